@@ -0,0 +1,440 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+from datetime import datetime, timezone
+from statistics import median, quantiles
+from threading import Semaphore
+from time import sleep
+from timeit import default_timer
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from frame_mailbox import FrameMailbox
+from instrumentation import get_instrumentation
+from logger import get_logger, set_logger
+from media_pipeline import MediaPipeline
+from quality_ladder import QualityLadder, QualityRung
+from udp_helper import PlayoutClock, UDPBuffer, UDPDatagram, add_parity, udp_datagram_from_msg
+from video_renderer import VideoRenderer
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # Prepares a run (untimed) and returns the function to be timed, which makes `operations` operations
+    setup: Callable[[], Callable[[], None]]
+    operations: int
+
+
+class Baseline(NamedTuple):
+    median: float  # Microseconds per operation, median of the repeats
+    minimum: float  # Microseconds per operation, fastest repeat
+    spread: float  # Interquartile range of the repeats, relative to the median
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    median: float  # Microseconds per operation, median of the repeats
+    minimum: float  # Microseconds per operation, fastest repeat
+    spread: float  # Interquartile range of the repeats, relative to the median
+    baseline: Optional[Baseline]  # Baseline of the benchmark, if there is one
+    regression: bool  # Both the median and the fastest repeat are slower than the baseline by more than the tolerance
+
+
+# Every random input is generated from this seed, so every run measures exactly the same work
+SEED = 2020
+DATAGRAM_PAYLOAD_SIZES = [1_000, 10_000, 60_000]
+DATAGRAM_OPERATIONS = 2_000
+# Frames inserted in the buffer on every run (more than UDPBuffer.RING_CAPACITY, so the ring wraps around)
+BUFFER_FRAMES = 512
+BUFFER_FRAME_SIZE = 20_000
+# Frames per second announced by the datagrams inserted in the buffer. It is high enough for consume never to wait for
+# the playout interval, so every call does the work of playing a frame
+BUFFER_FPS = 1_000_000_000
+REORDER_DEPTH = 3
+DUPLICATE_RATE = 0.2
+LOSS_RATE = 0.1
+FEC_GROUP_SIZE = 4
+FEC_LOSS_RATE = 0.05
+JPEG_OPERATIONS = 20
+COMPOSE_OPERATIONS = 20
+
+BASELINE_FILE = "benchmark_baseline.json"
+REPEATS = 15
+# A benchmark regresses when both its median and its fastest repeat are more than a tolerance slower than the ones of
+# its baseline. The tolerance is THRESHOLD, unless the repeats (of the baseline or of the run) are so noisy that
+# NOISE_FACTOR times their relative interquartile range is bigger, up to MAX_TOLERANCE
+THRESHOLD = 0.25
+NOISE_FACTOR = 2
+MAX_TOLERANCE = 0.5
+# A benchmark that regresses is measured again up to CONFIRMATIONS times (after the rest of the suite, waiting
+# CONFIRMATION_DELAY seconds before each round, so the measurements are spread in time), and it's only reported as a
+# regression if it regresses every time. Periods of load on the machine should not fail the suite
+CONFIRMATIONS = 3
+CONFIRMATION_DELAY = 2
+
+
+def _source_frame() -> np.ndarray:
+    """
+    :return: a camera-like BGR frame (a gradient with some texture) of MediaPipeline.VIDEO_WIDTH x VIDEO_HEIGHT
+    """
+    width, height = MediaPipeline.VIDEO_WIDTH, MediaPipeline.VIDEO_HEIGHT
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    gradient = np.dstack([np.tile(x, (height, 1)), np.tile(y[:, None], (1, width)), np.full((height, width), 128)])
+    texture = cv2.GaussianBlur(np.random.default_rng(SEED).normal(0, 40, (height, width, 3)), (5, 5), 0)
+    return np.clip(gradient + texture, 0, 255).astype(np.uint8)
+
+
+def _payload(rng: random.Random, size: int) -> bytes:
+    """
+    :param rng: random number generator
+    :param size: number of bytes
+    :return: random bytes
+    """
+    return rng.getrandbits(8 * size).to_bytes(size, "little")
+
+
+def _check_round_trip(datagram: UDPDatagram, message: memoryview):
+    """
+    Makes sure that a message parses back into the datagram it was encoded from, so a parser that rejects the message
+    right away is not measured as a fast one
+    :param datagram: datagram encoded
+    :param message: the encoded datagram
+    :raise RuntimeError: if the message is not parsed back into the datagram
+    """
+    parsed = udp_datagram_from_msg(message)
+    if parsed is None or (parsed.seq_number, parsed.sent_ts, parsed.resolution, parsed.fps, bytes(parsed.data)) != \
+            (datagram.seq_number, datagram.sent_ts, datagram.resolution, datagram.fps, bytes(datagram.data)):
+        raise RuntimeError(f"Datagram {datagram.seq_number} was not parsed back from its encoding")
+
+
+def _datagram_benchmarks() -> List[Benchmark]:
+    """
+    :return: benchmarks of encoding and parsing datagrams with both headers, for every payload size
+    """
+    benchmarks = []
+    for size in DATAGRAM_PAYLOAD_SIZES:
+        payload = _payload(random.Random(SEED), size)
+        datagram = UDPDatagram(1, "640x480", 30, payload)
+        for binary in (False, True):
+            header = "binary" if binary else "ascii"
+
+            def encode(datagram=datagram, binary=binary):
+                def run():
+                    for _ in range(DATAGRAM_OPERATIONS):
+                        datagram.encode(binary=binary)
+                return run
+
+            def parse(datagram=datagram, message=memoryview(datagram.encode(binary=binary))):
+                _check_round_trip(datagram, message)
+
+                def run():
+                    for _ in range(DATAGRAM_OPERATIONS):
+                        udp_datagram_from_msg(message)
+                return run
+
+            benchmarks.append(Benchmark(f"datagram.encode.{header}[{size}]", encode, DATAGRAM_OPERATIONS))
+            benchmarks.append(Benchmark(f"datagram.parse.{header}[{size}]", parse, DATAGRAM_OPERATIONS))
+    return benchmarks
+
+
+def _arrival(scenario: str) -> List[UDPDatagram]:
+    """
+    :param scenario: in_order, reordered, duplicated, lossy or fec_lossy
+    :return: the datagrams of BUFFER_FRAMES frames, in the order they arrive on the scenario
+    """
+    rng = random.Random(SEED)
+    payload = _payload(rng, BUFFER_FRAME_SIZE)
+    frames = [UDPDatagram(seq_number, "640x480", BUFFER_FPS, payload) for seq_number in range(1, BUFFER_FRAMES + 1)]
+    if scenario == "in_order":
+        return frames
+    if scenario == "reordered":
+        # Every frame arrives up to REORDER_DEPTH positions late
+        return [frame for _, frame in sorted(((i + rng.uniform(0, REORDER_DEPTH), frame)
+                                              for i, frame in enumerate(frames)), key=lambda item: item[0])]
+    if scenario == "duplicated":
+        arrival = []
+        for frame in frames:
+            arrival.append(frame)
+            if rng.random() < DUPLICATE_RATE:
+                arrival.append(UDPDatagram(frame.seq_number, frame.resolution, frame.fps, frame.data,
+                                           ts=frame.sent_ts))
+        return arrival
+    if scenario == "lossy":
+        return [frame for frame in frames if rng.random() >= LOSS_RATE]
+    if scenario == "fec_lossy":
+        # Frames split into fragments protected by parity datagrams (V3), losing packets independently
+        return [datagram for frame in frames for datagram in add_parity(frame.fragment(always=True), FEC_GROUP_SIZE)
+                if rng.random() >= FEC_LOSS_RATE]
+    raise ValueError(f"Unknown arrival scenario {scenario}")
+
+
+def _buffer_benchmarks(playout_clock: PlayoutClock) -> List[Benchmark]:
+    """
+    :param playout_clock: clock of the buffers (stopped, so it does not tick while they are measured)
+    :return: benchmarks of inserting every datagram that arrives in an adaptive buffer and consuming a frame after it
+    """
+    benchmarks = []
+    for scenario in ("in_order", "reordered", "duplicated", "lossy", "fec_lossy"):
+        def setup(scenario=scenario):
+            udp_buffer = UDPBuffer(playout_clock, adaptive=True)
+            arrival = _arrival(scenario)
+
+            def run():
+                for datagram in arrival:
+                    udp_buffer.insert(datagram)
+                    udp_buffer.consume()
+                while udp_buffer.consume():
+                    pass
+            return run
+
+        benchmarks.append(Benchmark(f"buffer.{scenario}", setup, BUFFER_FRAMES))
+    return benchmarks
+
+
+def _rungs() -> List[QualityRung]:
+    """
+    :return: the rungs of the quality ladder with a different resolution or JPEG quality
+    """
+    formats = {}
+    for rung in QualityLadder.RUNGS:
+        formats.setdefault((rung.width, rung.height, rung.jpeg_quality), rung)
+    return list(formats.values())
+
+
+def _jpeg_benchmarks(frame: np.ndarray) -> List[Benchmark]:
+    """
+    :param frame: camera frame
+    :return: benchmarks of compressing a camera frame with every format sent and decompressing it
+    """
+    benchmarks = []
+    for rung in _rungs():
+        name = f"{rung.width}x{rung.height}q{rung.jpeg_quality}"
+
+        def encode(rung=rung):
+            def run():
+                for _ in range(JPEG_OPERATIONS):
+                    MediaPipeline.encode_frame(frame, rung)
+            return run
+
+        def decode(data=np.frombuffer(MediaPipeline.encode_frame(frame, rung), np.uint8)):
+            def run():
+                for _ in range(JPEG_OPERATIONS):
+                    cv2.imdecode(data, cv2.IMREAD_COLOR)
+            return run
+
+        benchmarks.append(Benchmark(f"jpeg.encode[{name}]", encode, JPEG_OPERATIONS))
+        benchmarks.append(Benchmark(f"jpeg.decode[{name}]", decode, JPEG_OPERATIONS))
+    return benchmarks
+
+
+def _compose_benchmarks(frame: np.ndarray) -> List[Benchmark]:
+    """
+    :param frame: camera frame
+    :return: benchmarks of the work display_video does for every frame in a call: taking the local frame, rendering it
+             with the remote one on top and copying the result for the GUI thread (as GuiUpdater.update_frame does)
+    """
+    benchmarks = []
+    for width, height in dict.fromkeys((rung.width, rung.height) for rung in QualityLadder.RUNGS):
+        def setup(remote_frame=MediaPipeline.encode_frame(frame, QualityRung("", width, height, 75, 30))):
+            renderer = VideoRenderer(MediaPipeline.VIDEO_WIDTH, MediaPipeline.VIDEO_HEIGHT)
+            mailbox = FrameMailbox()
+            displayed = np.empty((MediaPipeline.VIDEO_HEIGHT, MediaPipeline.VIDEO_WIDTH, 3), np.uint8)
+            # Frames are never modified after being put in the mailbox, so each run puts its own copies
+            local_frames = [frame.copy() for _ in range(COMPOSE_OPERATIONS)]
+
+            def run():
+                for local_frame in local_frames:
+                    mailbox.put(local_frame)
+                    local_frame = renderer.render_local(mailbox.take())
+                    np.copyto(displayed, renderer.render_call(remote_frame, local_frame))
+            return run
+
+        benchmarks.append(Benchmark(f"compose[{width}x{height}]", setup, COMPOSE_OPERATIONS))
+    return benchmarks
+
+
+def spread(times: List[float]) -> float:
+    """
+    :param times: time of every repeat
+    :return: interquartile range of the times, relative to their median
+    """
+    if len(times) < 2:
+        return 0
+    first_quartile, _, third_quartile = quantiles(times, n=4)
+    return (third_quartile - first_quartile) / median(times)
+
+
+def is_regression(result_median: float, minimum: float, result_spread: float, baseline: Baseline,
+                  threshold: float) -> bool:
+    """
+    :param result_median: median of a run, in microseconds per operation
+    :param minimum: fastest repeat of the run
+    :param result_spread: relative interquartile range of the run
+    :param baseline
+    :param threshold: minimum tolerance, as a fraction of the baseline
+    :return: True if both the median and the fastest repeat are slower than the baseline by more than the tolerance
+    """
+    tolerance = max(threshold, min(NOISE_FACTOR * max(baseline.spread, result_spread), MAX_TOLERANCE))
+    return result_median > baseline.median * (1 + tolerance) and minimum > baseline.minimum * (1 + tolerance)
+
+
+def measure(benchmark: Benchmark, repeats: int) -> List[float]:
+    """
+    Runs a benchmark with the garbage collector disabled (as timeit does)
+    :param benchmark
+    :param repeats: number of runs
+    :return: microseconds per operation of every run
+    """
+    times = []
+    for _ in range(repeats):
+        run = benchmark.setup()
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = default_timer()
+            run()
+            end = default_timer()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        times.append((end - start) * 1_000_000 / benchmark.operations)
+    return times
+
+
+def run_benchmarks(name_filter: str = "", repeats: int = REPEATS, baseline: Dict[str, Baseline] = None,
+                   threshold: float = THRESHOLD) -> List[BenchmarkResult]:
+    """
+    :param name_filter: only the benchmarks whose name contains it are run
+    :param repeats: number of runs of every benchmark
+    :param baseline: baseline of every benchmark, by name, to compare the results with
+    :param threshold: minimum tolerance (as a fraction of the baseline) of the regressions, see is_regression
+    :return: result of every benchmark run
+    """
+    baseline = baseline or {}
+    frame = _source_frame()
+    playout_clock = PlayoutClock(Semaphore())
+    playout_clock.stop()
+    benchmarks = _datagram_benchmarks() + _buffer_benchmarks(playout_clock) + _jpeg_benchmarks(frame) + \
+        _compose_benchmarks(frame)
+
+    def run(benchmark: Benchmark) -> BenchmarkResult:
+        times = measure(benchmark, repeats)
+        result_median, minimum, result_spread = median(times), min(times), spread(times)
+        reference = baseline.get(benchmark.name)
+        get_logger().debug(f"{benchmark.name}: {result_median:.2f} us")
+        return BenchmarkResult(benchmark.name, result_median, minimum, result_spread, reference,
+                               reference is not None and
+                               is_regression(result_median, minimum, result_spread, reference, threshold))
+
+    results = {benchmark.name: run(benchmark) for benchmark in benchmarks if name_filter in benchmark.name}
+    for _ in range(CONFIRMATIONS):
+        suspects = [benchmark for benchmark in benchmarks if benchmark.name in results and
+                    results[benchmark.name].regression]
+        if not suspects:
+            break
+        sleep(CONFIRMATION_DELAY)
+        for benchmark in suspects:
+            get_logger().info(f"{benchmark.name} looks slower than its baseline, measuring it again")
+            results[benchmark.name] = run(benchmark)
+    return list(results.values())
+
+
+def machine() -> dict:
+    """
+    :return: description of the machine and the software the benchmarks run on. Results are only comparable with a
+             baseline measured on the same one
+    """
+    return {"platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(), "python": platform.python_version(), "opencv": cv2.__version__,
+            "numpy": np.__version__}
+
+
+def load_baseline(path: str) -> Tuple[Dict[str, Baseline], dict]:
+    """
+    :param path: path of the baseline file
+    :return: baseline of every benchmark, by name, and the machine they were measured on (both empty if there is no
+             baseline file)
+    """
+    try:
+        with open(path) as file:
+            content = json.load(file)
+    except FileNotFoundError:
+        return {}, {}
+    return {name: Baseline(**result) for name, result in content["results"].items()}, content.get("machine", {})
+
+
+def save_baseline(path: str, results: List[BenchmarkResult], repeats: int):
+    """
+    Stores the results as the new baseline, along with the machine and the conditions they were measured on. The
+    baselines of the benchmarks that were not run are kept
+    :param path: path of the baseline file
+    :param results
+    :param repeats: number of runs of every benchmark
+    """
+    baseline, _ = load_baseline(path)
+    baseline.update({result.name: Baseline(result.median, result.minimum, result.spread) for result in results})
+    conditions = {"date": datetime.now(timezone.utc).isoformat(timespec="seconds"), "repeats": repeats,
+                  "instrumentation": get_instrumentation().enabled}
+    if hasattr(os, "getloadavg"):
+        conditions["load_average"] = round(os.getloadavg()[0], ndigits=2)
+    with open(path, "w") as file:
+        json.dump({"machine": machine(), "conditions": conditions,
+                   "results": {name: {field: round(value, ndigits=3) for field, value in result._asdict().items()}
+                               for name, result in sorted(baseline.items())}}, file, indent=2)
+        file.write("\n")
+
+
+def print_results(results: List[BenchmarkResult]):
+    """
+    Prints a table with the results and their change with respect to the baseline
+    :param results
+    """
+    width = max(len(result.name) for result in results)
+    print(f"{'benchmark':<{width}} {'median us':>12} {'min us':>12} {'iqr':>7} {'baseline us':>12} {'change':>8}")
+    for result in results:
+        line = f"{result.name:<{width}} {result.median:>12.2f} {result.minimum:>12.2f} {result.spread * 100:>6.1f}%"
+        if result.baseline is not None:
+            change = (result.median / result.baseline.median - 1) * 100
+            line += f" {result.baseline.median:>12.2f} {change:>+7.1f}%"
+            if result.regression:
+                line += "  REGRESSION"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Samtale benchmarks')
+
+    parser.add_argument('-log_level', action='store', nargs='?', default='warning',
+                        choices=['debug', 'info', 'warning', 'error'], required=False,
+                        help='Indicate logging level')
+    parser.add_argument('-filter', action='store', default='', required=False,
+                        help='Indicate a text that the names of the benchmarks run must contain')
+    parser.add_argument('-repeats', action='store', type=int, default=REPEATS, required=False,
+                        help='Indicate the number of runs of every benchmark')
+    parser.add_argument('-baseline', action='store', default=BASELINE_FILE, required=False,
+                        help='Indicate the file with the baseline results')
+    parser.add_argument('-threshold', action='store', type=float, default=THRESHOLD, required=False,
+                        help='Indicate the minimum slowdown (as a fraction of the baseline) considered a regression')
+    parser.add_argument('-save', action='store_true', required=False,
+                        help='Indicate that the results are stored as the new baseline')
+
+    args = parser.parse_args()
+
+    set_logger(args)
+    baseline_results, baseline_machine = load_baseline(args.baseline)
+    if baseline_results and baseline_machine != machine():
+        get_logger().warning(f"The baseline was measured on another machine ({baseline_machine}), so the results "
+                             f"can't be compared with it")
+    benchmark_results = run_benchmarks(args.filter, args.repeats, baseline_results, args.threshold)
+    print_results(benchmark_results)
+    if args.save:
+        save_baseline(args.baseline, benchmark_results, args.repeats)
+    elif any(result.regression for result in benchmark_results):
+        sys.exit(1)
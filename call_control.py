@@ -1,12 +1,16 @@
+import asyncio
 import socket
+from collections import deque
 from threading import Thread, Lock
-from typing import Optional, Tuple
-from timeit import default_timer
+from typing import Callable, Deque, List, NamedTuple, Optional, Tuple
 
 from decorators import run_in_thread
-from discovery_server import get_user, UserUnknown, BadUser
+from instrumentation import counter, timed
+from discovery_server import get_user_directory, UserUnknown, BadUser, DiscoveryUnavailable
 from logger import get_logger
-from user import User, CurrentUser
+from network_core import NetworkCore
+from udp_helper import steady_time
+from user import User, CurrentUser, protocol_version
 
 
 def _open_tcp_socket(src_user: User) -> socket:
@@ -21,24 +25,122 @@ def _open_tcp_socket(src_user: User) -> socket:
     return sock
 
 
+class ReceiverReport(NamedTuple):
+    """
+    Report on the video received, sent periodically by the receiver of a call (V4+) so the sender can adapt to it
+    """
+    loss: float  # Estimated fraction of packets lost (before recovering them)
+    highest_seq_number: int  # Highest sequence number received
+    jitter: float  # Measured in ms
+    depth: int  # Frames in the buffer
+    decoded_fps: float  # Frames decoded per second since the previous report
+
+    def to_message(self, nickname: str) -> str:
+        """
+        :param nickname: nickname of the user sending the report
+        :return: the CALL_REPORT message
+        """
+        return f"CALL_REPORT {nickname} {self.loss:.4f} {self.highest_seq_number} {self.jitter:.2f} {self.depth} " \
+               f"{self.decoded_fps:.1f}"
+
+    @staticmethod
+    def from_message(fields: List[str]) -> "ReceiverReport":
+        """
+        :param fields: fields of a CALL_REPORT message, split by whitespace
+        :return: the report
+        :raise ValueError, IndexError: if the message is malformed
+        """
+        return ReceiverReport(float(fields[2]), int(fields[3]), float(fields[4]), int(fields[5]), float(fields[6]))
+
+
+class RoundTripStatistics(NamedTuple):
+    rtt: float  # Smoothed round trip time, measured in ms
+    min_rtt: float  # Lowest round trip time of the last OFFSET_SAMPLES probes, measured in ms
+    clock_offset: float  # Seconds the clock of the other end is ahead of ours
+    samples: int  # Probes answered
+
+
+class RoundTripEstimator:
+    """
+    Estimates the round trip time of a call and the offset between the clocks of both ends (V5+), the way NTP does.
+    Every CALL_PING carries the moment it was sent, and the CALL_PONG echoes it along with the moments the other end
+    received the ping and answered it. The offset is taken from the fastest of the last probes, since it is the one
+    least affected by queues (and by asymmetric paths)
+    """
+    # Weight of every new sample on the smoothed round trip time (as in TCP, RFC 6298)
+    RTT_GAIN = 1 / 8
+    OFFSET_SAMPLES = 8
+
+    def __init__(self):
+        """
+        Constructor. Nothing is estimated until the first sample is added
+        """
+        self.__mutex = Lock()
+        self.__rtt = 0
+        self.__count = 0
+        # Round trip time (in ms) and clock offset of the last OFFSET_SAMPLES probes
+        self.__samples: Deque[Tuple[float, float]] = deque(maxlen=RoundTripEstimator.OFFSET_SAMPLES)
+
+    def add_sample(self, sent: float, remote_received: float, remote_sent: float, received: float) \
+            -> RoundTripStatistics:
+        """
+        :param sent: moment the ping was sent, by our clock
+        :param remote_received: moment the ping was received, by the clock of the other end
+        :param remote_sent: moment the pong was sent, by the clock of the other end
+        :param received: moment the pong was received, by our clock
+        :return: the estimates, including the new sample
+        """
+        rtt = max((received - sent) - (remote_sent - remote_received), 0) * 1000
+        offset = ((remote_received - sent) + (remote_sent - received)) / 2
+        with self.__mutex:
+            self.__rtt = rtt if not self.__count else self.__rtt + (rtt - self.__rtt) * RoundTripEstimator.RTT_GAIN
+            self.__count += 1
+            self.__samples.append((rtt, offset))
+            return self.__statistics()
+
+    def get_statistics(self) -> Optional[RoundTripStatistics]:
+        """
+        :return: round trip time, lowest round trip time, clock offset and probes answered. None if no probe has been
+                 answered yet
+        """
+        with self.__mutex:
+            return self.__statistics() if self.__count else None
+
+    def __statistics(self) -> RoundTripStatistics:
+        """
+        Must be called with the mutex held, after the first sample has been added
+        """
+        min_rtt, offset = min(self.__samples)
+        return RoundTripStatistics(self.__rtt, min_rtt, offset, self.__count)
+
+
 class CallControl:
     BUFFER_SIZE = 1024
     TIMEOUT = 30
-    CONGESTED_INTERVAL = 60
+    # Messages that may be received through the connection of a call. Each one is counted by its own counter, and
+    # anything else by CallControl.unknown (so the other end can't create counters at will)
+    CALL_MESSAGES = ("CALL_HOLD", "CALL_RESUME", "CALL_CONGESTED", "CALL_REPORT", "CALL_PING", "CALL_PONG", "CALL_END")
+    MESSAGE_COUNTERS = {message: counter(f"CallControl.{message}") for message in CALL_MESSAGES}
+    UNKNOWN_MESSAGE_COUNTER = counter("CallControl.unknown")
 
-    def __init__(self, video_client, start_control_thread: bool):
+    def __init__(self, video_client, start_control_thread: bool, network_core: NetworkCore = None):
         """
         Default constructor
-        :param video_client: instance of the video client. Needed to access methods from the GUI
+        :param video_client: instance of the media pipeline (the GUI or the headless client). Needed to access the
+                             video buffers and to inform the user
         :param start_control_thread: True in control thread (the one who listens for requests) should start.
                                      This may only happen when CurrentUser is initialized.
+        :param network_core: if specified, the control listener and the call connections are run on its event loop
+                             instead of on dedicated threads
         """
         self.video_client = video_client
+        self.network_core = network_core
         # Control thread
         self.control_socket: Optional[socket] = None
+        self.control_server: Optional[asyncio.AbstractServer] = None
         self.control_thread = Thread(target=self.control_daemon, daemon=True)
         if start_control_thread:
-            self.control_thread.start()
+            self.start_control()
         # Call
         self._in_call = False
         self._waiting = False
@@ -49,7 +151,66 @@ class CallControl:
         self.call_lock = Lock()
         self.dst_user: Optional[User] = None
         self.call_socket: Optional[socket] = None
+        self.call_writer: Optional[asyncio.StreamWriter] = None
         self.call_thread: Optional[Thread] = None
+        # V4+: part of a message received through the connection of the call whose newline has not arrived yet
+        self.call_data = b""
+        self.last_report: Optional[ReceiverReport] = None
+        self.round_trip = RoundTripEstimator()
+
+    def start_control(self):
+        """
+        Starts listening for incoming calls, either on the control thread or on the event loop of the network core
+        """
+        if self.network_core is not None:
+            self.control_server = self.network_core.serve_control(CurrentUser().tcp_port, self._async_control_handler)
+        else:
+            self.control_thread.start()
+
+    def stop_control(self):
+        """
+        Stops listening for incoming calls
+        """
+        if self.control_server is not None:
+            self.network_core.call_soon(self.control_server.close)
+        if self.control_socket is not None:
+            self.control_socket.close()
+
+    def _send_call_message(self, message: str):
+        """
+        Sends a message through the connection of the current call. Since V4, every message ends with a newline
+        :param message
+        """
+        if self.protocol is not None and protocol_version(self.protocol) >= 4:
+            message += "\n"
+        if self.call_writer is not None:
+            self.network_core.call_soon(self.call_writer.write, message.encode())
+        else:
+            self.call_socket.send(message.encode())
+
+    def _reset_call_state(self):
+        """
+        Resets what is kept about the connection of a call (the part of a message received without its newline, the
+        last receiver report and the samples of the round trip probe), so a new call does not inherit them from the
+        previous one. Must be called before the messages of the call are read
+        """
+        self.call_data = b""
+        self.last_report = None
+        self.round_trip = RoundTripEstimator()
+
+    def _start_call_daemon(self, connection: socket):
+        """
+        Starts listening for the messages of the other end of the call
+        :param connection: connection of the call
+        """
+        self.call_socket = connection
+        self._reset_call_state()
+        if self.network_core is not None:
+            reader, self.call_writer = self.network_core.open_stream(connection)
+            self.network_core.run(self._async_call_daemon(reader))
+        else:
+            self.call_thread = Thread(target=self.call_daemon, daemon=True)
+            self.call_thread.start()
 
     def in_call(self) -> bool:
         """
@@ -89,6 +250,7 @@ class CallControl:
         """
         return self.dst_user.ip, self.dst_user.udp_port
 
+    @timed("CallControl.call_start")
     def _call_start(self, nickname: str):
         """
         Try to establish a call with the desired user, waiting for his answer. It displays information of the process
@@ -98,8 +260,8 @@ class CallControl:
         # Fetch user from server
         get_logger().info(f"Calling {nickname}...")
         try:
-            user = get_user(nickname)
-        except (UserUnknown, BadUser) as e:
+            user = get_user_directory().get_user(nickname)
+        except (UserUnknown, BadUser, DiscoveryUnavailable) as e:
             with self.call_lock:
                 self._waiting = False
 
@@ -114,6 +276,8 @@ class CallControl:
             connection.connect((user.ip, user.tcp_port))
         except socket.error:
             get_logger().info(f"Could not connect to {user.nick} at {user.ip}:{user.tcp_port}")
+            # The user may have registered again with another address since it was cached
+            get_user_directory().invalidate(user.nick)
             self.video_client.display_message("Could not connect",
                                               f"Could not connect to {user.nick} at {user.ip}:{user.tcp_port}")
             with self.call_lock:
@@ -154,9 +318,7 @@ class CallControl:
                 self.dst_user = user
                 self.dst_user.update_udp_port(int(response[2]))
                 connection.settimeout(None)  # The connection should not be closed until wanted
-                self.call_socket = connection
-                self.call_thread = Thread(target=self.call_daemon)
-                self.call_thread.start()
+                self._start_call_daemon(connection)
                 with self.call_lock:
                     self._in_call = True
                 self.video_client.display_in_call(nickname)
@@ -220,8 +382,13 @@ class CallControl:
             self.they_on_hold = False
             self.sequence_number = 0
             self.protocol = None
+            self.video_client.quality_ladder.reset()
             self.video_client.flush_buffer()
-            self.call_socket.close()
+            if self.call_writer is not None:
+                self.network_core.call_soon(self.call_writer.close)
+                self.call_writer = None
+            else:
+                self.call_socket.close()
             self.video_client.display_connect()
 
     def call_end(self):
@@ -229,7 +396,7 @@ class CallControl:
         Notify the other end we are ending the call and reset attributes
         """
         get_logger().info(f"Ending call with {self.dst_user.nick}")
-        self.call_socket.send(f"CALL_END {CurrentUser().nick}".encode())
+        self._send_call_message(f"CALL_END {CurrentUser().nick}")
         self._call_end()
 
     @run_in_thread
@@ -240,7 +407,7 @@ class CallControl:
         """
         self.we_on_hold = True
         get_logger().info(f"Pausing call with {self.dst_user.nick}")
-        self.call_socket.send(f"CALL_HOLD {CurrentUser().nick}".encode())
+        self._send_call_message(f"CALL_HOLD {CurrentUser().nick}")
 
     @run_in_thread
     def call_resume(self):
@@ -250,7 +417,7 @@ class CallControl:
         """
         self.we_on_hold = False
         get_logger().info(f"Resuming call with {self.dst_user.nick}")
-        self.call_socket.send(f"CALL_RESUME {CurrentUser().nick}".encode())
+        self._send_call_message(f"CALL_RESUME {CurrentUser().nick}")
 
     @run_in_thread
     def call_congested(self):
@@ -261,15 +428,112 @@ class CallControl:
         # All protocols different to V0 should support this
         if self.protocol != "V0":
             get_logger().info(f"Sending CALL_CONGESTED to {self.dst_user.nick}")
-            self.call_socket.send(f"CALL_CONGESTED {CurrentUser().nick}".encode())
+            self._send_call_message(f"CALL_CONGESTED {CurrentUser().nick}")
         else:
             get_logger().info(f"Won't send CALL_CONGESTED to {self.dst_user.nick} since it is using V0")
 
+    def call_report(self, report: ReceiverReport):
+        """
+        Sends a receiver report to the other end. This is done only if the call protocol is V4 or higher (checked
+        inside)
+        :param report: report on the video received
+        """
+        protocol = self.protocol
+        if protocol is not None and protocol_version(protocol) >= 4:
+            get_logger().debug(f"Sending {report} to {self.dst_user.nick}")
+            self._send_call_message(report.to_message(CurrentUser().nick))
+
+    def call_ping(self):
+        """
+        Sends a round trip probe to the other end, which answers it with a CALL_PONG. This is done only if the call
+        protocol is V5 or higher (checked inside)
+        """
+        protocol = self.protocol
+        if protocol is not None and protocol_version(protocol) >= 5:
+            self._send_call_message(f"CALL_PING {CurrentUser().nick} {steady_time():.6f}")
+
+    @timed("CallControl.handle_incoming_connection")
+    def _handle_incoming_connection(self, response: bytes, client_address: Tuple[str, int],
+                                    send: Callable[[bytes], None], peer_closed: Callable[[], bool]) -> bool:
+        """
+        Handles the first message of an incoming connection. If we are already in a call, it answers CALL_BUSY to the
+        incoming user. If we are available, asks the user whether to accept the call or not. It may block until the
+        user answers.
+        :param response: first message received
+        :param client_address: address of the other end
+        :param send: function that sends data through the connection
+        :param peer_closed: function that tells if the other end has closed the connection
+        :return: True if a call has been accepted (so the connection should be kept open), False if not
+        """
+        lock_held = False
+        try:
+            get_logger().debug(f"Received via control connection: {response}")
+            response = response.decode().split()
+
+            self.call_lock.acquire()
+            lock_held = True
+            if self._in_call or self._waiting:
+                self.call_lock.release()  # Release the lock asap
+                lock_held = False
+                if response[0] == "CALLING":
+                    send("CALL_BUSY".encode())
+                    get_logger().info(f"{response[1]} called while in a call")
+                    self.video_client.display_message(f"{response[1]} called you", f"{response[1]} called you")
+                else:
+                    get_logger().error(f"Received {response} while on a call. The other side is probably sending "
+                                       f"data using a new TCP connection instead of using the already created one")
+                return False
+
+            if response[0] != "CALLING":
+                get_logger().error(f"The first word in {response} should be CALLING")
+                self.call_lock.release()
+                lock_held = False
+                return False
+
+            # If V1 or +, CALLING has the protocol to be used in last argument
+            self.protocol = response[3] if len(response) > 3 else "V0"
+
+            incoming_user = User(nick=response[1],
+                                 protocols=self.protocol,
+                                 tcp_port=client_address[1],
+                                 ip=client_address[0],
+                                 udp_port=int(response[2]))
+
+            # Wait for the user's answer without blocking the execution (releasing the lock)
+            self.call_lock.release()
+            lock_held = False
+            accept = self.video_client.incoming_call(incoming_user.nick, incoming_user.ip)
+            self.call_lock.acquire()
+            lock_held = True
+            if accept:
+                send(f"CALL_ACCEPTED {CurrentUser().nick} {CurrentUser().udp_port}".encode())
+                if peer_closed():
+                    self.call_lock.release()
+                    get_logger().info("The other end has closed the connection")
+                    self.video_client.display_message("Connection timed out",
+                                                      f"{incoming_user.nick} was tired of waiting for you to answer")
+                    return False
+
+                get_logger().info(f"We accepted a call with {incoming_user.nick}")
+                self._in_call = True
+                self.video_client.display_in_call(incoming_user.nick)
+                self.dst_user = incoming_user
+            else:
+                get_logger().info(f"We rejected a call with {incoming_user.nick}")
+                send(f"CALL_DENIED {CurrentUser().nick}".encode())
+            self.call_lock.release()
+            return accept
+        except (ValueError, IndexError):
+            get_logger().error(f"Error parsing control message")
+            send(f"CALL_DENIED {CurrentUser().nick}".encode())
+            if lock_held:
+                self.call_lock.release()
+            return False
+
     def control_daemon(self):
         """
-        Function executed by the listener, checking if someone is calling us. If we are already in a call,
-        it answers CALL_BUSY to the incoming user. If we are available, builds a new CallControl, where
-        the user can interact with the call (deny it, ...)
+        Function executed by the listener, checking if someone is calling us. Each incoming connection is handled by
+        _handle_incoming_connection
         """
         self.control_socket = _open_tcp_socket(CurrentUser())
         self.control_socket.listen(1)
@@ -277,118 +541,146 @@ class CallControl:
             connection, client_address = self.control_socket.accept()
             connection.settimeout(3)
 
+            def peer_closed() -> bool:
+                # The following code will throw an exception if the connection is open
+                try:
+                    connection.setblocking(False)
+                    connection.recv(10)
+                    # If we have reached here the connection has been closed in the other end
+                    return True
+                except BlockingIOError:
+                    connection.setblocking(True)
+                    return False
+
             try:
                 response = connection.recv(CallControl.BUFFER_SIZE)
-                get_logger().debug(f"Received via control connection: {response}")
-                response = response.decode().split()
-
-                self.call_lock.acquire()
-                if self._in_call or self._waiting:
-                    self.call_lock.release()  # Release the lock asap
-                    if response[0] == "CALLING":
-                        connection.send("CALL_BUSY".encode())
-                        get_logger().info(f"{response[1]} called while in a call")
-                        self.video_client.display_message(f"{response[1]} called you", f"{response[1]} called you")
-                    else:
-                        get_logger().error(f"Received {response} while on a call. The other side is probably sending "
-                                           f"data using a new TCP connection instead of using the already created one")
-                    connection.close()
-                    continue
-
-                if response[0] != "CALLING":
-                    get_logger().error(f"The first word in {response} should be CALLING")
-                    connection.close()
-                    continue
-
-                # If V1 or +, CALLING has the protocol to be used in last argument
-                self.protocol = response[3] if len(response) > 3 else "V0"
-
-                incoming_user = User(nick=response[1],
-                                     protocols=self.protocol,
-                                     tcp_port=client_address[1],
-                                     ip=client_address[0],
-                                     udp_port=int(response[2]))
-                connection.settimeout(None)  # The connection should not be closed until wanted
+            except socket.error:
+                connection.close()
+                continue
 
-                # Wait for the user's answer without blocking the execution (releasing the lock)
-                self.call_lock.release()
-                accept = self.video_client.incoming_call(incoming_user.nick, incoming_user.ip)
-                self.call_lock.acquire()
-                if accept:
-                    answer = f"CALL_ACCEPTED {CurrentUser().nick} {CurrentUser().udp_port}".encode()
-                    connection.send(answer)
-                    # The following code will throw an exception if the connection is open
-                    try:
-                        connection.setblocking(False)
-                        connection.recv(10)
-                        # If we have reached here the connection has been closed in the other end
-                        self.call_lock.release()
-                        get_logger().info("The other end has closed the connection")
-                        self.video_client.display_message("Connection timed out",
-                                                          f"{incoming_user.nick} was tired of waiting for you to answer")
-                        connection.close()
-                        continue
-                    except BlockingIOError:
-                        connection.setblocking(True)
-
-                    get_logger().info(f"We accepted a call with {incoming_user.nick}")
-                    self._in_call = True
-                    self.video_client.display_in_call(incoming_user.nick)
-                    self.dst_user = incoming_user
-                    self.call_socket = connection
-                    self.call_thread = Thread(target=self.call_daemon, daemon=True)
-                    self.call_thread.start()
-                else:
-                    get_logger().info(f"We rejected a call with {incoming_user.nick}")
-                    connection.send(f"CALL_DENIED {CurrentUser().nick}".encode())
-                    connection.close()
-                self.call_lock.release()
-            except (ValueError, IndexError):
-                get_logger().error(f"Error parsing control message")
-                connection.send(f"CALL_DENIED {CurrentUser().nick}".encode())
+            if self._handle_incoming_connection(response, client_address, connection.send, peer_closed):
+                connection.settimeout(None)  # The connection should not be closed until wanted
+                self._start_call_daemon(connection)
+            else:
                 connection.close()
-                self.call_lock.release()
+
+    async def _async_control_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Coroutine run by the network core for each incoming connection. It is the counterpart of control_daemon.
+        Since the user has to be asked, the connection is handled on the executor of the event loop
+        :param reader
+        :param writer
+        """
+        try:
+            response = await asyncio.wait_for(reader.read(CallControl.BUFFER_SIZE), 3)
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+
+        def send(data: bytes):
+            self.network_core.call_soon(writer.write, data)
+
+        accept = await self.network_core.loop.run_in_executor(None, self._handle_incoming_connection, response,
+                                                              writer.get_extra_info("peername"), send, reader.at_eof)
+        if not accept:
+            writer.close()
+            return
+
+        self._reset_call_state()
+        self.call_socket = writer.get_extra_info("socket")
+        self.call_writer = writer
+        await self._async_call_daemon(reader)
+
+    def _handle_call_data(self, data: bytes) -> bool:
+        """
+        Handles data received through the connection of the call. Since V4, messages end with a newline, so several
+        messages (or part of one) may be received at once. Before V4, every chunk received is a message
+        :param data: data received. If empty, the connection has been closed
+        :return: False if the call is over, True if not
+        """
+        protocol = self.protocol
+        if not data or protocol is None or protocol_version(protocol) < 4:
+            return self._handle_call_message(data)
+        *messages, self.call_data = (self.call_data + data).split(b"\n")
+        for message in messages:
+            if message.strip() and not self._handle_call_message(message):
+                return False
+        return True
+
+    @timed("CallControl.handle_call_message")
+    def _handle_call_message(self, response: bytes) -> bool:
+        """
+        Handles a message received through the connection of the call, notifying the user if needed
+        :param response: data received. If empty, the connection has been closed
+        :return: False if the call is over, True if not
+        """
+        received = steady_time()
+        try:
+            response = response.decode().split()
+            # If socket is closed, no exception is thrown but response is empty
+            if not response:
+                self._call_end()
+                return False
+            CallControl.MESSAGE_COUNTERS.get(response[0], CallControl.UNKNOWN_MESSAGE_COUNTER).increment()
+            if response[0] == "CALL_HOLD":
+                get_logger().info(f"{self.dst_user.nick} paused the call")
+                self.they_on_hold = True
+            elif response[0] == "CALL_RESUME":
+                get_logger().info(f"{self.dst_user.nick} resumed the call")
+                self.they_on_hold = False
+            elif self.protocol != "V0" and response[0] == "CALL_CONGESTED":
+                get_logger().info(f"{self.dst_user.nick} detected network congestion")
+                self.video_client.quality_ladder.step_down()
+            elif self.protocol is not None and protocol_version(self.protocol) >= 4 and response[0] == "CALL_REPORT":
+                self.last_report = ReceiverReport.from_message(response)
+                self.video_client.receive_report(self.last_report)
+            elif self.protocol is not None and protocol_version(self.protocol) >= 5 and response[0] == "CALL_PING":
+                # The timestamp of the ping is echoed as it was received
+                self._send_call_message(f"CALL_PONG {CurrentUser().nick} {response[2]} {received:.6f} "
+                                        f"{steady_time():.6f}")
+            elif self.protocol is not None and protocol_version(self.protocol) >= 5 and response[0] == "CALL_PONG":
+                statistics = self.round_trip.add_sample(float(response[2]), float(response[3]), float(response[4]),
+                                                        received)
+                self.video_client.receive_round_trip(statistics)
+            elif response[0] == "CALL_END":
+                get_logger().info(f"{self.dst_user.nick} ended the call")
+                self._call_end()
+                self.video_client.display_message("Call ended",
+                                                  f"The user {self.dst_user.nick} has ended the call")
+                return False
+        except (ValueError, IndexError) as e:
+            get_logger().error(f"Error receiving information from {self.dst_user.nick}: {e}")
+        return True
 
     def call_daemon(self):
         """
         Function that is executed by the listener thread (one per call).
-        Checks if the call must be held, resumed, ended of if the connection is congested, notifying the user in any case
+        Checks if the call must be held, resumed, ended of if the connection is congested (or receives the reports of
+        the other end), notifying the user in any case
         """
-        last_congested = 0
-
         while True:
-            if self.protocol != "V0":  # Check congested condition only if using protocol that requires it
-                # If last congested has not been received since CONGESTED_INTERVAL seconds, deactivate extreme compression
-                if last_congested and default_timer() - last_congested > CallControl.CONGESTED_INTERVAL:
-                    self.video_client.extreme_compression = False
-
             try:
                 response = self.call_socket.recv(CallControl.BUFFER_SIZE)
                 get_logger().debug(f"{self.dst_user.nick} sent: {response}")
             except socket.error:
                 self._call_end()
                 break
+            if not self._handle_call_data(response):
+                break
+
+    async def _async_call_daemon(self, reader: asyncio.StreamReader):
+        """
+        Coroutine run by the network core for each call. It is the counterpart of call_daemon. Messages are handled on
+        the executor of the event loop, since the user may have to be notified
+        :param reader: reader of the connection of the call
+        """
+        loop = self.network_core.loop
+        while True:
             try:
-                response = response.decode().split()
-                # If socket is closed, no exception is thrown but response is empty
-                if not response:
-                    self._call_end()
-                    break
-                if response[0] == "CALL_HOLD":
-                    get_logger().info(f"{self.dst_user.nick} paused the call")
-                    self.they_on_hold = True
-                elif response[0] == "CALL_RESUME":
-                    get_logger().info(f"{self.dst_user.nick} resumed the call")
-                    self.they_on_hold = False
-                elif self.protocol != "V0" and response[0] == "CALL_CONGESTED":
-                    get_logger().info(f"{self.dst_user.nick} detected network congestion")
-                    last_congested = default_timer()
-                    self.video_client.extreme_compression = True
-                elif response[0] == "CALL_END":
-                    get_logger().info(f"{self.dst_user.nick} ended the call")
-                    self._call_end()
-                    self.video_client.display_message("Call ended",
-                                                      f"The user {self.dst_user.nick} has ended the call")
-                    break
-            except (ValueError, IndexError) as e:
-                get_logger().error(f"Error receiving information from {self.dst_user.nick}: {e}")
+                response = await reader.read(CallControl.BUFFER_SIZE)
+                get_logger().debug(f"{self.dst_user.nick} sent: {response}")
+            except ConnectionError:
+                await loop.run_in_executor(None, self._call_end)
+                break
+            if not await loop.run_in_executor(None, self._handle_call_data, response):
+                break
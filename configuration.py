@@ -3,9 +3,9 @@ from enum import Enum, auto
 import os
 from typing import Tuple
 
-from discovery_server import register, RegisterFailed
+from discovery_server import register, RegisterFailed, DiscoveryUnavailable
 from logger import get_logger
-from user import CurrentUser
+from user import CurrentUser, SUPPORTED_PROTOCOLS
 
 
 class ConfigurationStatus(Enum):
@@ -17,6 +17,8 @@ class ConfigurationStatus(Enum):
     WRONG_FILE = auto()
     # No configuration file was found
     NO_FILE = auto()
+    # The discovery server could not be reached to check the user information
+    SERVER_UNAVAILABLE = auto()
 
 
 class Configuration:
@@ -39,13 +41,16 @@ class Configuration:
                 private_ip = self.config["Configuration"]["private_ip"] == "True"
                 get_logger().debug("Configuration file read")
 
-                CurrentUser(nickname, "V0#V1", tcp_port, password, udp_port=udp_port, private_ip=private_ip)
+                CurrentUser(nickname, SUPPORTED_PROTOCOLS, tcp_port, password, udp_port=udp_port, private_ip=private_ip)
                 # Check if the password is correct
                 try:
                     register()
                     self.status = ConfigurationStatus.LOADED
                 except RegisterFailed:
                     self.status = ConfigurationStatus.WRONG_PASSWORD
+                except DiscoveryUnavailable as e:
+                    get_logger().warning(f"Couldn't sign in as {nickname}: {e}")
+                    self.status = ConfigurationStatus.SERVER_UNAVAILABLE
 
             except KeyError as e:
                 # File is corrupted or has been tampered
@@ -69,7 +74,7 @@ class Configuration:
         to a file called Configuration.CONFIGURATION_FILENAME
         :return: a pair of strings (title - message) so an information box can be displayed in the GUI
         """
-        CurrentUser(nickname, "V0#V1", tcp_port, password, udp_port, private_ip=private_ip)
+        CurrentUser(nickname, SUPPORTED_PROTOCOLS, tcp_port, password, udp_port, private_ip=private_ip)
         # Check if the password is correct
         try:
             register()
@@ -77,6 +82,10 @@ class Configuration:
             get_logger().warning(f"Couldn't sign in as {nickname}. The password is probably not correct")
             self.status = ConfigurationStatus.WRONG_PASSWORD
             return "Wrong Password", f"The provided password for {nickname} was not correct"
+        except DiscoveryUnavailable as e:
+            get_logger().warning(f"Couldn't sign in as {nickname}: {e}")
+            self.status = ConfigurationStatus.SERVER_UNAVAILABLE
+            return "Server Unavailable", f"{e}. Please try again later"
 
         self.status = ConfigurationStatus.LOADED
         if persistent:
@@ -1,7 +1,11 @@
 import signal
+from functools import wraps
 from threading import Thread
 from timeit import default_timer
 
+from instrumentation import counter, get_instrumentation, timed
+from logger import get_logger
+
 
 def timeout(milliseconds: int):
     """
@@ -35,17 +39,10 @@ def timeout(milliseconds: int):
 def timer(function):
     """
     :param function: function to be decorated
-    :return: a function that will run the original function printing the time taken to run it (in milliseconds)
+    :return: a function that will run the original function recording the time taken to run it in the timer of the
+    instrumentation named after the function
     """
-    def _timeit(*args, **kwargs):
-        start = default_timer()
-        return_value = function(*args, **kwargs)
-        end = default_timer()
-        time_elapsed = (end - start) * 1000
-        print(f"Function {function.__name__} took {time_elapsed} ms")
-        return return_value
-
-    return _timeit
+    return timed(function.__qualname__)(function)
 
 
 def run_in_thread(function):
@@ -63,17 +60,27 @@ def run_in_thread(function):
 def notify_timeout(milliseconds: int):
     """
     :param milliseconds: maximum number of milliseconds the function should take
-    :return: a decorator whose effect is to inform if the execution time of the function passed to it reached the limit
-    of milliseconds milliseconds.
+    :return: a decorator whose effect is to time the function passed to it (as timer does) and count the executions
+    that reached the limit of milliseconds milliseconds in the counter "<function name>.timeouts"
     """
     def _timeout(function):
+        name = function.__qualname__
+        function_timer = timed(name)
+        timeouts = counter(f"{name}.timeouts")
+
+        @wraps(function)
         def wrapper(*args, **kwargs):
+            if not get_instrumentation().enabled:
+                return function(*args, **kwargs)
             start = default_timer()
-            function(*args, **kwargs)
-            end = default_timer()
-            time_elapsed = (end - start) * 1000
-            if time_elapsed >= milliseconds:
-                print(f"[WARNING] {function.__name__} took {time_elapsed} ms")
+            try:
+                return function(*args, **kwargs)
+            finally:
+                time_elapsed = (default_timer() - start) * 1000
+                function_timer.record(time_elapsed)
+                if time_elapsed >= milliseconds:
+                    timeouts.increment()
+                    get_logger().debug(f"{name} took {time_elapsed} ms")
 
         return wrapper
 
@@ -1,5 +1,10 @@
+import json
+import os
 import socket
-from typing import List
+from threading import Event, Lock, Thread
+from time import sleep, time
+from timeit import default_timer
+from typing import Callable, Dict, List, Optional, Tuple
 
 from logger import get_logger
 from user import User, CurrentUser
@@ -24,41 +29,181 @@ class BadUser(Exception):
         super().__init__(f"Couldn't parse {nick} information")
 
 
-def _send(message: bytes, end_char: chr = None) -> str:
+class DiscoveryUnavailable(ConnectionError):
+    def __init__(self, reason: str):
+        super().__init__(f"The discovery server is not available: {reason}")
+
+
+class DiscoveryClient:
     """
-    Sends a message to the Discovery Server
-    :param message: message encoded in bytes to be sent
-    :return: response of the server
+    Client of the discovery server that keeps its connection open between requests, so they don't pay a TCP handshake
+    (and a DNS lookup) each. Responses are read with blocking receives bounded by TIMEOUT. If a request fails, the
+    connection is opened again and the request is retried (unless it's not idempotent and it had already been sent),
+    waiting longer (exponential backoff) after every failure. Requests that are not idempotent are always sent on a new
+    connection, since the server may have closed the open one without us noticing
     """
-    return_string = ""
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as connection:
-        connection.connect((socket.gethostbyname(server_hostname), server_port))
-        connection.send(message)
-        get_logger().debug(f"Sent {message} to discovery server")
-        response = connection.recv(BUFFER_SIZE)
-        return_string += response.decode()
-        if end_char:
-            connection.setblocking(False)
-            while chr(response[-1]) != end_char:
+    # Seconds to wait for the connection to be established, or for (a part of) a response
+    TIMEOUT = 5
+    # Seconds the address the hostname resolves to is cached for
+    DNS_TTL = 300
+    # A request is retried this many times before giving up. The first retry of a request sent through a connection
+    # that was already open is not delayed, since the server may have just closed the idle connection
+    MAX_RETRIES = 3
+    INITIAL_BACKOFF = 0.5
+    MAX_BACKOFF = 8
+
+    def __init__(self, hostname: str, port: int):
+        """
+        Constructor. Nothing is resolved or connected until the first request
+        :param hostname: hostname of the discovery server
+        :param port: port of the discovery server
+        """
+        self.hostname = hostname
+        self.port = port
+        # Requests are sent one at a time, since they share the connection
+        self.__mutex = Lock()
+        self.__connection: Optional[socket.socket] = None
+        self.__address: Optional[str] = None
+        self.__resolved_at = 0
+
+    def __resolve(self) -> str:
+        """
+        Must be called with the mutex held
+        :return: the IP address of the server, which is only resolved again once the cached one has expired
+        """
+        now = default_timer()
+        if self.__address is None or now - self.__resolved_at > DiscoveryClient.DNS_TTL:
+            self.__address = socket.gethostbyname(self.hostname)
+            self.__resolved_at = now
+            get_logger().debug(f"Discovery server {self.hostname} resolved to {self.__address}")
+        return self.__address
+
+    def __connect(self) -> socket.socket:
+        """
+        Must be called with the mutex held
+        :return: the connection to the server, which is opened if there is none
+        """
+        if self.__connection is None:
+            try:
+                self.__connection = socket.create_connection((self.__resolve(), self.port), DiscoveryClient.TIMEOUT)
+            except OSError:
+                # The server may have moved to another address
+                self.__address = None
+                raise
+            get_logger().debug(f"Connected to discovery server {self.hostname}:{self.port}")
+        return self.__connection
+
+    def __disconnect(self):
+        """
+        Closes the connection, if there is one. Must be called with the mutex held
+        """
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    def request(self, message: str, complete: Callable[[str], bool] = None, idempotent: bool = True) -> str:
+        """
+        Sends a request to the server and waits for its response. The connection is only held for one attempt at a
+        time, so other requests are not delayed while this one backs off
+        :param message: request
+        :param complete: function that tells if the response received so far is complete. If not specified, the
+                         response is whatever is received first
+        :param idempotent: if False, the request is sent on a new connection, and it is not retried once it has been
+                           sent (the server may have already handled it)
+        :return: response of the server
+        :raise DiscoveryUnavailable: if the request has failed MAX_RETRIES + 1 times, or a request that is not
+                                     idempotent has failed after being sent
+        """
+        backoff = DiscoveryClient.INITIAL_BACKOFF
+        for attempt in range(DiscoveryClient.MAX_RETRIES + 1):
+            with self.__mutex:
+                if not idempotent:
+                    self.__disconnect()
+                reused = self.__connection is not None
+                sent = False
                 try:
-                    response = connection.recv(BUFFER_SIZE)
-                    return_string += response.decode()
-                except BlockingIOError:
+                    connection = self.__connect()
+                    connection.sendall(message.encode())
+                    sent = True
+                    get_logger().debug(f"Sent {message} to discovery server")
+                    response = self.__receive(connection, complete)
+                    get_logger().debug(f"Received {response} from discovery server")
+                    return response
+                except OSError as e:
+                    self.__disconnect()
+                    error = e
+            if attempt == DiscoveryClient.MAX_RETRIES or (sent and not idempotent):
+                raise DiscoveryUnavailable(str(error)) from error
+            if reused and attempt == 0:
+                get_logger().debug(f"Connection to discovery server lost ({error}), reconnecting")
+                continue
+            get_logger().warning(f"Error contacting discovery server ({error}), retrying in {backoff} s")
+            sleep(backoff)
+            backoff = min(backoff * 2, DiscoveryClient.MAX_BACKOFF)
+
+    @staticmethod
+    def __receive(connection: socket.socket, complete: Optional[Callable[[str], bool]]) -> str:
+        """
+        :param connection: connection to the server
+        :param complete: function that tells if the response received so far is complete
+        :return: the response
+        :raise OSError: if the connection is closed or the response times out (socket.timeout)
+        """
+        response = b""
+        while True:
+            data = connection.recv(BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError("Connection closed by the discovery server")
+            response += data
+            if complete is None or complete(response.decode(errors="replace")):
+                return response.decode()
+
+    def close(self):
+        """
+        Says goodbye to the server and closes the connection (a new one is opened if another request is sent)
+        """
+        with self.__mutex:
+            if self.__connection is not None:
+                try:
+                    self.__connection.sendall("QUIT".encode())
+                except OSError:
                     pass
-        connection.send("QUIT".encode())
+                self.__disconnect()
+
 
-    get_logger().debug(f"Received {return_string} from discovery server")
-    return return_string
+_discovery_client = DiscoveryClient(server_hostname, server_port)
+
+
+def get_discovery_client() -> DiscoveryClient:
+    """
+    :return: client of the discovery server used by the program
+    """
+    return _discovery_client
+
+
+def _users_list_complete(response: str) -> bool:
+    """
+    :param response: response to LIST_USERS received so far, which looks like OK USERS_LIST N_USERS user1#user2#...
+    :return: True once every user has been received
+    """
+    fields = response.split(maxsplit=3)
+    if fields and fields[0] != "OK":
+        return True
+    if len(fields) < 3 or not fields[2].isdigit():
+        return False
+    return response.count("#") >= int(fields[2])
 
 
 def register():
     """
     Registers the current user in the system with the specified parameters
     :raise RegisterFailed
+    :raise DiscoveryUnavailable: if the server can't be reached
     """
     user = CurrentUser()
     string_to_send = f"REGISTER {user.nick} {user.ip} {user.tcp_port} {user.password} {'#'.join(user.protocols)}"
-    response = _send(string_to_send.encode()).split()
+    # REGISTER changes the state of the server, so it is not retried once it has been sent
+    response = _discovery_client.request(string_to_send, idempotent=False).split()
     if response[0] == "NOK":
         get_logger().warning(f"Error registering user {user.nick}: {response}")
         raise RegisterFailed
@@ -71,9 +216,10 @@ def get_user(nick: str) -> User:
     :param nick
     :return: User
     :raise UserUnknown if user is not found
+    :raise DiscoveryUnavailable: if the server can't be reached
     """
     string_to_send = f"QUERY {nick}"
-    response = _send(string_to_send.encode()).split()
+    response = _discovery_client.request(string_to_send).split()
     if response[0] == "NOK":
         get_logger().warning(f"Error getting username: {response}")
         raise UserUnknown(nick)
@@ -91,12 +237,13 @@ def list_users() -> List[User]:
     """
     Gets a list of all the users
     :return: list of users.
+    :raise DiscoveryUnavailable: if the server can't be reached
     """
     """Response contains something like OK USERS_LIST N_USERS user1#... So to get the actual list of users, 
         we look for N_USERS and start splitting the list from there. Afterwards, we get a list with all the info
         of each user in a string (users_str), so we need to split again each user to get a list of the needed values"""
 
-    response = _send("LIST_USERS".encode(), end_char='#')
+    response = _discovery_client.request("LIST_USERS", complete=_users_list_complete)
     n_users = response.split()[2]
     start_index = response.find(n_users) + len(n_users) + 1  # The number itself and the white space
     users_str = response[start_index:].split('#')[:-1]  # Avoid final empty element
@@ -113,3 +260,155 @@ def list_users() -> List[User]:
 
     get_logger().info(f"Successfully parsed {len(users)} users out of {n_users}")
     return users
+
+
+class UserDirectory:
+    """
+    Cache of the users registered in the discovery server. The list of users is refreshed on a background thread every
+    REFRESH_INTERVAL seconds, and saved to a snapshot on disk so the next start has the last known list at once.
+    Listeners are notified every time a refresh changes the list. Users fetched with get_user are cached for USER_TTL
+    seconds each (LIST_USERS does not tell the protocols of the users, so the listed ones can't be used to call them)
+    """
+    USER_TTL = 60
+    REFRESH_INTERVAL = 300
+    SNAPSHOT_FILENAME = "users.json"
+
+    def __init__(self, snapshot_path: str = SNAPSHOT_FILENAME):
+        """
+        Constructor. The directory starts empty, until the snapshot is loaded or the list is refreshed
+        :param snapshot_path: path of the snapshot of the list of users
+        """
+        self.snapshot_path = snapshot_path
+        self.__mutex = Lock()
+        # Users fetched with get_user, and the moment they were fetched
+        self.__users: Dict[str, Tuple[User, float]] = {}
+        # Users of the last list (nick, IP, TCP port), by nick
+        self.__listed: Dict[str, Tuple[str, str, int]] = {}
+        self.__listeners: List[Callable[[List[str]], None]] = []
+        self.__stopped = Event()
+        self.__thread: Optional[Thread] = None
+
+    def nicks(self) -> List[str]:
+        """
+        :return: the nicknames of the users of the last list, sorted
+        """
+        with self.__mutex:
+            return sorted(self.__listed)
+
+    def get_user(self, nick: str) -> User:
+        """
+        Gets the IP, port and protocols of the user with the specified nickname, from the cache if it was fetched less
+        than USER_TTL seconds ago
+        :param nick
+        :return: User (a new instance every time, so it can be modified)
+        :raise UserUnknown if user is not found
+        :raise DiscoveryUnavailable: if the server can't be reached
+        """
+        with self.__mutex:
+            cached = self.__users.get(nick)
+        if cached is None or default_timer() - cached[1] > UserDirectory.USER_TTL:
+            cached = get_user(nick), default_timer()
+            with self.__mutex:
+                self.__users[nick] = cached
+        else:
+            get_logger().debug(f"User {nick} found in the directory cache")
+        user = cached[0]
+        return User(user.nick, protocols="#".join(user.protocols), tcp_port=user.tcp_port, ip=user.ip)
+
+    def invalidate(self, nick: str):
+        """
+        Removes a user from the cache (e.g. because it could not be reached at the cached address), so it is fetched
+        again the next time
+        :param nick
+        """
+        with self.__mutex:
+            self.__users.pop(nick, None)
+
+    def add_listener(self, listener: Callable[[List[str]], None]):
+        """
+        :param listener: function called with the sorted nicknames every time a refresh changes the list. It's called
+                         from the refreshing thread
+        """
+        with self.__mutex:
+            self.__listeners.append(listener)
+
+    def load_snapshot(self) -> bool:
+        """
+        Loads the list of users saved by the last refresh (of this or a previous run)
+        :return: True if the snapshot could be loaded
+        """
+        try:
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+            listed = {nick: (nick, ip, int(tcp_port)) for nick, ip, tcp_port in snapshot["users"]}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            get_logger().debug(f"Couldn't load the snapshot of the user directory: {e}")
+            return False
+        with self.__mutex:
+            self.__listed = listed
+        get_logger().info(f"Loaded {len(listed)} users from {self.snapshot_path}")
+        return True
+
+    def save_snapshot(self):
+        """
+        Saves the list of users. The file is replaced atomically, so a snapshot being written is never loaded
+        """
+        with self.__mutex:
+            users = list(self.__listed.values())
+        temporary_path = f"{self.snapshot_path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"time": round(time()), "users": users}, file, separators=(",", ":"))
+        os.replace(temporary_path, self.snapshot_path)
+
+    def refresh(self) -> bool:
+        """
+        Fetches the list of users, saves it to the snapshot and notifies the listeners if it has changed
+        :return: True if the list could be fetched
+        """
+        try:
+            listed = {user.nick: (user.nick, user.ip, user.tcp_port) for user in list_users()}
+        except (DiscoveryUnavailable, IndexError) as e:
+            get_logger().warning(f"Couldn't refresh the user directory: {e}")
+            return False
+        with self.__mutex:
+            changed = listed != self.__listed
+            self.__listed = listed
+            listeners = list(self.__listeners)
+        if changed:
+            try:
+                self.save_snapshot()
+            except OSError as e:
+                get_logger().warning(f"Couldn't save the snapshot of the user directory: {e}")
+            nicks = sorted(listed)
+            for listener in listeners:
+                listener(nicks)
+        return True
+
+    def start(self):
+        """
+        Starts refreshing the list on a background thread: once right away, and then every REFRESH_INTERVAL seconds
+        """
+        if self.__thread is None:
+            self.__thread = Thread(target=self.__refresh_periodically, daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        """
+        Stops refreshing the list
+        """
+        self.__stopped.set()
+
+    def __refresh_periodically(self):
+        self.refresh()
+        while not self.__stopped.wait(UserDirectory.REFRESH_INTERVAL):
+            self.refresh()
+
+
+_user_directory = UserDirectory()
+
+
+def get_user_directory() -> UserDirectory:
+    """
+    :return: user directory used by the program
+    """
+    return _user_directory
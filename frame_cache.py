@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Hashable, TypeVar, Union
+
+import numpy as np
+
+from logger import get_logger
+
+CachedFrame = TypeVar("CachedFrame", np.ndarray, bytes)
+
+
+class FrameCache:
+    """
+    LRU cache of resized and compressed frames. Entries are keyed by the content they were built from (a key that
+    identifies the source frame, such as the static image or a frame of a video file) plus the resolution and JPEG
+    quality they were built with, so a source frame that doesn't change is only resized and compressed once per quality
+    rung. The total size of the entries is bounded, and the least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Constructor
+        :param max_bytes: maximum number of bytes that the cached frames may take up
+        """
+        self.__max_bytes = max_bytes
+        self.__mutex = Lock()
+        self.__entries: "OrderedDict[Hashable, CachedFrame]" = OrderedDict()
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def __size_of(value: Union[np.ndarray, bytes]) -> int:
+        return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+    def get(self, key: Hashable, producer: Callable[[], CachedFrame]) -> CachedFrame:
+        """
+        Returns the frame cached under key, building (and caching) it if it's not cached. The producer is called without
+        holding the lock, so two threads missing the same key at the same time may both build it
+        :param key: key that identifies the content of the frame, its resolution and its quality
+        :param producer: function that builds the frame. If it returns None, nothing is cached
+        :return: the cached frame. Cached arrays are shared, so they must not be modified
+        """
+        with self.__mutex:
+            value = self.__entries.get(key)
+            if value is not None:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = producer()
+        if value is None:
+            return value
+        size = FrameCache.__size_of(value)
+        if size > self.__max_bytes:
+            return value
+
+        with self.__mutex:
+            if key not in self.__entries:
+                self.__entries[key] = value
+                self.__size += size
+                while self.__size > self.__max_bytes:
+                    _, evicted = self.__entries.popitem(last=False)
+                    self.__size -= FrameCache.__size_of(evicted)
+        return value
+
+    def clear(self):
+        """
+        Removes every cached frame (e.g. when the source they were built from changes)
+        """
+        with self.__mutex:
+            get_logger().debug(f"Frame cache cleared ({len(self.__entries)} frames, {self.__size} bytes, "
+                               f"{self.hits} hits, {self.misses} misses)")
+            self.__entries.clear()
+            self.__size = 0
@@ -0,0 +1,38 @@
+from threading import Lock
+from typing import Optional
+
+import numpy as np
+
+
+class FrameMailbox:
+    """
+    Hands the latest frame over from the capturing thread to the visualization one. The mailbox only keeps the newest
+    frame, so if the visualization thread falls behind the older frames are dropped (and counted) instead of piling up.
+    Frames are handed over by reference, so a frame must not be modified after putting it
+    """
+
+    def __init__(self):
+        """
+        Constructor. The mailbox starts empty
+        """
+        self.__mutex = Lock()
+        self.__frame: Optional[np.ndarray] = None
+        self.dropped = 0
+
+    def put(self, frame: np.ndarray):
+        """
+        Leaves a frame in the mailbox, dropping the previous one if it has not been taken
+        :param frame: the frame
+        """
+        with self.__mutex:
+            if self.__frame is not None:
+                self.dropped += 1
+            self.__frame = frame
+
+    def take(self) -> Optional[np.ndarray]:
+        """
+        :return: the newest frame, or None if no frame has been put since the last take
+        """
+        with self.__mutex:
+            frame, self.__frame = self.__frame, None
+            return frame
@@ -0,0 +1,244 @@
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from threading import Event
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from logger import get_logger
+
+# Resolution and JPEG quality of the frames of a store file, as (width, height, jpeg_quality)
+StoreFormat = Tuple[int, int, int]
+
+
+class StoredFrame(NamedTuple):
+    store: "FrameStore"
+    index: int
+
+
+class _StoreFile:
+    """
+    A file with every frame of a video compressed as JPEG with the same resolution and quality, mapped in memory. The
+    file is made up of the frames one after the other, followed by the index (the offset of every frame, plus the end
+    of the last one) and by the footer (see FOOTER)
+    """
+    MAGIC = b"SFS1"
+    # Magic, number of frames and fps. The index and the footer use the byte order of the machine that wrote them, as
+    # the store is a local cache
+    FOOTER = struct.Struct("=4sQd")
+
+    def __init__(self, path: str):
+        """
+        Maps a store file in memory
+        :param path: path of the store file
+        :raise ValueError: if the file isn't a valid store file
+        """
+        with open(path, "rb") as file:
+            self.__mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.__mapping)
+        if len(view) < _StoreFile.FOOTER.size:
+            raise ValueError(f"{path} is too short to be a frame store")
+        magic, self.frame_count, self.fps = _StoreFile.FOOTER.unpack(view[-_StoreFile.FOOTER.size:])
+        index_size = (self.frame_count + 1) * array("Q").itemsize
+        if magic != _StoreFile.MAGIC or self.frame_count == 0 or index_size + _StoreFile.FOOTER.size > len(view):
+            raise ValueError(f"{path} is not a valid frame store")
+        index_start = len(view) - _StoreFile.FOOTER.size - index_size
+        self.__offsets = view[index_start:index_start + index_size].cast("Q")
+        self.__view = view
+
+    def frame(self, index: int) -> memoryview:
+        """
+        :param index: index of the frame, from 0 to frame_count - 1
+        :return: the compressed frame, without copying it from the mapping
+        """
+        return self.__view[self.__offsets[index]:self.__offsets[index + 1]]
+
+
+class _StoreFileWriter:
+    """
+    Writes a store file (see _StoreFile) frame by frame. It's written to a temporary file first, so a store file is
+    either complete or missing
+    """
+
+    def __init__(self, path: str):
+        """
+        Constructor
+        :param path: path of the store file
+        """
+        self.__path = path
+        self.__file = open(path + ".tmp", "wb")
+        self.__offsets = array("Q", [0])
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def append(self, frame: Union[bytes, np.ndarray]):
+        """
+        :param frame: next compressed frame
+        """
+        frame = memoryview(frame)
+        self.__file.write(frame)
+        self.__offsets.append(self.__offsets[-1] + frame.nbytes)
+
+    def commit(self, fps: float):
+        """
+        Writes the index and the footer, and moves the file to its final path
+        :param fps: frames per second of the video
+        """
+        self.__offsets.tofile(self.__file)
+        self.__file.write(_StoreFile.FOOTER.pack(_StoreFile.MAGIC, len(self), fps))
+        self.__file.close()
+        os.replace(self.__path + ".tmp", self.__path)
+
+    def abort(self):
+        """
+        Removes the temporary file
+        """
+        self.__file.close()
+        try:
+            os.remove(self.__path + ".tmp")
+        except OSError:
+            pass
+
+
+class FrameStore:
+    """
+    Frames of a video file compressed once at every resolution and JPEG quality needed, so the video can be played in a
+    loop with no decoding nor encoding. Every format is stored in its own file (see _StoreFile), mapped in memory at
+    playback, and the frames are sent straight from the mapping
+    """
+    DIRECTORY = "frame_store"
+
+    def __init__(self, files: Dict[StoreFormat, _StoreFile]):
+        """
+        Constructor. Use FrameStore.open or FrameStore.transcode instead
+        :param files: store file of every format
+        """
+        self.__files = files
+        # Every file has the same frames, the preview is taken from the largest and best one
+        self.__preview = files[max(files, key=lambda store_format: (store_format[0] * store_format[1], store_format[2]))]
+        self.frame_count = self.__preview.frame_count
+        self.fps = self.__preview.fps
+
+    def frame(self, index: int, width: int, height: int, jpeg_quality: int) -> Optional[memoryview]:
+        """
+        :param index: index of the frame, from 0 to frame_count - 1
+        :param width: width of the frame
+        :param height: height of the frame
+        :param jpeg_quality: JPEG quality of the frame
+        :return: the compressed frame, or None if the store doesn't have that format
+        """
+        store_file = self.__files.get((width, height, jpeg_quality))
+        return store_file.frame(index) if store_file is not None else None
+
+    def preview(self, index: int) -> np.ndarray:
+        """
+        :param index: index of the frame, from 0 to frame_count - 1
+        :return: the frame decoded, so it can be shown locally
+        """
+        return cv2.imdecode(np.frombuffer(self.__preview.frame(index), np.uint8), cv2.IMREAD_COLOR)
+
+    @staticmethod
+    def __path(video_path: str, store_format: StoreFormat, directory: str) -> str:
+        """
+        :return: path of the store file of a video with a format. The name depends on the size and modification time of
+                 the video, so a video that has changed is transcoded again
+        """
+        status = os.stat(video_path)
+        key = f"{os.path.abspath(video_path)}#{status.st_size}#{status.st_mtime_ns}".encode()
+        width, height, jpeg_quality = store_format
+        return os.path.join(directory, f"{hashlib.sha1(key).hexdigest()[:16]}_{width}x{height}_q{jpeg_quality}.frames")
+
+    @staticmethod
+    def open(video_path: str, store_formats: Iterable[StoreFormat], directory: str = DIRECTORY) \
+            -> Optional["FrameStore"]:
+        """
+        Opens the store of a video that has already been transcoded
+        :param video_path: path of the video file
+        :param store_formats: formats the store must have
+        :param directory: directory where the stores are kept
+        :return: the store, or None if it has not been transcoded (or is not valid)
+        """
+        try:
+            files = {store_format: _StoreFile(FrameStore.__path(video_path, store_format, directory))
+                     for store_format in set(store_formats)}
+        except (OSError, ValueError):
+            return None
+        if not files or len({store_file.frame_count for store_file in files.values()}) != 1:
+            return None
+        return FrameStore(files)
+
+    @staticmethod
+    def __compress_frames(video_path: str, capture: cv2.VideoCapture, writers: Dict[StoreFormat, _StoreFileWriter],
+                          cancelled: Optional[Event]) -> bool:
+        """
+        Compresses every frame of a video in every format
+        :return: true if every frame was compressed, false if transcoding was cancelled or failed
+        """
+        while cancelled is None or not cancelled.is_set():
+            success, frame = capture.read()
+            if not success:
+                if not any(len(writer) for writer in writers.values()):
+                    get_logger().warning(f"{video_path} has no frames to transcode")
+                    return False
+                return True
+            resized = {}
+            for (width, height, jpeg_quality), writer in writers.items():
+                if (width, height) not in resized:
+                    resized[(width, height)] = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                success, compressed_frame = cv2.imencode(".jpg", resized[(width, height)],
+                                                         [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+                if not success:
+                    get_logger().error(f"Error compressing a frame of {video_path}")
+                    return False
+                writer.append(compressed_frame)
+        get_logger().debug(f"Transcoding of {video_path} cancelled")
+        return False
+
+    @staticmethod
+    def transcode(video_path: str, store_formats: Iterable[StoreFormat], directory: str = DIRECTORY,
+                  cancelled: Event = None) -> Optional["FrameStore"]:
+        """
+        Decodes a video file once and compresses every frame in every format. It takes a while, so it's meant to be run
+        on a separate thread
+        :param video_path: path of the video file
+        :param store_formats: formats the store must have
+        :param directory: directory where the stores are kept
+        :param cancelled: if it is set, transcoding stops
+        :return: the store, or None if the video could not be transcoded (or transcoding was cancelled)
+        """
+        store_formats = sorted(set(store_formats))
+        if not store_formats:
+            return None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            writers = {store_format: _StoreFileWriter(FrameStore.__path(video_path, store_format, directory))
+                       for store_format in store_formats}
+        except OSError as e:
+            get_logger().error(f"Could not create the frame store of {video_path}: {e}")
+            return None
+
+        capture = cv2.VideoCapture(video_path)
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        try:
+            completed = FrameStore.__compress_frames(video_path, capture, writers, cancelled)
+            if completed:
+                for writer in writers.values():
+                    writer.commit(fps)
+        except OSError as e:
+            get_logger().error(f"Could not write the frame store of {video_path}: {e}")
+            completed = False
+        finally:
+            capture.release()
+        if not completed:
+            for writer in writers.values():
+                writer.abort()
+            return None
+
+        get_logger().info(f"{video_path} transcoded to {len(store_formats)} formats "
+                          f"({len(writers[store_formats[0]])} frames)")
+        return FrameStore.open(video_path, store_formats, directory)
@@ -0,0 +1,126 @@
+from threading import Lock
+from timeit import default_timer
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageTk
+from appJar import gui
+
+
+class GuiUpdaterStatistics(NamedTuple):
+    frames_submitted: int
+    frames_displayed: int
+    frames_coalesced: int  # Frames replaced by a newer one before being displayed
+    status_submitted: int
+    status_displayed: int
+    status_dropped: int  # Status texts replaced by a newer one before being displayed, or equal to the one displayed
+
+
+class GuiUpdater:
+    """
+    Marshals the updates of the video widget, the status bar and the auto entries from worker threads to the GUI thread.
+    Workers only leave the latest frame, status texts and words here, and the GUI thread applies them every
+    REFRESH_INTERVAL milliseconds, so at most one image update is made per refresh and the status bar is updated at most
+    every STATUS_INTERVAL seconds
+    """
+    REFRESH_INTERVAL = 15
+    STATUS_INTERVAL = 0.25
+
+    def __init__(self, app: gui, image: ImageTk.PhotoImage, width: int, height: int):
+        """
+        Constructor. The updates start being applied once the GUI runs
+        :param app: the GUI
+        :param image: image of the video widget, which is updated in place
+        :param width: width of the frames displayed
+        :param height: height of the frames displayed
+        """
+        self.__gui = app
+        self.__image = image
+        self.__mutex = Lock()
+        self.__frame = np.empty((height, width, 3), np.uint8)
+        self.__frame_pending = False
+        self.__status: Dict[int, str] = {}
+        self.__auto_entry: Optional[Tuple[str, List[str]]] = None
+        # Only accessed from the GUI thread
+        self.__displayed_status: Dict[int, str] = {}
+        self.__last_status_update = 0
+
+        self.__frames_submitted = 0
+        self.__frames_displayed = 0
+        self.__frames_coalesced = 0
+        self.__status_submitted = 0
+        self.__status_displayed = 0
+        self.__status_dropped = 0
+
+        self.__gui.setPollTime(GuiUpdater.REFRESH_INTERVAL)
+        self.__gui.registerEvent(self.__apply)
+
+    def update_frame(self, frame: np.ndarray):
+        """
+        Sets the frame that will be displayed on the next refresh. The frame is copied, so the caller may reuse it
+        :param frame: RGB frame with the size of the video widget
+        """
+        with self.__mutex:
+            self.__frames_submitted += 1
+            if self.__frame_pending:
+                self.__frames_coalesced += 1
+            np.copyto(self.__frame, frame)
+            self.__frame_pending = True
+
+    def update_status(self, text: str, field: int):
+        """
+        Sets the text that a field of the status bar will show on the next status update
+        :param text: the text
+        :param field: index of the field
+        """
+        with self.__mutex:
+            self.__status_submitted += 1
+            if field in self.__status:
+                self.__status_dropped += 1
+            self.__status[field] = text
+
+    def update_auto_entry(self, title: str, words: List[str]):
+        """
+        Sets the words an auto entry will suggest after the next refresh
+        :param title: title of the auto entry
+        :param words: the words
+        """
+        with self.__mutex:
+            self.__auto_entry = title, words
+
+    def get_statistics(self) -> GuiUpdaterStatistics:
+        """
+        :return: statistics of the updates submitted and applied
+        """
+        with self.__mutex:
+            return GuiUpdaterStatistics(self.__frames_submitted, self.__frames_displayed, self.__frames_coalesced,
+                                        self.__status_submitted, self.__status_displayed, self.__status_dropped)
+
+    def __apply(self):
+        """
+        Applies the pending updates. Called from the GUI thread every REFRESH_INTERVAL milliseconds
+        """
+        with self.__mutex:
+            if self.__frame_pending:
+                self.__image.paste(Image.fromarray(self.__frame))
+                self.__frame_pending = False
+                self.__frames_displayed += 1
+            if self.__auto_entry is not None:
+                self.__gui.changeAutoEntry(*self.__auto_entry)
+                self.__auto_entry = None
+
+            now = default_timer()
+            if not self.__status or now - self.__last_status_update < GuiUpdater.STATUS_INTERVAL:
+                return
+            self.__last_status_update = now
+            status, self.__status = self.__status, {}
+
+        for field, text in status.items():
+            if self.__displayed_status.get(field) == text:
+                with self.__mutex:
+                    self.__status_dropped += 1
+                continue
+            self.__displayed_status[field] = text
+            self.__gui.setStatusbar(text, field)
+            with self.__mutex:
+                self.__status_displayed += 1
@@ -0,0 +1,253 @@
+import argparse
+import json
+import signal
+import sys
+import threading
+from os import _exit
+from threading import Event
+from time import time
+from timeit import default_timer
+from typing import Optional, TextIO
+
+import cv2
+import numpy as np
+
+from configuration import ConfigurationStatus
+from instrumentation import get_instrumentation, install_dump_signal
+from logger import get_logger, set_logger
+from media_pipeline import MediaPipeline, ReceiveMode, NetworkMode
+from metrics import MetricsExporter, get_metrics
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the memory used is not reported
+    resource = None
+
+
+class AcceptPolicy:
+    """
+    Decides which incoming calls a headless client accepts: all of them ("all"), none of them ("none") or only the
+    ones from some users (their nicknames separated by commas)
+    """
+
+    def __init__(self, policy: str):
+        """
+        Constructor
+        :param policy: "all", "none" or a list of nicknames separated by commas
+        """
+        self.accept_all = policy == "all"
+        self.nicknames = set() if policy in ("all", "none") else {nick.strip() for nick in policy.split(",")}
+
+    def accepts(self, nickname: str) -> bool:
+        """
+        :param nickname: nickname of the user calling
+        :return: true if the call should be accepted
+        """
+        return self.accept_all or nickname in self.nicknames
+
+
+class HeadlessClient(MediaPipeline):
+    """
+    The media pipeline without a GUI. Remote frames are decoded (but not shown), incoming calls are answered according
+    to an AcceptPolicy, and the statistics of the pipeline are written periodically as JSON lines
+    """
+    STATS_INTERVAL = 1
+
+    def __init__(self, accept_policy: AcceptPolicy, stats_output: TextIO,
+                 receive_mode: ReceiveMode = ReceiveMode.ZERO_COPY, receive_buffer_size: int = None,
+                 network_mode: NetworkMode = NetworkMode.THREADS):
+        """
+        Constructor. The webcam is never opened: the client starts in CaptureMode.NO_CAMERA
+        :param accept_policy: which incoming calls are accepted
+        :param stats_output: where the statistics are written
+        :param receive_mode: see MediaPipeline
+        :param receive_buffer_size: see MediaPipeline
+        :param network_mode: see MediaPipeline
+        """
+        super().__init__(receive_mode, receive_buffer_size, network_mode, open_camera=False)
+        self.accept_policy = accept_policy
+        self.stats_output = stats_output
+        self.stopped = Event()
+        self.started = default_timer()
+        self.local_frames = 0
+        self.decode_errors = 0
+        self.calls = 0
+
+    def display_video(self):
+        """
+        Takes the local frames and decodes the remote ones as they are played out, without showing them. It also checks
+        if the buffer quality is bad in order to take measures. This function is meant to be run on a separate thread
+        """
+        # Do first acquire so next one is blocking
+        self.video_semaphore.acquire()
+        while True:
+            self.video_semaphore.acquire()
+            with MediaPipeline.DISPLAY_TIMER:
+                if self.camera_buffer.take() is not None:
+                    self.local_frames += 1
+                remote_frame = self.udp_buffer.consume()
+                self.check_congestion(self.udp_buffer.get_statistics())
+                if remote_frame:
+                    start = default_timer()
+                    if cv2.imdecode(np.frombuffer(remote_frame, np.uint8), cv2.IMREAD_COLOR) is None:
+                        self.decode_errors += 1
+                    else:
+                        get_metrics().observe("decode", (default_timer() - start) * 1000)
+                        self.frames_decoded += 1
+
+    def incoming_call(self, nickname: str, ip: str) -> bool:
+        """
+        This function will be called when there's an incoming call
+        :param nickname: nickname of the user
+        :param ip: the actual IP address of the user
+        :return: true if the accept policy accepts the call
+        """
+        accept = self.accept_policy.accepts(nickname)
+        get_logger().info(f"Call from {nickname} ({ip}) {'accepted' if accept else 'denied'}")
+        return accept
+
+    def display_in_call(self, nickname: str):
+        """
+        This function will be called when a call is established
+        :param nickname: nickname of the user whom the are talking to
+        """
+        self.calls += 1
+        get_logger().info(f"In a call with {nickname}")
+
+    def get_statistics(self) -> dict:
+        """
+        :return: a snapshot of the statistics of the whole pipeline
+        """
+        buffer_statistics = self.udp_buffer.get_statistics()
+        rung = self.quality_ladder.current()
+        latency = self.latency_estimate()
+        statistics = {
+            "time": round(time(), ndigits=3),
+            "uptime": round(default_timer() - self.started, ndigits=3),
+            "in_call": self.call_control.in_call(),
+            "calls": self.calls,
+            "capture_mode": self.capture_mode.name,
+            "sending": rung.name,
+            "frames_sent": self.call_control.sequence_number,
+            "local_frames": self.local_frames,
+            "local_frames_dropped": self.camera_buffer.dropped,
+            "remote_frames": self.frames_decoded,
+            "remote_report": None if self.remote_report is None else self.remote_report._asdict(),
+            "decode_errors": self.decode_errors,
+            "buffer": {**buffer_statistics._asdict(), "quality": buffer_statistics.quality.name},
+            "latency": None if latency is None else latency._asdict(),
+            "playout_clock": self.playout_clock.get_statistics()._asdict(),
+            "capture_pacer": self.capture_pacer.get_statistics()._asdict(),
+            "frame_cache": {"hits": self.frame_cache.hits, "misses": self.frame_cache.misses},
+            "threads": threading.active_count(),
+        }
+        if resource is not None:
+            # Maximum resident set size, in kilobytes on Linux (bytes on macOS)
+            statistics["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return statistics
+
+    def run(self, duration: Optional[float] = None, call: Optional[str] = None):
+        """
+        Runs the pipeline, writing the statistics every STATS_INTERVAL seconds, until stop is called or the duration
+        has elapsed
+        :param duration: seconds to run for. If not specified, it runs until stop is called
+        :param call: if specified, nickname of the user to call once the pipeline has started
+        """
+        self.start_pipeline()
+        if call is not None:
+            self.call_control.call_start(call)
+        deadline = None if duration is None else self.started + duration
+        while not self.stopped.wait(HeadlessClient.STATS_INTERVAL):
+            self.stats_output.write(json.dumps(self.get_statistics()) + "\n")
+            self.stats_output.flush()
+            if deadline is not None and default_timer() >= deadline:
+                break
+        get_logger().info(f"Closing {HeadlessClient.APP_NAME}")
+        self.stop_pipeline()
+        self.stats_output.write(json.dumps(self.get_statistics()) + "\n")
+        self.stats_output.flush()
+
+    def stop(self):
+        """
+        Makes run return
+        """
+        self.stopped.set()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Samtale (headless)')
+
+    parser.add_argument('-log_level', action='store', nargs='?', default='info',
+                        choices=['debug', 'info', 'warning', 'error'], required=False,
+                        help='Indicate logging level')
+    parser.add_argument('-receive_mode', action='store', nargs='?', default='zero_copy',
+                        choices=['copy', 'zero_copy'], required=False,
+                        help='Indicate how video datagrams are received')
+    parser.add_argument('-network_mode', action='store', nargs='?', default='threads',
+                        choices=['threads', 'asyncio'], required=False,
+                        help='Indicate whether sockets are handled by threads or by an asyncio event loop')
+    parser.add_argument('-rcvbuf', action='store', type=int, default=None, required=False,
+                        help='Indicate the size (in bytes) of the receive buffer of the video socket')
+    parser.add_argument('-metrics_port', action='store', type=int, default=None, required=False,
+                        help='Indicate the local port of an HTTP endpoint that serves the latency metrics')
+    parser.add_argument('-metrics_file', action='store', default=None, required=False,
+                        help='Indicate a JSON file where the latency metrics are written periodically')
+    parser.add_argument('-instrumentation', action='store', nargs='?', default='on', choices=['on', 'off'],
+                        required=False, help='Indicate whether the hot paths are timed (dumped to the log on SIGUSR1)')
+    parser.add_argument('-source', action='store', default='synthetic', required=False,
+                        help='Indicate the video sent: synthetic, no_camera, camera or the path of a video file')
+    parser.add_argument('-accept', action='store', default='all', required=False,
+                        help='Indicate which calls are accepted: all, none or a list of nicknames separated by commas')
+    parser.add_argument('-call', action='store', default=None, required=False,
+                        help='Indicate the nickname of a user to call at start')
+    parser.add_argument('-duration', action='store', type=float, default=None, required=False,
+                        help='Indicate the number of seconds to run for (forever by default)')
+    parser.add_argument('-stats', action='store', default='-', required=False,
+                        help='Indicate the file where statistics are written as JSON lines (- for stdout)')
+    parser.add_argument('-nickname', action='store', default=None, required=False,
+                        help='Indicate the nickname to register with, if there is no configuration.ini')
+    parser.add_argument('-password', action='store', default=None, required=False)
+    parser.add_argument('-tcp_port', action='store', type=int, default=None, required=False)
+    parser.add_argument('-udp_port', action='store', type=int, default=None, required=False)
+    parser.add_argument('-private_ip', action='store_true', required=False,
+                        help='Indicate that the user is registered with the private IP')
+    parser.add_argument('-video_port', action='store', type=int, default=None, required=False,
+                        help='Indicate the port where video is received, if it is not the registered UDP port (e.g. '
+                             'behind an impairment proxy)')
+
+    args = parser.parse_args()
+
+    set_logger(args)
+    get_instrumentation().enabled = args.instrumentation == 'on'
+    install_dump_signal()
+    stats_output = sys.stdout if args.stats == '-' else open(args.stats, "a")
+    client = HeadlessClient(AcceptPolicy(args.accept), stats_output,
+                            receive_mode=ReceiveMode[args.receive_mode.upper()], receive_buffer_size=args.rcvbuf,
+                            network_mode=NetworkMode[args.network_mode.upper()])
+    client.video_port = args.video_port
+
+    if client.configuration.status != ConfigurationStatus.LOADED:
+        if None in (args.nickname, args.password, args.tcp_port, args.udp_port):
+            get_logger().error("No configuration.ini found: -nickname, -password, -tcp_port and -udp_port are needed")
+            _exit(1)
+        title, message = client.register(args.nickname, args.password, args.tcp_port, args.udp_port,
+                                         private_ip=args.private_ip, persistent=False)
+        client.display_message(title, message)
+        if client.configuration.status != ConfigurationStatus.LOADED:
+            _exit(1)
+
+    if args.source == 'synthetic':
+        client.select_synthetic()
+    elif args.source == 'camera':
+        client.select_camera()
+    elif args.source != 'no_camera' and not client.select_video_file(args.source):
+        _exit(1)
+
+    signal.signal(signal.SIGINT, lambda signum, frame: client.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: client.stop())
+    metrics_exporter = MetricsExporter(port=args.metrics_port, path=args.metrics_file)
+    metrics_exporter.start()
+    client.run(duration=args.duration, call=args.call)
+    metrics_exporter.stop()
+    _exit(0)
@@ -0,0 +1,407 @@
+import argparse
+import bisect
+import csv
+import heapq
+import ipaddress
+import json
+import random
+import signal
+import socket
+import sys
+from threading import Condition, Event, Lock, Thread
+from time import time
+from timeit import default_timer
+from typing import Dict, List, NamedTuple, Tuple
+
+from logger import get_logger, set_logger
+from media_pipeline import MAX_DATAGRAM_SIZE
+
+
+class Impairment(NamedTuple):
+    loss: float = 0  # Probability of losing a packet
+    burst_loss: float = 0  # Probability of a burst of losses starting at a packet
+    burst_length: float = 1  # Average number of packets lost in a row by a burst
+    reorder: float = 0  # Probability of a packet being held back REORDER_DELAY ms, so the next ones overtake it
+    reorder_delay: float = 20  # ms
+    duplicate: float = 0  # Probability of a packet being delivered twice
+    delay: float = 0  # ms
+    jitter: float = 0  # Standard deviation of the delay, in ms
+    bandwidth: float = 0  # kbit/s. 0 means unlimited
+    queue: float = 500  # Packets that would wait more than this (in ms) for the bandwidth are dropped
+
+
+class ImpairmentPhase(NamedTuple):
+    start: float  # Seconds since the proxy started
+    impairment: Impairment
+
+
+class ProxyStatistics(NamedTuple):
+    received: int
+    forwarded: int  # Packets sent, duplicates included
+    lost: int  # Lost at random, in a burst or not
+    burst_lost: int
+    queue_dropped: int  # Dropped because the bandwidth could not drain them in time
+    duplicated: int
+    reordered: int
+    bytes_forwarded: int
+    queue_delay: float  # ms that the last packet waited for the bandwidth
+
+
+class ImpairmentSchedule:
+    """
+    Impairments applied over time by an ImpairmentProxy: a list of phases, each with the impairments applied from its
+    start on, and the seed of every random decision. Every packet takes the same number of random draws, so with the
+    same schedule, the n-th packet always meets the same fate (as long as it arrives on the same phase)
+    """
+
+    def __init__(self, phases: List[ImpairmentPhase], seed: int = 0):
+        """
+        Constructor
+        :param phases: phases of the schedule. Until the first one starts, its impairments are applied too
+        :param seed: seed of the random decisions
+        """
+        self.phases = sorted(phases, key=lambda phase: phase.start) or [ImpairmentPhase(0, Impairment())]
+        self.seed = seed
+        self.__starts = [phase.start for phase in self.phases]
+
+    def phase_at(self, elapsed: float) -> int:
+        """
+        :param elapsed: seconds since the proxy started
+        :return: index of the phase that applies
+        """
+        return max(bisect.bisect_right(self.__starts, elapsed) - 1, 0)
+
+    def to_json(self) -> dict:
+        """
+        :return: the schedule as a JSON object
+        """
+        return {"seed": self.seed, "phases": [{"start": phase.start, **phase.impairment._asdict()}
+                                              for phase in self.phases]}
+
+    @staticmethod
+    def from_json(schedule: dict) -> "ImpairmentSchedule":
+        """
+        :param schedule: a JSON object returned by to_json. Impairments missing from a phase are not applied
+        :return: the schedule
+        """
+        phases = []
+        for phase in schedule["phases"]:
+            phase = dict(phase)
+            start = phase.pop("start", 0)
+            phases.append(ImpairmentPhase(start, Impairment(**phase)))
+        return ImpairmentSchedule(phases, schedule.get("seed", 0))
+
+    @staticmethod
+    def load(path: str) -> "ImpairmentSchedule":
+        """
+        :param path: path of a JSON file written by save
+        :return: the schedule
+        """
+        with open(path) as file:
+            return ImpairmentSchedule.from_json(json.load(file))
+
+    def save(self, path: str):
+        """
+        Writes the schedule to a JSON file, so a run can be repeated
+        :param path: path of the file
+        """
+        with open(path, "w") as file:
+            json.dump(self.to_json(), file, indent=2)
+            file.write("\n")
+
+
+class ImpairmentProxy:
+    """
+    UDP relay that forwards the video sent to a client through a bad network: the datagrams received on the listening
+    address are lost, delayed, reordered, duplicated and rate limited according to an ImpairmentSchedule, and forwarded
+    to the address of the client. Each proxy handles one direction of a call
+    """
+    # Seconds the receiving thread waits for a datagram before checking if the proxy has been stopped
+    RECEIVE_TIMEOUT = 0.5
+
+    def __init__(self, listen_address: Tuple[str, int], forward_address: Tuple[str, int],
+                 schedule: ImpairmentSchedule):
+        """
+        Constructor. Nothing is forwarded until start is called
+        :param listen_address: address the proxy receives datagrams on (the one the sender sends the video to)
+        :param forward_address: address of the receiver
+        :param schedule: impairments applied
+        """
+        self.forward_address = forward_address
+        self.schedule = schedule
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__socket.bind(listen_address)
+        self.__socket.settimeout(ImpairmentProxy.RECEIVE_TIMEOUT)
+        self.__random = random.Random(schedule.seed)
+        self.__mutex = Lock()
+        self.__condition = Condition(self.__mutex)
+        # Datagrams waiting to be forwarded: (departure time, arrival index, data)
+        self.__pending: List[Tuple[float, int, bytes]] = []
+        self.__running = Event()
+        self.__started = 0
+        self.__index = 0
+        self.__bursting = False
+        self.__link_free = 0  # Moment the bandwidth finishes sending the packets already queued
+
+        self.__received = 0
+        self.__forwarded = 0
+        self.__lost = 0
+        self.__burst_lost = 0
+        self.__queue_dropped = 0
+        self.__duplicated = 0
+        self.__reordered = 0
+        self.__bytes_forwarded = 0
+        self.__queue_delay = 0
+
+        self.__receiving_thread = Thread(target=self.__receive, daemon=True)
+        self.__sending_thread = Thread(target=self.__send, daemon=True)
+
+    def start(self):
+        """
+        Starts forwarding. The schedule starts now
+        """
+        self.__started = default_timer()
+        self.__running.set()
+        self.__receiving_thread.start()
+        self.__sending_thread.start()
+
+    def stop(self):
+        """
+        Stops forwarding. Datagrams still pending are discarded
+        """
+        self.__running.clear()
+        with self.__condition:
+            self.__condition.notify()
+        self.__receiving_thread.join()
+        self.__sending_thread.join()
+        self.__socket.close()
+
+    def elapsed(self) -> float:
+        """
+        :return: seconds since the proxy started
+        """
+        return default_timer() - self.__started
+
+    def get_statistics(self) -> ProxyStatistics:
+        """
+        :return: statistics of the datagrams received and forwarded
+        """
+        with self.__mutex:
+            return ProxyStatistics(self.__received, self.__forwarded, self.__lost, self.__burst_lost,
+                                   self.__queue_dropped, self.__duplicated, self.__reordered, self.__bytes_forwarded,
+                                   self.__queue_delay)
+
+    def __departures(self, now: float, size: int) -> List[float]:
+        """
+        Decides the fate of a datagram. Must be called with the mutex held
+        :param now: moment the datagram was received
+        :param size: size of the datagram, in bytes
+        :return: moments the datagram must be forwarded at (none if it is lost, two if it is duplicated)
+        """
+        impairment = self.schedule.phases[self.schedule.phase_at(now - self.__started)].impairment
+        # The same draws are taken for every datagram, whatever the impairments, so decisions do not shift
+        loss_draw, burst_draw, reorder_draw, duplicate_draw = (self.__random.random() for _ in range(4))
+        jitter_draw = self.__random.gauss(0, 1)
+
+        if self.__bursting:
+            self.__bursting = burst_draw >= 1 / max(impairment.burst_length, 1)
+            self.__burst_lost += 1
+            return []
+        if burst_draw < impairment.burst_loss:
+            self.__bursting = impairment.burst_length > 1
+            self.__burst_lost += 1
+            return []
+        if loss_draw < impairment.loss:
+            self.__lost += 1
+            return []
+
+        departure = now
+        if impairment.bandwidth:
+            start = max(self.__link_free, now)
+            self.__queue_delay = (start - now) * 1000
+            if self.__queue_delay > impairment.queue:
+                self.__queue_dropped += 1
+                return []
+            self.__link_free = start + size * 8 / (impairment.bandwidth * 1000)
+            departure = self.__link_free
+        else:
+            self.__queue_delay = 0
+
+        departure += max(impairment.delay + impairment.jitter * jitter_draw, 0) / 1000
+        if reorder_draw < impairment.reorder:
+            self.__reordered += 1
+            departure += impairment.reorder_delay / 1000
+        if duplicate_draw < impairment.duplicate:
+            self.__duplicated += 1
+            return [departure, departure]
+        return [departure]
+
+    def __receive(self):
+        """
+        Receives datagrams and schedules their forwarding. Run on a separate thread
+        """
+        while self.__running.is_set():
+            try:
+                data, _ = self.__socket.recvfrom(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            now = default_timer()
+            with self.__condition:
+                self.__received += 1
+                for departure in self.__departures(now, len(data)):
+                    heapq.heappush(self.__pending, (departure, self.__index, data))
+                    self.__index += 1
+                self.__condition.notify()
+
+    def __send(self):
+        """
+        Forwards the datagrams once their departure time comes. Run on a separate thread
+        """
+        with self.__condition:
+            while self.__running.is_set():
+                if not self.__pending:
+                    self.__condition.wait()
+                    continue
+                now = default_timer()
+                departure, _, data = self.__pending[0]
+                if now < departure:
+                    self.__condition.wait(departure - now)
+                    continue
+                heapq.heappop(self.__pending)
+                try:
+                    self.__socket.sendto(data, self.forward_address)
+                except OSError as e:
+                    get_logger().warning(f"Error forwarding a datagram: {e}")
+                    continue
+                self.__forwarded += 1
+                self.__bytes_forwarded += len(data)
+
+
+# Fields of the receiver statistics (written by headless.py) included in the report
+REPORT_BUFFER_FIELDS = ["quality", "packages_lost", "avg_delay", "jitter", "partial_frames", "depth", "target_depth",
+                        "packets_recovered", "packet_loss_rate", "buffer_delay"]
+
+
+def _read_json_lines(path: str) -> List[dict]:
+    """
+    :param path: path of a JSON lines file
+    :return: the objects of the file
+    """
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_report(proxy_log: str, receiver_stats: str, output: str, sender_stats: str = None):
+    """
+    Joins the log of a proxy with the statistics of the receiver (and optionally the sender) written by headless.py,
+    producing a CSV time series with the impairments applied, what the proxy did, how the buffer of the receiver
+    reacted and the quality the sender was sending with
+    :param proxy_log: path of the JSON lines written by the proxy
+    :param receiver_stats: path of the JSON lines written by the receiving headless client
+    :param output: path of the CSV file
+    :param sender_stats: path of the JSON lines written by the sending headless client
+    """
+    proxy_lines = _read_json_lines(proxy_log)
+    proxy_times = [line["time"] for line in proxy_lines]
+    sender_lines = _read_json_lines(sender_stats) if sender_stats else []
+    sender_times = [line["time"] for line in sender_lines]
+
+    def latest(lines: List[dict], times: List[float], moment: float) -> Dict:
+        index = bisect.bisect_right(times, moment) - 1
+        return lines[index] if index >= 0 else {}
+
+    with open(output, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["elapsed", "phase", *Impairment._fields, *ProxyStatistics._fields,
+                         *(f"receiver_{field}" for field in REPORT_BUFFER_FIELDS), "receiver_frames", "sender_quality"])
+        for receiver_line in _read_json_lines(receiver_stats):
+            proxy_line = latest(proxy_lines, proxy_times, receiver_line["time"])
+            if not proxy_line:
+                continue
+            impairment = proxy_line["impairment"]
+            statistics = proxy_line["statistics"]
+            buffer = receiver_line["buffer"]
+            sending = latest(sender_lines, sender_times, receiver_line["time"]).get("sending", "")
+            writer.writerow([round(proxy_line["elapsed"] + receiver_line["time"] - proxy_line["time"], ndigits=3),
+                             proxy_line["phase"], *(impairment[field] for field in Impairment._fields),
+                             *(statistics[field] for field in ProxyStatistics._fields),
+                             *(buffer[field] for field in REPORT_BUFFER_FIELDS), receiver_line["remote_frames"],
+                             sending])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Samtale network impairment proxy')
+
+    parser.add_argument('-log_level', action='store', nargs='?', default='info',
+                        choices=['debug', 'info', 'warning', 'error'], required=False,
+                        help='Indicate logging level')
+    parser.add_argument('-listen', action='store', type=int, default=None, required=False,
+                        help='Indicate the UDP port the proxy receives the video on (the registered port of the '
+                             'receiver)')
+    parser.add_argument('-listen_ip', action='store', default='0.0.0.0', required=False)
+    parser.add_argument('-forward', action='store', default=None, required=False,
+                        help='Indicate the address the video is forwarded to, as ip:port (the registered IP and the '
+                             '-video_port of the receiver)')
+    parser.add_argument('-schedule', action='store', default=None, required=False,
+                        help='Indicate a JSON file with the schedule of impairments. If not specified, the '
+                             'impairments of the arguments are applied for the whole run')
+    parser.add_argument('-record', action='store', default=None, required=False,
+                        help='Indicate a JSON file where the schedule applied is written, to repeat the run')
+    parser.add_argument('-seed', action='store', type=int, default=0, required=False)
+    for field, default in Impairment._field_defaults.items():
+        parser.add_argument(f'-{field}', action='store', type=float, default=default, required=False)
+    parser.add_argument('-duration', action='store', type=float, default=None, required=False,
+                        help='Indicate the number of seconds to run for (forever by default)')
+    parser.add_argument('-log', action='store', default='-', required=False,
+                        help='Indicate the file where the statistics of the proxy are written every second as JSON '
+                             'lines (- for stdout)')
+    parser.add_argument('-report', action='store', nargs=3, default=None, required=False,
+                        metavar=('PROXY_LOG', 'RECEIVER_STATS', 'OUTPUT'),
+                        help='Instead of running the proxy, join its log with the statistics of the receiver into a '
+                             'CSV file')
+    parser.add_argument('-sender_stats', action='store', default=None, required=False,
+                        help='Indicate the statistics of the sender, to include its quality in the report')
+
+    args = parser.parse_args()
+
+    set_logger(args)
+    if args.report is not None:
+        write_report(*args.report, sender_stats=args.sender_stats)
+        sys.exit(0)
+    if args.listen is None or args.forward is None:
+        parser.error("-listen and -forward are needed to run the proxy")
+
+    if args.schedule is not None:
+        impairment_schedule = ImpairmentSchedule.load(args.schedule)
+    else:
+        impairment_schedule = ImpairmentSchedule([ImpairmentPhase(0, Impairment(
+            **{field: getattr(args, field) for field in Impairment._fields}))], args.seed)
+    if args.record is not None:
+        impairment_schedule.save(args.record)
+
+    forward_ip, forward_port = args.forward.rsplit(':', 1)
+    # Datagrams are forwarded from the IP they are sent to, and the receiver discards the ones that do not come from the
+    # IP of the sender, which is never a loopback one
+    if ipaddress.ip_address(socket.gethostbyname(forward_ip)).is_loopback:
+        parser.error("-forward must use the registered IP of the receiver, the video forwarded to a loopback address "
+                     "would be discarded")
+    proxy = ImpairmentProxy((args.listen_ip, args.listen), (forward_ip, int(forward_port)), impairment_schedule)
+    stopped = Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+    log = None if args.log == '-' else open(args.log, "a")
+    get_logger().info(f"Forwarding UDP port {args.listen} to {args.forward}")
+    proxy.start()
+    while not stopped.wait(1):
+        elapsed = proxy.elapsed()
+        phase = impairment_schedule.phase_at(elapsed)
+        line = json.dumps({"time": round(time(), ndigits=3), "elapsed": round(elapsed, ndigits=3), "phase": phase,
+                           "impairment": impairment_schedule.phases[phase].impairment._asdict(),
+                           "statistics": proxy.get_statistics()._asdict()})
+        print(line, file=log, flush=True)
+        if args.duration is not None and elapsed >= args.duration:
+            break
+    proxy.stop()
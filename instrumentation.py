@@ -0,0 +1,267 @@
+import signal
+from functools import wraps
+from threading import Lock, local
+from timeit import default_timer
+from typing import Dict, List, NamedTuple
+
+from logger import get_logger
+
+
+class TimerSnapshot(NamedTuple):
+    count: int
+    total: float  # Measured in ms
+    max: float  # Measured in ms
+    p99: float  # Measured in ms, over the last SAMPLES observations of every thread
+
+
+class _TimerShard:
+    """
+    Observations of a timer made by a single thread. Only that thread writes to it, so no lock is needed
+    """
+    __slots__ = ("count", "total", "max", "samples", "next_sample", "starts")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.samples: List[float] = []
+        self.next_sample = 0
+        # Start of the sections being timed with the context manager (a stack, since they may be nested)
+        self.starts: List[float] = []
+
+
+class _CounterShard:
+    """
+    Increments of a counter made by a single thread
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+
+class Timer:
+    """
+    Named timer. It can decorate a function (timing every call) or time a section as a context manager. Every thread
+    aggregates its observations on its own shard, so timing takes no lock, and nothing is measured while the
+    instrumentation is disabled
+    """
+    # Observations kept by every thread to estimate the 99th percentile
+    SAMPLES = 512
+
+    def __init__(self, name: str, instrumentation: "Instrumentation"):
+        """
+        Constructor
+        :param name: name of the timer
+        :param instrumentation: registry the timer belongs to
+        """
+        self.name = name
+        self.__instrumentation = instrumentation
+        self.__local = local()
+        self.__mutex = Lock()
+        self.__shards: List[_TimerShard] = []
+
+    def __shard(self) -> _TimerShard:
+        """
+        :return: the shard of the calling thread, which is created on its first observation
+        """
+        try:
+            return self.__local.shard
+        except AttributeError:
+            shard = self.__local.shard = _TimerShard()
+            with self.__mutex:
+                self.__shards.append(shard)
+            return shard
+
+    def record(self, milliseconds: float):
+        """
+        :param milliseconds: a duration
+        """
+        shard = self.__shard()
+        shard.count += 1
+        shard.total += milliseconds
+        if milliseconds > shard.max:
+            shard.max = milliseconds
+        if len(shard.samples) < Timer.SAMPLES:
+            shard.samples.append(milliseconds)
+        else:
+            shard.samples[shard.next_sample] = milliseconds
+            shard.next_sample = (shard.next_sample + 1) % Timer.SAMPLES
+
+    def __enter__(self) -> "Timer":
+        if self.__instrumentation.enabled:
+            self.__shard().starts.append(default_timer())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__instrumentation.enabled:
+            starts = self.__shard().starts
+            if starts:
+                self.record((default_timer() - starts.pop()) * 1000)
+
+    def __call__(self, function):
+        """
+        :param function: function to be decorated
+        :return: a function that runs the original one, timing it
+        """
+        @wraps(function)
+        def _timed(*args, **kwargs):
+            if not self.__instrumentation.enabled:
+                return function(*args, **kwargs)
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record((default_timer() - start) * 1000)
+
+        return _timed
+
+    def snapshot(self) -> TimerSnapshot:
+        """
+        :return: the observations of every thread. Shards are read without locking them, so an observation being made
+                 meanwhile may be missing
+        """
+        with self.__mutex:
+            shards = list(self.__shards)
+        samples = sorted(sample for shard in shards for sample in list(shard.samples))
+        p99 = samples[int(0.99 * (len(samples) - 1))] if samples else 0
+        return TimerSnapshot(sum(shard.count for shard in shards), sum(shard.total for shard in shards),
+                             max((shard.max for shard in shards), default=0), p99)
+
+
+class Counter:
+    """
+    Named counter. Every thread increments its own shard, so counting takes no lock
+    """
+
+    def __init__(self, name: str, instrumentation: "Instrumentation"):
+        """
+        Constructor
+        :param name: name of the counter
+        :param instrumentation: registry the counter belongs to
+        """
+        self.name = name
+        self.__instrumentation = instrumentation
+        self.__local = local()
+        self.__mutex = Lock()
+        self.__shards: List[_CounterShard] = []
+
+    def increment(self, amount: int = 1):
+        """
+        :param amount: amount to add to the counter
+        """
+        if not self.__instrumentation.enabled:
+            return
+        try:
+            shard = self.__local.shard
+        except AttributeError:
+            shard = self.__local.shard = _CounterShard()
+            with self.__mutex:
+                self.__shards.append(shard)
+        shard.value += amount
+
+    def value(self) -> int:
+        """
+        :return: the sum of the increments of every thread
+        """
+        with self.__mutex:
+            return sum(shard.value for shard in self.__shards)
+
+
+class Instrumentation:
+    """
+    Registry of the named timers and counters of the program. They are meant to stay enabled in production: nothing is
+    printed while measuring, and the aggregated results are only read when a snapshot is taken
+    """
+
+    def __init__(self):
+        """
+        Constructor. The instrumentation starts enabled
+        """
+        self.enabled = True
+        self.__mutex = Lock()
+        self.__timers: Dict[str, Timer] = {}
+        self.__counters: Dict[str, Counter] = {}
+
+    def timer(self, name: str) -> Timer:
+        """
+        :param name: name of the timer
+        :return: the timer with that name, which is created if it does not exist
+        """
+        with self.__mutex:
+            if name not in self.__timers:
+                self.__timers[name] = Timer(name, self)
+            return self.__timers[name]
+
+    def counter(self, name: str) -> Counter:
+        """
+        :param name: name of the counter
+        :return: the counter with that name, which is created if it does not exist
+        """
+        with self.__mutex:
+            if name not in self.__counters:
+                self.__counters[name] = Counter(name, self)
+            return self.__counters[name]
+
+    def snapshot(self) -> dict:
+        """
+        :return: a JSON object with the count, total, max and p99 (in ms) of every timer, and the value of every counter
+        """
+        with self.__mutex:
+            timers = list(self.__timers.values())
+            counters = list(self.__counters.values())
+        return {"timers": {timer.name: {field: round(value, ndigits=3)
+                                        for field, value in timer.snapshot()._asdict().items()}
+                           for timer in timers},
+                "counters": {counter.name: counter.value() for counter in counters}}
+
+    def dump(self) -> str:
+        """
+        :return: a table with the snapshot of every timer and counter
+        """
+        snapshot = self.snapshot()
+        width = max((len(name) for group in snapshot.values() for name in group), default=0)
+        lines = [f"{'timer':<{width}} {'count':>10} {'total ms':>12} {'max ms':>10} {'p99 ms':>10}"]
+        for name, timer in sorted(snapshot["timers"].items()):
+            lines.append(f"{name:<{width}} {timer['count']:>10} {timer['total']:>12.1f} {timer['max']:>10.3f} "
+                         f"{timer['p99']:>10.3f}")
+        lines.append(f"{'counter':<{width}} {'value':>10}")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name:<{width}} {value:>10}")
+        return "\n".join(lines)
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation() -> Instrumentation:
+    """
+    :return: instrumentation registry of the running program
+    """
+    return _instrumentation
+
+
+def timed(name: str) -> Timer:
+    """
+    :param name: name of the timer
+    :return: the timer, to be used as a decorator or as a context manager
+    """
+    return _instrumentation.timer(name)
+
+
+def counter(name: str) -> Counter:
+    """
+    :param name: name of the counter
+    :return: the counter
+    """
+    return _instrumentation.counter(name)
+
+
+def install_dump_signal():
+    """
+    Makes the program log a dump of the instrumentation every time it receives SIGUSR1 (where available). Must be
+    called from the main thread
+    """
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: get_logger().info(f"Instrumentation:\n"
+                                                                              f"{_instrumentation.dump()}"))
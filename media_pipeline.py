@@ -0,0 +1,736 @@
+import socket
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum, auto
+from threading import Event, Thread, Semaphore, Lock
+from typing import Deque, Hashable, NamedTuple, Optional, Tuple, Union
+from timeit import default_timer
+
+import cv2
+import numpy as np
+
+from call_control import CallControl, ReceiverReport, RoundTripStatistics
+from configuration import Configuration, ConfigurationStatus
+from discovery_server import get_discovery_client
+from frame_cache import FrameCache
+from frame_mailbox import FrameMailbox
+from frame_store import FrameStore, StoredFrame
+from udp_helper import UDPBuffer, udp_datagram_from_msg, UDPDatagram, BufferQuality, BufferStatistics, DatagramPool, \
+    PlayoutClock, add_parity, fec_group_size, steady_time
+from user import CurrentUser, protocol_version
+from instrumentation import get_instrumentation, timed
+from logger import get_logger
+from metrics import get_metrics
+from network_core import NetworkCore
+from pacer import FramePacer
+from quality_ladder import QualityLadder, QualityRung
+
+MAX_DATAGRAM_SIZE = 65_507
+
+
+class ReceiveMode(Enum):
+    # Each datagram is received into a new bytes object
+    COPY = auto()
+    # Datagrams are received into reusable buffers of a DatagramPool, and their data is never copied
+    ZERO_COPY = auto()
+
+
+class NetworkMode(Enum):
+    # Video and control connections are handled by dedicated blocking threads
+    THREADS = auto()
+    # Video and control connections are handled by an asyncio event loop (see network_core.NetworkCore)
+    ASYNCIO = auto()
+
+
+class CaptureMode(Enum):
+    # The video is provided by a webcam (video0 by default)
+    CAMERA = auto()
+    # The video is provided by a file
+    FILE = auto()
+    # The video is provided by a file that has already been compressed in every quality (see frame_store.FrameStore)
+    STORE = auto()
+    # There's no video, just an image showing that there's no webcam (on video0)
+    NO_CAMERA = auto()
+    # The video is generated (a moving pattern with the number of the frame), so every frame is different
+    SYNTHETIC = auto()
+
+
+class LatencyEstimate(NamedTuple):
+    rtt: float  # Round trip time of the connection of the call, measured in ms
+    one_way: float  # Network delay in each direction (half the round trip time), measured in ms
+    frame_delay: float  # Time from the capture of a remote frame until it is received, measured in ms
+    glass_to_glass: float  # Time from the capture of a remote frame until it is shown, measured in ms
+
+
+class MediaPipeline:
+    """
+    Everything a client does with the video but showing it: it captures video (from the webcam, a file, a static image
+    or a synthetic source), compresses it and sends it to the other end of the call, and receives and plays out the
+    video of the other end. The call is controlled through CallControl, which calls back the display_* methods and
+    incoming_call. Subclasses decide how the video is shown (display_video) and how the user is asked and informed
+    """
+    APP_NAME = "Samtale"
+    VIDEO_WIDTH = 640
+    VIDEO_HEIGHT = 480
+
+    # On V1-V3, the CALL_CONGESTED message will be sent at most once every CONGEST_INTERVAL seconds
+    CONGESTED_INTERVAL = 5
+    # On V4+, a receiver report is sent every REPORT_INTERVAL seconds instead (on V5+, along with a round trip probe).
+    # The video sent steps down when a report shows more packet loss, jitter (in ms) or lag (seconds of video sent but
+    # not received yet) than these
+    REPORT_INTERVAL = 1
+    REPORT_MAX_LOSS = 0.05
+    REPORT_MAX_JITTER = 50
+    REPORT_MAX_LAG = 1
+    # The video sent is only allowed to step up while it's healthy: the reports (or, before V4, the buffer of our end,
+    # assuming that the connection is symmetric) show at most these, and (before V4) the quality of the buffer is HIGH
+    HEALTHY_LOSS = 0.01
+    HEALTHY_JITTER = 20
+    HEALTHY_LAG = 0.5
+    # On NO_CAMERA mode, the static image will be set NO_CAMERA_FPS per second
+    NO_CAMERA_FPS = 30
+    NO_CAMERA_IMAGE = "no_camera.bmp"
+    # On SYNTHETIC mode, frames are generated SYNTHETIC_FPS per second
+    SYNTHETIC_FPS = 30
+    # If True, the UDPBuffer adapts its playout delay to the measured jitter and loss
+    ADAPTIVE_PLAYOUT = True
+    # Threads compressing frames, and maximum number of frames that may be waiting to be compressed and sent
+    ENCODE_WORKERS = 2
+    MAX_IN_FLIGHT_FRAMES = 3
+    # If True, parity datagrams are sent to V3+ peers (forward error correction)
+    FEC_ENABLED = True
+    # Number of free receive buffers kept by the DatagramPool in ReceiveMode.ZERO_COPY
+    RECEIVE_POOL_SIZE = 32
+    # Maximum size (in bytes) of the cache of resized and compressed frames of the static image and video files
+    FRAME_CACHE_SIZE = 64 * 1024 * 1024
+    # Timers of every iteration of the capture and display loops. They are looked up once, so timing an iteration takes
+    # no lock of the instrumentation registry
+    CAPTURE_TIMER = timed("capture_and_send_video")
+    DISPLAY_TIMER = timed("display_video")
+
+    def __init__(self, receive_mode: ReceiveMode = ReceiveMode.ZERO_COPY, receive_buffer_size: int = None,
+                 network_mode: NetworkMode = NetworkMode.THREADS, open_camera: bool = True):
+        """
+        Reads the configuration and creates the sockets, buffers and threads of the pipeline. Nothing runs until
+        start_pipeline is called
+        :param receive_mode: how datagrams are received from the UDP socket. Ignored in NetworkMode.ASYNCIO, where the
+                             event loop receives them
+        :param receive_buffer_size: size (in bytes) of the SO_RCVBUF of the UDP socket. If not specified, the default
+                                    one of the system is kept
+        :param network_mode: whether the sockets are handled by threads or by an asyncio event loop
+        :param open_camera: if False, the webcam is not opened and the pipeline starts in CaptureMode.NO_CAMERA
+        """
+        self.configuration = Configuration()
+
+        # The quality of the video sent steps down when congestion has been detected
+        self.quality_ladder = QualityLadder()
+
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if receive_buffer_size is not None:
+            self.receive_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+            get_logger().debug(f"SO_RCVBUF set to "
+                               f"{self.receive_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes")
+        self.receive_mode = receive_mode
+        # Port the UDP socket is bound to, if it is not the registered one (e.g. when the video reaches it through an
+        # impairment proxy listening on the registered port)
+        self.video_port: Optional[int] = None
+        self.datagram_pool = DatagramPool(MAX_DATAGRAM_SIZE, MediaPipeline.RECEIVE_POOL_SIZE) \
+            if receive_mode == ReceiveMode.ZERO_COPY and network_mode == NetworkMode.THREADS else None
+        self.network_core = NetworkCore() if network_mode == NetworkMode.ASYNCIO else None
+
+        # Select capturing mode
+        self.capture_lock = Lock()
+        self.capture_mode = CaptureMode.CAMERA
+        # This will only be used in CaptureMode.FILE, CaptureMode.STORE and CaptureMode.SYNTHETIC
+        self.video_current_frame = 0
+        self.video_frame_count = 0
+        self.video_file = None
+        # Video files are transcoded on a separate thread, and played from the store once it's ready
+        self.frame_store: Optional[FrameStore] = None
+        self.transcoding_cancelled = Event()
+        # Frames that don't change (the static image, or a video file played in a loop) are only resized and compressed
+        # once per quality rung
+        self.frame_cache = FrameCache(MediaPipeline.FRAME_CACHE_SIZE)
+        self.synthetic_pattern: Optional[np.ndarray] = None
+
+        self.capture = cv2.VideoCapture(0) if open_camera else cv2.VideoCapture()
+        self.no_camera = cv2.imread(MediaPipeline.NO_CAMERA_IMAGE)
+        if not self.capture.isOpened():
+            get_logger().info("No camera mode enabled")
+            self.capture_mode = CaptureMode.NO_CAMERA
+            self.fps = MediaPipeline.NO_CAMERA_FPS
+        else:
+            get_logger().info("Camera mode enabled")
+            self.fps = int(self.capture.get(cv2.CAP_PROP_FPS))
+
+        self.call_control = CallControl(self, False, self.network_core)
+        self.listening = False
+        self.video_semaphore = Semaphore()
+        # Only the newest local frame is kept for the visualization thread
+        self.camera_buffer = FrameMailbox()
+        self.playout_clock = PlayoutClock(self.video_semaphore)
+        self.capture_pacer = FramePacer()
+        self.encode_pool = ThreadPoolExecutor(max_workers=MediaPipeline.ENCODE_WORKERS, thread_name_prefix="encoder")
+        self.udp_buffer = UDPBuffer(self.playout_clock, adaptive=MediaPipeline.ADAPTIVE_PLAYOUT)
+        self.last_congested = 0
+        # Highest sequence number received when the health of the video was last reported to the quality ladder (V0-V3)
+        self.last_health_seq_number = 0
+        # Remote frames decoded, and moment and count of decoded frames of the last receiver report sent (V4+)
+        self.frames_decoded = 0
+        self.last_report: Optional[Tuple[float, int]] = None
+        # Last receiver report received from the other end (V4+)
+        self.remote_report: Optional[ReceiverReport] = None
+        # Last remote frame played out (so it can be shown again if the next one is not ready)
+        self.last_remote_frame = None
+        self.receiving_thread = Thread(target=self.receive_video, daemon=True)
+        self.capture_thread = Thread(target=self.capture_and_send_video, daemon=True)
+        self.visualization_thread = Thread(target=self.display_video, daemon=True)
+
+    def start_pipeline(self):
+        """
+        Starts capturing, receiving and showing video. If the user is already registered, incoming calls are listened
+        for too
+        """
+        if self.configuration.status == ConfigurationStatus.LOADED:
+            self.start_listening()
+        if self.network_core is None:
+            self.receiving_thread.start()
+        self.capture_thread.start()
+        self.visualization_thread.start()
+
+    def stop_pipeline(self):
+        """
+        Ends the current call (if any) and closes the sockets of the pipeline (and the connection to the discovery
+        server)
+        """
+        if self.call_control.in_call():
+            self.call_control.call_end()
+        # Close sockets
+        self.call_control.stop_control()
+        self.send_socket.close()
+        self.receive_socket.close()
+        if self.network_core is not None:
+            self.network_core.stop()
+        self.playout_clock.stop()
+        self.encode_pool.shutdown(wait=False)
+        get_discovery_client().close()
+        get_logger().debug(f"Local frames dropped: {self.camera_buffer.dropped}")
+        get_logger().debug(f"Capture pacing: {self.capture_pacer.get_statistics()}")
+        get_logger().debug(f"Instrumentation:\n{get_instrumentation().dump()}")
+
+    def register(self, nickname: str, password: str, tcp_port: int, udp_port: int, private_ip: bool,
+                 persistent: bool) -> Tuple[str, str]:
+        """
+        Registers the user (see Configuration.load). If it succeeds, incoming calls start being listened for
+        :return: a pair of strings (title - message) so the result can be displayed
+        """
+        title, message = self.configuration.load(nickname, password, tcp_port, udp_port, private_ip=private_ip,
+                                                 persistent=persistent)
+        if self.configuration.status == ConfigurationStatus.LOADED:
+            self.start_listening()
+        return title, message
+
+    def start_listening(self):
+        """
+        Opens the video endpoint and starts listening for incoming calls (only the first time it's called). The user
+        must be registered
+        """
+        if not self.listening:
+            self.listening = True
+            self.open_video_endpoint()
+            self.call_control.start_control()
+
+    def receive_video(self):
+        """
+        This function will receive data from the UDP socket. After checking that the video should indeed flow
+        (a not-that-good-programmed client might send us video even if the video is on pause), it inserts the datagram
+        into the UDPBuffer. In ReceiveMode.ZERO_COPY, the datagram is received into a buffer of the pool, which will be
+        given back by the UDPBuffer once the datagram is discarded or consumed.
+        This function is meant to be run on a separate thread.
+        """
+        while True:
+            if self.datagram_pool is not None:
+                buffer = self.datagram_pool.acquire()
+                size, addr = self.receive_socket.recvfrom_into(buffer)
+                data = memoryview(buffer)[:size]
+            else:
+                buffer = None
+                data, addr = self.receive_socket.recvfrom(MAX_DATAGRAM_SIZE)
+
+            self.handle_datagram(data, addr, buffer)
+
+    @timed("receive_video.handle_datagram")
+    def handle_datagram(self, data: Union[bytes, memoryview], addr: Tuple[str, int], buffer: bytearray = None):
+        """
+        Inserts a datagram received from the UDP socket into the UDPBuffer, if it comes from the other end of the call
+        and the video should flow
+        :param data: datagram received
+        :param addr: address the datagram comes from
+        :param buffer: buffer of the DatagramPool data is a view of (if any). It is given back if data is discarded
+        """
+        start = default_timer()
+        udp_datagram = None
+        if self.call_control.should_video_flow() and addr[0] == self.call_control.get_send_address()[0]:
+            udp_datagram = udp_datagram_from_msg(data)
+            if udp_datagram is None:
+                get_logger().warning(f"Discarding malformed datagram from {addr[0]}")
+
+        if udp_datagram is None:
+            if buffer is not None:
+                self.datagram_pool.release(buffer)
+            return
+
+        if buffer is not None:
+            udp_datagram.set_buffer(buffer, self.datagram_pool)
+        self.udp_buffer.insert(udp_datagram)
+        get_metrics().observe("insert", (default_timer() - start) * 1000)
+
+    def open_video_endpoint(self):
+        """
+        Binds the UDP socket where video is received. In NetworkMode.ASYNCIO, the socket is handed over to the event
+        loop
+        """
+        self.receive_socket.bind(("0.0.0.0", self.video_port or CurrentUser().udp_port))
+        if self.network_core is not None:
+            self.network_core.open_video_endpoint(self.receive_socket, self.handle_datagram)
+
+    @staticmethod
+    def encode_frame(frame: np.ndarray, rung: QualityRung) -> Optional[bytes]:
+        """
+        Resizes (if needed) and compresses a frame. OpenCV releases the GIL while doing so, so this function is run on
+        the encoding thread pool
+        :param frame: a frame returned by the get_frame function
+        :param rung: quality the frame should be sent with
+        :return: the frame compressed as JPEG, or None if it could not be compressed
+        """
+        if frame.shape[1] != rung.width or frame.shape[0] != rung.height:
+            frame = cv2.resize(frame, (rung.width, rung.height), interpolation=cv2.INTER_AREA)
+
+        success, compressed_frame = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, rung.jpeg_quality])
+        if not success:
+            get_logger().error("Error compressing a frame")
+            return None
+        return compressed_frame.tobytes()
+
+    def encode_cached_frame(self, frame: np.ndarray, source_key: Optional[Hashable], rung: QualityRung) \
+            -> Optional[Union[bytes, memoryview]]:
+        """
+        Compresses a frame, reusing the compressed frame of the same source frame and rung if it's cached or stored in
+        a FrameStore
+        :param frame: a frame returned by the get_frame function
+        :param source_key: key of the source frame returned by the get_frame function. If None, nothing is cached
+        :param rung: quality the frame should be sent with
+        :return: the frame compressed as JPEG, or None if it could not be compressed
+        """
+        if isinstance(source_key, StoredFrame):
+            stored_frame = source_key.store.frame(source_key.index, rung.width, rung.height, rung.jpeg_quality)
+            if stored_frame is not None:
+                return stored_frame
+            return self.encode_frame(frame, rung)
+        if source_key is None:
+            return self.encode_frame(frame, rung)
+        return self.frame_cache.get((source_key, rung.width, rung.height, rung.jpeg_quality),
+                                    lambda: self.encode_frame(frame, rung))
+
+    def encode_captured_frame(self, frame: np.ndarray, source_key: Optional[Hashable], rung: QualityRung,
+                              captured: float) -> Tuple[Optional[Union[bytes, memoryview]], float]:
+        """
+        Compresses a frame as encode_cached_frame does, measuring the encode stage. Run on the encoding thread pool
+        :param frame: a frame returned by the get_frame function
+        :param source_key: key of the source frame returned by the get_frame function
+        :param rung: quality the frame should be sent with
+        :param captured: moment the frame was captured (default_timer)
+        :return: the frame compressed as JPEG (or None if it could not be compressed), and the moment it was compressed
+        """
+        compressed_frame = self.encode_cached_frame(frame, source_key, rung)
+        encoded = default_timer()
+        get_metrics().observe("encode", (encoded - captured) * 1000)
+        return compressed_frame, encoded
+
+    def send_frame(self, udp_datagram: UDPDatagram):
+        """
+        Sends a compressed frame to the other end, using the format that the protocol of the call requires
+        :param udp_datagram: datagram with the compressed frame
+        """
+        protocol = self.call_control.protocol
+        address = self.call_control.get_send_address()
+        if protocol is None or not address:
+            return
+
+        # V2+ peers understand the binary header and reassemble frames split into several packets. V3+ ones also
+        # recover lost packets with parity datagrams. Older ones need the ASCII header and the whole frame in a single
+        # datagram
+        version = protocol_version(protocol)
+        if version >= 3 and MediaPipeline.FEC_ENABLED:
+            # V4+ peers report the loss they measure. Otherwise, it's measured on our end, assuming that the connection
+            # is symmetric
+            remote_report = self.remote_report
+            loss_rate = remote_report.loss if version >= 4 and remote_report is not None \
+                else self.udp_buffer.get_statistics().packet_loss_rate
+            group_size = fec_group_size(loss_rate)
+            packets = [datagram.encode(binary=True)
+                       for datagram in add_parity(udp_datagram.fragment(always=True), group_size)]
+        elif version >= 2:
+            packets = [fragment.encode(binary=True) for fragment in udp_datagram.fragment()]
+        else:
+            packets = [udp_datagram.encode()]
+            assert (len(packets[0]) <= MAX_DATAGRAM_SIZE)
+
+        for packet in packets:
+            self.send_socket.sendto(packet, address)
+
+    def capture_and_send_video(self):
+        """
+        This function will capture video from the preferred source (webcam, file or static image), insert it into a
+        queue (so the visualization thread can play it) and send it to the other end in the case that we are in a call
+        and the video should flow. Frames are compressed on the encoding thread pool, so capturing a frame overlaps with
+        compressing the previous ones. Sequence numbers are assigned when frames are captured, and frames are sent in
+        that same order. Frames are captured on the deadlines set by the capture pacer. This function is meant to be run
+        on a separate thread.
+        """
+        # Frames being compressed, as (datagram without data, future with the compressed frame)
+        in_flight: Deque[Tuple[UDPDatagram, Future]] = deque()
+        next_send = 0
+        while True:
+            with MediaPipeline.CAPTURE_TIMER:
+                capture_fps = self.fps
+                # Fetch webcam frame
+                capture_start = default_timer()
+                local_frame, source_key = self.get_frame()
+                capture_ts = steady_time()
+                now = default_timer()
+                get_metrics().observe("capture", (now - capture_start) * 1000)
+                # Notify visualization thread
+                self.camera_buffer.put(local_frame)
+                self.video_semaphore.release()
+                # Compress local frame to send it via the socket
+                # The rung of the quality ladder sets the resolution, JPEG quality and maximum fps of the video sent
+                rung = self.quality_ladder.current()
+                # The fps sent drives the playout rate of the other end, so it's the rate frames are actually captured
+                # at (capped by the fps of the rung)
+                achieved_fps = self.capture_pacer.get_statistics().achieved_fps or capture_fps
+                fps = min(capture_fps, achieved_fps, rung.fps)
+                # If the capturing rate is higher than the fps of the rung, frames are skipped so that, on average,
+                # fps frames are sent every second (with a tolerance of half a capturing period for the jitter of the
+                # capture)
+                if self.call_control.should_video_flow() and now >= next_send - 0.5 / capture_fps:
+                    sequence_number = self.call_control.get_sequence_number()
+                    if sequence_number >= 0:
+                        next_send = max(next_send, now - 1 / fps) + 1 / fps
+                        udp_datagram = UDPDatagram(sequence_number, f"{rung.width}x{rung.height}",
+                                                   round(fps, ndigits=1), bytes(), ts=capture_ts)
+                        future = self.encode_pool.submit(self.encode_captured_frame, local_frame, source_key, rung, now)
+                        in_flight.append((udp_datagram, future))
+
+                # Send the compressed frames in order. If there are too many frames in flight, wait for the oldest one
+                while in_flight and (in_flight[0][1].done() or len(in_flight) >= MediaPipeline.MAX_IN_FLIGHT_FRAMES):
+                    udp_datagram, future = in_flight.popleft()
+                    try:
+                        udp_datagram.data, encoded = future.result()
+                    except Exception as e:
+                        # A frame that cannot be compressed is dropped, the capture goes on with the next ones
+                        get_logger().error(f"Error compressing frame {udp_datagram.seq_number}: {e!r}")
+                        continue
+                    if udp_datagram.data is not None and self.call_control.should_video_flow():
+                        self.send_frame(udp_datagram)
+                        get_metrics().observe("send", (default_timer() - encoded) * 1000)
+
+            self.capture_pacer.wait(capture_fps)
+
+    def get_frame(self) -> Tuple[np.ndarray, Optional[Hashable]]:
+        """
+        Captures a frame using the selected capture mode.
+        :return: the frame, and a key that identifies its content (so the compressed frame can be cached), or None if
+                 the frame comes from the webcam and won't ever repeat
+        """
+        with self.capture_lock:
+            source_key = None
+            if self.capture_mode == CaptureMode.NO_CAMERA:
+                frame = self.no_camera
+            elif self.capture_mode == CaptureMode.SYNTHETIC:
+                frame = self.synthetic_frame()
+            elif self.capture_mode == CaptureMode.STORE:
+                # Stored frames are already compressed, they are only decoded to be shown locally
+                source_key = StoredFrame(self.frame_store, self.video_current_frame % self.frame_store.frame_count)
+                self.video_current_frame = source_key.index + 1
+                frame = self.frame_store.preview(source_key.index)
+            else:
+                success, frame = self.capture.read()
+                if not success:
+                    frame = self.no_camera
+                else:
+                    if self.capture_mode == CaptureMode.CAMERA:
+                        # Flip the image so it has the natural orientation
+                        frame = cv2.flip(frame, 1)
+                    elif self.capture_mode == CaptureMode.FILE:
+                        source_key = (self.video_file, self.video_current_frame)
+                        # Update the current video frame number
+                        self.video_current_frame += 1
+
+                        # If the reached the end of the video file, we'll start back again
+                        if self.video_current_frame == self.video_frame_count:
+                            self.video_current_frame = 0
+                            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+            if frame is self.no_camera:
+                # The static image is resized only once. Frames of video files are not, as they would flood the cache
+                source_key = (MediaPipeline.NO_CAMERA_IMAGE, 0)
+                return self.frame_cache.get((source_key, MediaPipeline.VIDEO_WIDTH, MediaPipeline.VIDEO_HEIGHT),
+                                            self.resize_no_camera), source_key
+            if frame.shape[1] == MediaPipeline.VIDEO_WIDTH and frame.shape[0] == MediaPipeline.VIDEO_HEIGHT:
+                return frame, source_key
+            return cv2.resize(frame, (MediaPipeline.VIDEO_WIDTH, MediaPipeline.VIDEO_HEIGHT),
+                              interpolation=cv2.INTER_AREA), source_key
+
+    def resize_no_camera(self) -> np.ndarray:
+        """
+        :return: the static image resized to the size of the video. It is shared through the frame cache, so it's made
+                 read-only
+        """
+        frame = cv2.resize(self.no_camera, (MediaPipeline.VIDEO_WIDTH, MediaPipeline.VIDEO_HEIGHT),
+                           interpolation=cv2.INTER_AREA)
+        frame.flags.writeable = False
+        return frame
+
+    def synthetic_frame(self) -> np.ndarray:
+        """
+        Generates the next frame of CaptureMode.SYNTHETIC: a color pattern that moves every frame, with the number of
+        the frame written on it. Must be called with the capture_lock acquired
+        :return: the frame
+        """
+        if self.synthetic_pattern is None:
+            x = np.linspace(0, 255, MediaPipeline.VIDEO_WIDTH, dtype=np.uint8)
+            y = np.linspace(0, 255, MediaPipeline.VIDEO_HEIGHT, dtype=np.uint8)
+            self.synthetic_pattern = np.dstack([np.tile(x, (MediaPipeline.VIDEO_HEIGHT, 1)),
+                                                np.tile(y[:, None], (1, MediaPipeline.VIDEO_WIDTH)),
+                                                np.full((MediaPipeline.VIDEO_HEIGHT, MediaPipeline.VIDEO_WIDTH), 128,
+                                                        np.uint8)])
+        frame = np.roll(self.synthetic_pattern, self.video_current_frame * 4, axis=1)
+        cv2.putText(frame, str(self.video_current_frame), (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        self.video_current_frame += 1
+        return frame
+
+    def select_video_file(self, video_file: str) -> bool:
+        """
+        Starts sending a video file (played in a loop) instead of the current source. The file is transcoded into a
+        FrameStore on a separate thread, and played from the store once it's ready
+        :param video_file: path of the video file
+        :return: true if the file could be opened as a video file
+        """
+        capture = cv2.VideoCapture(video_file)
+        success, _ = capture.read()
+        if not success:
+            get_logger().warning(f"Couldn't open {video_file} as a video file")
+            return False
+        with self.capture_lock:
+            get_logger().info(f"File {video_file} loaded")
+            self.capture.release()
+            self.capture_mode = CaptureMode.FILE
+            self.capture = capture
+            self.video_current_frame = 1
+            self.video_frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            # A file may have changed since the last time it was played
+            self.video_file = video_file
+            self.frame_cache.clear()
+            self.fps = int(self.capture.get(cv2.CAP_PROP_FPS))
+            self.cancel_frame_store()
+            Thread(target=self.prepare_frame_store, args=(video_file, self.transcoding_cancelled),
+                   daemon=True).start()
+        return True
+
+    def select_camera(self):
+        """
+        Starts sending the video of the webcam (or the static image, if there's no webcam) instead of the current source
+        """
+        with self.capture_lock:
+            self.cancel_frame_store()
+            self.capture.release()
+            self.capture = cv2.VideoCapture(0)
+            if not self.capture.isOpened():
+                get_logger().info("No camera mode enabled")
+                self.capture_mode = CaptureMode.NO_CAMERA
+                self.fps = MediaPipeline.NO_CAMERA_FPS
+            else:
+                get_logger().info("Camera mode enabled")
+                self.fps = int(self.capture.get(cv2.CAP_PROP_FPS))
+                self.capture_mode = CaptureMode.CAMERA
+
+    def select_synthetic(self):
+        """
+        Starts sending generated video (see CaptureMode.SYNTHETIC) instead of the current source
+        """
+        with self.capture_lock:
+            get_logger().info("Synthetic video mode enabled")
+            self.cancel_frame_store()
+            self.capture.release()
+            self.capture_mode = CaptureMode.SYNTHETIC
+            self.video_current_frame = 0
+            self.fps = MediaPipeline.SYNTHETIC_FPS
+
+    def prepare_frame_store(self, video_file: str, cancelled: Event):
+        """
+        Opens the store of a video file (transcoding it if it's the first time it's played), and plays the file from
+        the store once it's ready. This function is meant to be run on a separate thread
+        :param video_file: path of the video file
+        :param cancelled: set if another file is selected (or the file is cleared) in the meantime
+        """
+        store_formats = [(rung.width, rung.height, rung.jpeg_quality) for rung in QualityLadder.RUNGS]
+        frame_store = FrameStore.open(video_file, store_formats)
+        if frame_store is None:
+            get_logger().info(f"Transcoding {video_file}")
+            frame_store = FrameStore.transcode(video_file, store_formats, cancelled=cancelled)
+        if frame_store is None:
+            return
+        with self.capture_lock:
+            if cancelled.is_set() or self.capture_mode != CaptureMode.FILE or self.video_file != video_file:
+                return
+            get_logger().info(f"Playing {video_file} from its frame store")
+            self.capture_mode = CaptureMode.STORE
+            self.frame_store = frame_store
+            self.capture.release()
+
+    def cancel_frame_store(self):
+        """
+        Stops playing from the frame store (and stops transcoding, if a file is being transcoded). Must be called with
+        the capture_lock acquired
+        """
+        self.transcoding_cancelled.set()
+        self.transcoding_cancelled = Event()
+        self.frame_store = None
+
+    def check_congestion(self, statistics: BufferStatistics):
+        """
+        Takes measures if the quality of the buffer is bad. If we are using V0, our video quality steps down (assuming
+        that the connection is symmetric). If V1-V3 is used, a CALL_CONGESTED is sent to the other end. Before V4, the
+        health of the buffer is also reported to the quality ladder every time new frames arrive, so the video we send
+        only steps up while the video we receive is fine. If V4 (or higher) is used, a receiver report is sent to the
+        other end every REPORT_INTERVAL seconds, whatever the quality
+        :param statistics: statistics of the UDPBuffer
+        """
+        protocol = self.call_control.protocol
+        if not self.call_control.in_call() or protocol is None:
+            return
+        if protocol_version(protocol) >= 4:
+            now = default_timer()
+            if self.last_report is None:
+                self.last_report = now, self.frames_decoded
+            elif now - self.last_report[0] >= MediaPipeline.REPORT_INTERVAL:
+                decoded_fps = (self.frames_decoded - self.last_report[1]) / (now - self.last_report[0])
+                self.last_report = now, self.frames_decoded
+                self.call_control.call_report(ReceiverReport(statistics.packet_loss_rate, statistics.highest_seq_number,
+                                                             statistics.jitter, statistics.depth, decoded_fps))
+                self.call_control.call_ping()
+        else:
+            if statistics.highest_seq_number != self.last_health_seq_number:
+                self.last_health_seq_number = statistics.highest_seq_number
+                self.quality_ladder.report_health(statistics.quality == BufferQuality.HIGH and
+                                                  statistics.packet_loss_rate <= MediaPipeline.HEALTHY_LOSS)
+            if statistics.quality < BufferQuality.MEDIUM:
+                if protocol == "V0":
+                    self.quality_ladder.step_down()
+                else:
+                    now = default_timer()
+                    if now - self.last_congested > MediaPipeline.CONGESTED_INTERVAL:
+                        self.last_congested = now
+                        self.call_control.call_congested()
+
+    def receive_report(self, report: ReceiverReport):
+        """
+        Adapts the video sent to a receiver report (V4+): the quality steps down if the other end is losing too many
+        packets, the jitter is too high or the frames sent are not arriving (because the link cannot carry them). It
+        may only step up while the reports are well below those limits
+        :param report: report received from the other end
+        """
+        self.remote_report = report
+        rung = self.quality_ladder.current()
+        # Sequence numbers of a call start at 1, so if the other end has received nothing at all (its highest sequence
+        # number is 0), every frame sent is lagging
+        lag = (self.call_control.sequence_number - report.highest_seq_number) / rung.fps
+        if report.loss > MediaPipeline.REPORT_MAX_LOSS or report.jitter > MediaPipeline.REPORT_MAX_JITTER or \
+                lag > MediaPipeline.REPORT_MAX_LAG:
+            get_logger().info(f"Congestion reported by the other end: loss {report.loss:.1%}, jitter "
+                              f"{report.jitter:.1f} ms, lag {lag:.1f} s")
+            self.quality_ladder.step_down()
+        else:
+            self.quality_ladder.report_health(report.loss <= MediaPipeline.HEALTHY_LOSS and
+                                              report.jitter <= MediaPipeline.HEALTHY_JITTER and
+                                              lag <= MediaPipeline.HEALTHY_LAG)
+
+    def receive_round_trip(self, statistics: RoundTripStatistics):
+        """
+        Takes the estimates of a round trip probe (V5+): the delays of the video received are corrected from then on
+        with the offset between the clocks of both ends
+        :param statistics: estimates of the round trip probe of the call
+        """
+        get_logger().debug(f"Round trip: {statistics}")
+        self.udp_buffer.clock_offset = statistics.clock_offset
+
+    def latency_estimate(self) -> Optional[LatencyEstimate]:
+        """
+        :return: the latency of the call, derived from the round trip probe and the delays of the video received. None
+                 if no round trip probe has been answered (the protocol of the call is not V5+, or it has just started)
+        """
+        round_trip = self.call_control.round_trip.get_statistics()
+        if round_trip is None:
+            return None
+        statistics = self.udp_buffer.get_statistics()
+        glass_to_glass = statistics.avg_delay + statistics.buffer_delay + get_metrics().mean("decode") + \
+            get_metrics().mean("render")
+        return LatencyEstimate(round_trip.rtt, round_trip.rtt / 2, statistics.avg_delay, glass_to_glass)
+
+    def flush_buffer(self):
+        """
+        This function will be called when a call ends. It will flush the UDPBuffer and delete the "frozen" remote frame
+        """
+        get_logger().debug("Flushing buffer")
+        # The clock will not tick again until the new buffer is ready to be played
+        self.playout_clock.retarget(None)
+        ticks, late_ticks, underruns = self.playout_clock.get_statistics()
+        get_logger().debug(f"Playout clock: {ticks} ticks, {late_ticks} late, {underruns} underruns")
+        self.last_remote_frame = None
+        self.last_report = None
+        self.remote_report = None
+        self.last_health_seq_number = 0
+        self.udp_buffer = UDPBuffer(self.playout_clock, adaptive=MediaPipeline.ADAPTIVE_PLAYOUT)
+
+    def display_video(self):
+        """
+        Shows (or otherwise processes) the local frames put into camera_buffer and the remote frames played out by the
+        UDPBuffer. It is woken through video_semaphore, and it's run on a separate thread
+        """
+        raise NotImplementedError()
+
+    def incoming_call(self, nickname: str, ip: str) -> bool:
+        """
+        This function will be called when there's an incoming call
+        :param nickname: nickname of the user
+        :param ip: the actual IP address of the user
+        :return: true if the call is accepted and false otherwise
+        """
+        raise NotImplementedError()
+
+    def display_message(self, title: str, message: str):
+        """
+        Informs the user about something
+        :param title: title of the message
+        :param message: message that will be displayed
+        """
+        get_logger().info(f"{title}: {message}")
+
+    def display_calling(self, nickname: str):
+        """
+        This function will be called when calling someone
+        :param nickname: nickname of the user that is being called
+        """
+
+    def display_in_call(self, nickname: str):
+        """
+        This function will be called when a call is established
+        :param nickname: nickname of the user whom the are talking to
+        """
+
+    def display_connect(self):
+        """
+        This function will be called when a call ends
+        """
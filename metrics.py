@@ -0,0 +1,219 @@
+import json
+import os
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from typing import Dict, List, NamedTuple, Optional
+
+from instrumentation import get_instrumentation
+from logger import get_logger
+
+
+class HistogramSnapshot(NamedTuple):
+    stage: str
+    description: str
+    counts: List[int]  # Observations of every bucket (not cumulative), the last one being the +Inf bucket
+    sum: float  # Measured in ms
+    count: int
+
+
+class Histogram:
+    """
+    Histogram of durations with fixed buckets, so observing a value is O(log buckets) and takes no memory
+    """
+    # Upper bounds of the buckets (in ms). Values above the last one fall in the +Inf bucket
+    BUCKETS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+    def __init__(self, stage: str, description: str):
+        """
+        Constructor
+        :param stage: name of the stage measured
+        :param description: what the stage measures
+        """
+        self.stage = stage
+        self.description = description
+        self.__mutex = Lock()
+        self.__counts = [0] * (len(Histogram.BUCKETS) + 1)
+        self.__sum = 0
+        self.__count = 0
+
+    def observe(self, milliseconds: float):
+        """
+        :param milliseconds: a duration
+        """
+        bucket = bisect_left(Histogram.BUCKETS, milliseconds)
+        with self.__mutex:
+            self.__counts[bucket] += 1
+            self.__sum += milliseconds
+            self.__count += 1
+
+    def snapshot(self) -> HistogramSnapshot:
+        """
+        :return: the observations made so far
+        """
+        with self.__mutex:
+            return HistogramSnapshot(self.stage, self.description, list(self.__counts), self.__sum, self.__count)
+
+
+class Metrics:
+    """
+    Latency of every stage a frame goes through, from its capture on one end to its rendering on the other one. Each
+    stage measures the time since the previous one, so together they show where the milliseconds go
+    """
+    STAGES: Dict[str, str] = {
+        "capture": "Time taken to get a frame from the video source",
+        "encode": "Time from the capture of a frame until it is compressed (waiting for an encoder included)",
+        "send": "Time from the compression of a frame until all of its packets are sent",
+        "receive": "Time from the capture of a frame on the other end until it is received (corrected with the offset "
+                   "between clocks measured on V5+ calls; otherwise, clocks must be in sync)",
+        "insert": "Time from the reception of a packet until it is parsed and inserted in the buffer",
+        "buffer": "Time a frame spends in the buffer until it is played",
+        "decode": "Time taken to decompress a frame",
+        "render": "Time taken to compose the decompressed frame with the local one",
+    }
+
+    def __init__(self):
+        """
+        Constructor. Every histogram starts empty
+        """
+        self.__histograms = {stage: Histogram(stage, description) for stage, description in Metrics.STAGES.items()}
+
+    def observe(self, stage: str, milliseconds: float):
+        """
+        :param stage: one of STAGES
+        :param milliseconds: time spent on the stage by a frame
+        """
+        self.__histograms[stage].observe(milliseconds)
+
+    def snapshot(self) -> List[HistogramSnapshot]:
+        """
+        :return: the histogram of every stage
+        """
+        return [histogram.snapshot() for histogram in self.__histograms.values()]
+
+    def mean(self, stage: str) -> float:
+        """
+        :param stage: one of STAGES
+        :return: average time (in ms) spent on the stage by a frame, or 0 if nothing has been observed
+        """
+        snapshot = self.__histograms[stage].snapshot()
+        return snapshot.sum / snapshot.count if snapshot.count else 0
+
+    def to_json(self) -> dict:
+        """
+        :return: the histograms as a JSON object, by stage. Buckets are identified by their upper bound (in ms)
+        """
+        bounds = [str(bound) for bound in Histogram.BUCKETS] + ["+Inf"]
+        return {snapshot.stage: {"buckets": dict(zip(bounds, snapshot.counts)), "sum": round(snapshot.sum, ndigits=3),
+                                 "count": snapshot.count}
+                for snapshot in self.snapshot()}
+
+    def to_prometheus(self) -> str:
+        """
+        :return: the histograms in the Prometheus text format (in seconds, as Prometheus expects)
+        """
+        name = "samtale_stage_duration_seconds"
+        lines = [f"# HELP {name} Time spent by frames on every stage of the media pipeline",
+                 f"# TYPE {name} histogram"]
+        for snapshot in self.snapshot():
+            cumulative = 0
+            for bound, count in zip(Histogram.BUCKETS + [None], snapshot.counts):
+                cumulative += count
+                le = "+Inf" if bound is None else repr(bound / 1000)
+                lines.append(f'{name}_bucket{{stage="{snapshot.stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{snapshot.stage}"}} {snapshot.sum / 1000}')
+            lines.append(f'{name}_count{{stage="{snapshot.stage}"}} {snapshot.count}')
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """
+    :return: metrics of the running program
+    """
+    return _metrics
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = get_metrics().to_prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(get_metrics().to_json()).encode(), "application/json"
+        elif self.path == "/instrumentation.json":
+            body, content_type = json.dumps(get_instrumentation().snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        get_logger().debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+
+class MetricsExporter:
+    """
+    Exports the Metrics through a local HTTP endpoint (/metrics in the Prometheus text format, /metrics.json as JSON,
+    and the snapshot of the instrumentation in /instrumentation.json) and/or by writing them to a JSON file every
+    FILE_INTERVAL seconds
+    """
+    FILE_INTERVAL = 10
+
+    def __init__(self, port: Optional[int] = None, path: Optional[str] = None, address: str = "127.0.0.1"):
+        """
+        Constructor. Nothing is exported until start is called
+        :param port: port of the HTTP endpoint. If not specified, there is no endpoint
+        :param path: path of the JSON file. If not specified, no file is written
+        :param address: address the HTTP endpoint listens on
+        """
+        self.__server = ThreadingHTTPServer((address, port), _MetricsRequestHandler) if port is not None else None
+        self.__path = path
+        self.__stopped = Event()
+        self.__threads: List[Thread] = []
+        if self.__server is not None:
+            self.__threads.append(Thread(target=self.__server.serve_forever, daemon=True))
+        if self.__path is not None:
+            self.__threads.append(Thread(target=self.__write_periodically, daemon=True))
+
+    def start(self):
+        """
+        Starts exporting
+        """
+        for thread in self.__threads:
+            thread.start()
+        if self.__server is not None:
+            get_logger().info(f"Serving metrics on http://{self.__server.server_address[0]}:"
+                              f"{self.__server.server_address[1]}/metrics")
+
+    def stop(self):
+        """
+        Stops exporting, writing the file one last time
+        """
+        self.__stopped.set()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+        if self.__path is not None:
+            self.write()
+
+    def write(self):
+        """
+        Writes the metrics to the JSON file. The file is replaced atomically, so it can be read at any moment
+        """
+        temporary_path = f"{self.__path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(get_metrics().to_json(), file)
+        os.replace(temporary_path, self.__path)
+
+    def __write_periodically(self):
+        while not self.__stopped.wait(MetricsExporter.FILE_INTERVAL):
+            try:
+                self.write()
+            except OSError as e:
+                get_logger().warning(f"Error writing metrics to {self.__path}: {e}")
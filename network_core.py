@@ -0,0 +1,92 @@
+import asyncio
+import socket
+from concurrent.futures import Future
+from threading import Thread
+from typing import Awaitable, Callable, Tuple
+
+from logger import get_logger
+
+
+class _VideoProtocol(asyncio.DatagramProtocol):
+    """
+    Protocol of the UDP video endpoint. Every datagram received is handed to the callback
+    """
+    def __init__(self, on_datagram: Callable[[bytes, Tuple[str, int]], None]):
+        self.on_datagram = on_datagram
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc: Exception):
+        get_logger().warning(f"Error on video endpoint: {exc}")
+
+
+class NetworkCore:
+    """
+    asyncio event loop, run on its own thread, that owns the UDP video endpoint, the TCP control listener and the
+    control streams of the calls. Its methods may be called from any thread.
+    """
+    def __init__(self):
+        """
+        Constructor. Starts the thread of the event loop
+        """
+        self.loop = asyncio.new_event_loop()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coroutine: Awaitable) -> Future:
+        """
+        Schedules a coroutine on the event loop
+        :param coroutine
+        :return: future with the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call_soon(self, callback: Callable, *args):
+        """
+        Schedules a callback on the event loop
+        :param callback
+        :param args: arguments of the callback
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def open_video_endpoint(self, sock: socket.socket,
+                            on_datagram: Callable[[bytes, Tuple[str, int]], None]) -> asyncio.DatagramTransport:
+        """
+        Hands the UDP video socket over to the event loop. on_datagram is called on the event loop, so it should not
+        block
+        :param sock: bound UDP socket
+        :param on_datagram: callback receiving the data and the address of each datagram
+        :return: transport of the endpoint
+        """
+        transport, _ = self.run(self.loop.create_datagram_endpoint(lambda: _VideoProtocol(on_datagram),
+                                                                   sock=sock)).result()
+        return transport
+
+    def serve_control(self, port: int, handler: Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable]) \
+            -> asyncio.AbstractServer:
+        """
+        Starts the TCP control listener
+        :param port
+        :param handler: coroutine run for each incoming connection
+        :return: the server
+        """
+        return self.run(asyncio.start_server(handler, "0.0.0.0", port, reuse_address=True)).result()
+
+    def open_stream(self, sock: socket.socket) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """
+        Hands a connected TCP socket over to the event loop
+        :param sock
+        :return: reader and writer of the socket
+        """
+        return self.run(asyncio.open_connection(sock=sock)).result()
+
+    def stop(self):
+        """
+        Stops the event loop
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,73 @@
+from threading import Lock
+from time import sleep
+from timeit import default_timer
+from typing import NamedTuple
+
+
+class PacerStatistics(NamedTuple):
+    achieved_fps: float
+    deadline_misses: int  # Ticks skipped because the loop was running late
+    jitter: float  # Average time (in ms) between a deadline and the moment the loop was actually woken
+
+
+class FramePacer:
+    """
+    Paces a loop to a number of frames per second. Tick N is scheduled at start + N / fps on a monotonic clock, so the
+    time spent on every iteration doesn't add up, and if the loop falls behind, the ticks that were missed are skipped
+    instead of being run late one after the other
+    """
+    # Weight of every new sample on the average tick interval and jitter
+    AVERAGE_WEIGHT = 1 / 16
+
+    def __init__(self):
+        """
+        Constructor. The schedule starts on the first tick
+        """
+        self.__mutex = Lock()
+        self.__fps = None
+        self.__start = 0
+        self.__tick = 0
+        self.__last_tick = None
+        self.__average_interval = None
+        self.__deadline_misses = 0
+        self.__jitter = 0
+
+    def wait(self, fps: float):
+        """
+        Blocks until the deadline of the next tick. If the deadline has already passed, it returns right away, skipping
+        the ticks whose deadline passed more than a period ago
+        :param fps: ticks per second. If it changes, the schedule starts again from now
+        """
+        now = default_timer()
+        with self.__mutex:
+            if fps != self.__fps:
+                self.__fps = fps
+                self.__start = now
+                self.__tick = 0
+                self.__average_interval = 1 / fps
+            self.__tick += 1
+            period = 1 / fps
+            deadline = self.__start + self.__tick * period
+            if now >= deadline + period:
+                missed = int((now - deadline) / period)
+                self.__tick += missed
+                self.__deadline_misses += missed
+                deadline += missed * period
+
+        if now < deadline:
+            sleep(deadline - now)
+            now = default_timer()
+
+        with self.__mutex:
+            self.__jitter += (max(now - deadline, 0) * 1000 - self.__jitter) * FramePacer.AVERAGE_WEIGHT
+            if self.__last_tick is not None:
+                self.__average_interval += (now - self.__last_tick - self.__average_interval) * FramePacer.AVERAGE_WEIGHT
+            self.__last_tick = now
+
+    def get_statistics(self) -> PacerStatistics:
+        """
+        :return: the rate actually achieved, the number of deadlines missed and the jitter of the wake ups
+        """
+        with self.__mutex:
+            achieved_fps = 1 / self.__average_interval if self.__average_interval else 0
+            return PacerStatistics(achieved_fps, self.__deadline_misses, self.__jitter)
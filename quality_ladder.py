@@ -0,0 +1,112 @@
+from threading import Lock
+from timeit import default_timer
+from typing import List, NamedTuple, Optional
+
+from logger import get_logger
+
+
+class QualityRung(NamedTuple):
+    name: str
+    width: int
+    height: int
+    jpeg_quality: int
+    fps: float  # Maximum frames per second sent
+
+
+class QualityLadder:
+    """
+    Set of video qualities (rungs) the sender moves through depending on the congestion of the network. Every
+    congestion signal steps one rung down (at most once every STEP_DOWN_INTERVAL seconds). The ladder only steps one
+    rung up once the video has been reported healthy (see report_health) without interruption for some time, and as
+    long as the last report is at most HEALTH_TIMEOUT seconds old (so it does not climb on an idle link). If congestion
+    shows up again right after stepping up, the time needed to step up doubles, so the ladder does not keep bouncing
+    between two rungs.
+    """
+    RUNGS: List[QualityRung] = [
+        QualityRung("Minimum", 160, 120, 40, 10),
+        QualityRung("Low", 320, 240, 40, 15),
+        QualityRung("Medium", 320, 240, 60, 30),
+        QualityRung("High", 640, 480, 50, 30),
+        QualityRung("Best", 640, 480, 75, 30),
+    ]
+    INITIAL_RUNG = 3
+    STEP_DOWN_INTERVAL = 2
+    MIN_STEP_UP_INTERVAL = 10
+    MAX_STEP_UP_INTERVAL = 120
+    HEALTH_TIMEOUT = 3
+
+    def __init__(self):
+        """
+        Constructor. The ladder starts at INITIAL_RUNG
+        """
+        self.__mutex = Lock()
+        self.__rung = QualityLadder.INITIAL_RUNG
+        self.__last_change = default_timer()
+        self.__last_step_up = None
+        self.__step_up_interval = QualityLadder.MIN_STEP_UP_INTERVAL
+        # Moment since which every health report has been healthy (None if the last one was not), and moment of the
+        # last report
+        self.__healthy_since: Optional[float] = None
+        self.__last_health_report: Optional[float] = None
+
+    def report_health(self, healthy: bool):
+        """
+        Tells the ladder how the video is doing (e.g. whether the quality of the buffer is high and there is almost no
+        loss). Only healthy video lets the ladder step up
+        :param healthy
+        """
+        with self.__mutex:
+            now = default_timer()
+            self.__last_health_report = now
+            if not healthy:
+                self.__healthy_since = None
+            elif self.__healthy_since is None:
+                self.__healthy_since = now
+
+    def current(self) -> QualityRung:
+        """
+        :return: the rung that should be used now. The ladder steps up if the video has been healthy (and there has been
+                 no congestion) for long enough
+        """
+        with self.__mutex:
+            now = default_timer()
+            if self.__rung < len(QualityLadder.RUNGS) - 1 and self.__healthy_since is not None and \
+                    now - self.__last_health_report <= QualityLadder.HEALTH_TIMEOUT and \
+                    now - max(self.__last_change, self.__healthy_since) > self.__step_up_interval:
+                self.__rung += 1
+                self.__last_change = self.__last_step_up = now
+                get_logger().info(f"Video quality stepped up to {QualityLadder.RUNGS[self.__rung].name}")
+            return QualityLadder.RUNGS[self.__rung]
+
+    def step_down(self):
+        """
+        Notifies the ladder that congestion has been detected
+        """
+        with self.__mutex:
+            now = default_timer()
+            if now - self.__last_change < QualityLadder.STEP_DOWN_INTERVAL:
+                return
+
+            if self.__last_step_up is not None and now - self.__last_step_up < self.__step_up_interval:
+                # The last step up was too optimistic
+                self.__step_up_interval = min(self.__step_up_interval * 2, QualityLadder.MAX_STEP_UP_INTERVAL)
+            else:
+                self.__step_up_interval = QualityLadder.MIN_STEP_UP_INTERVAL
+            self.__last_step_up = None
+            self.__last_change = now
+            self.__healthy_since = None
+            if self.__rung > 0:
+                self.__rung -= 1
+                get_logger().info(f"Video quality stepped down to {QualityLadder.RUNGS[self.__rung].name}")
+
+    def reset(self):
+        """
+        Goes back to the initial rung (for instance, when a call ends)
+        """
+        with self.__mutex:
+            self.__rung = QualityLadder.INITIAL_RUNG
+            self.__last_change = default_timer()
+            self.__last_step_up = None
+            self.__step_up_interval = QualityLadder.MIN_STEP_UP_INTERVAL
+            self.__healthy_since = None
+            self.__last_health_report = None
@@ -1,50 +1,28 @@
-import queue
-import socket
 import argparse
-from enum import Enum, auto
 from os import _exit, getcwd
-from queue import Queue
-from threading import Thread, Semaphore, Lock
-from time import sleep
-from timeit import default_timer
 
-import cv2
 import numpy as np
 from PIL import Image, ImageTk
 from appJar import gui
 from appJar.appjar import ItemLookupError
 
-from call_control import CallControl
-from configuration import Configuration, ConfigurationStatus
-from discovery_server import list_users
-from udp_helper import UDPBuffer, udp_datagram_from_msg, UDPDatagram, BufferQuality
-from user import CurrentUser
+from configuration import ConfigurationStatus
+from discovery_server import get_user_directory
+from gui_updater import GuiUpdater
+from instrumentation import get_instrumentation, install_dump_signal
 from logger import get_logger, set_logger
-
-MAX_DATAGRAM_SIZE = 65_507
-
-
-class CaptureMode(Enum):
-    # The video is provided by a webcam (video0 by default)
-    CAMERA = auto()
-    # The video is provided by a file
-    FILE = auto()
-    # There's no video, just an image showing that there's no webcam (on video0)
-    NO_CAMERA = auto()
+from media_pipeline import MediaPipeline, ReceiveMode, NetworkMode
+from metrics import MetricsExporter
+from user import CurrentUser
+from video_renderer import VideoRenderer
 
 
-class VideoClient:
-    APP_NAME = "Samtale"
+class VideoClient(MediaPipeline):
+    """
+    The media pipeline with an appJar GUI to control the calls and show the video
+    """
     APP_WIDTH = 850
     APP_HEIGHT = 550
-    VIDEO_WIDTH = 640
-    VIDEO_HEIGHT = 480
-
-    # On V1+, the CALL_CONGESTED message will be sent at most once every CONGEST_INTERVAL seconds
-    CONGESTED_INTERVAL = 30
-    # On NO_CAMERA mode, the static image will be set NO_CAMERA_FPS per second
-    NO_CAMERA_FPS = 30
-    NO_CAMERA_IMAGE = "no_camera.bmp"
 
     # Widgets
     SUBMIT_BUTTON = "Submit"
@@ -66,46 +44,28 @@ class VideoClient:
     VIDEO_WIDGET_NAME = "video"
     USER_SELECTOR_WIDGET = "USER_SELECTOR_WIDGET"
 
-    def __init__(self):
+    def __init__(self, receive_mode: ReceiveMode = ReceiveMode.ZERO_COPY, receive_buffer_size: int = None,
+                 network_mode: NetworkMode = NetworkMode.THREADS):
         """
         Initializes the GUI, reads the configuration and creates the necessary threads and sockets
+        :param receive_mode: how datagrams are received from the UDP socket. Ignored in NetworkMode.ASYNCIO, where the
+                             event loop receives them
+        :param receive_buffer_size: size (in bytes) of the SO_RCVBUF of the UDP socket. If not specified, the default
+                                    one of the system is kept
+        :param network_mode: whether the sockets are handled by threads or by an asyncio event loop
         """
+        super().__init__(receive_mode, receive_buffer_size, network_mode)
         self.gui = gui(VideoClient.APP_NAME, f"{VideoClient.APP_WIDTH}x{VideoClient.APP_HEIGHT}", handleArgs=False)
         self.gui.setLogLevel("WARNING")
         self.gui.setResizable(False)
         self.gui.setGuiPadding(5)
 
-        self.configuration = Configuration()
-
-        # The extreme compression mode will be activated when congestion has been detected
-        self.extreme_compression = False
-
-        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if self.configuration.status == ConfigurationStatus.LOADED:
-            self.receive_socket.bind(("0.0.0.0", CurrentUser().udp_port))
-
-        # Select capturing mode
-        self.capture_lock = Lock()
-        self.capture_mode = CaptureMode.CAMERA
-        # This will only be used in CaptureMode.VIDEO
-        self.video_current_frame = 0
-
-        self.capture = cv2.VideoCapture(0)
-        self.no_camera = cv2.imread(VideoClient.NO_CAMERA_IMAGE)
-        if not self.capture.isOpened():
-            get_logger().info("No camera mode enabled")
-            self.capture_mode = CaptureMode.NO_CAMERA
-            self.fps = VideoClient.NO_CAMERA_FPS
-        else:
-            get_logger().info("Camera mode enabled")
-            self.fps = int(self.capture.get(cv2.CAP_PROP_FPS))
-
         # Add widgets
-        self.last_local_frame = cv2.cvtColor(self.get_frame(), cv2.COLOR_BGR2RGB)
-        self.last_remote_frame = None
-        self.gui.addImageData(VideoClient.VIDEO_WIDGET_NAME,
-                              VideoClient.get_image(self.last_local_frame),
+        # Frames are rendered into preallocated arrays, and then pasted on the same PhotoImage
+        self.renderer = VideoRenderer(VideoClient.VIDEO_WIDTH, VideoClient.VIDEO_HEIGHT)
+        self.last_local_frame = self.renderer.render_local(self.get_frame()[0])
+        self.video_image = VideoClient.get_image(self.last_local_frame)
+        self.gui.addImageData(VideoClient.VIDEO_WIDGET_NAME, self.video_image,
                               fmt="PhotoImage", row=0, column=1, rowspan=2)
         self.gui.addButtons([VideoClient.CONNECT_BUTTON,
                              VideoClient.SELECT_VIDEO_BUTTON,
@@ -116,94 +76,34 @@ class VideoClient:
         if self.configuration.status == ConfigurationStatus.LOADED:
             self.gui.setButton(VideoClient.REGISTER_BUTTON, CurrentUser().nick)
 
-        self.users = {user.nick: user for user in list_users()}
-        nicks = list(self.users.keys())
+        # The last known users are suggested at once, and updated once the directory is refreshed
+        self.user_directory = get_user_directory()
+        self.user_directory.load_snapshot()
+        nicks = self.user_directory.nicks()
         self.gui.setStretch("column")
         self.gui.setSticky("nw")
         self.gui.addLabel(VideoClient.TYPE_NICKNAME_LABEL, VideoClient.TYPE_NICKNAME_LABEL, row=0, column=0)
         self.gui.setStretch("both")
         self.gui.setSticky("new")
         self.gui.addAutoEntry(VideoClient.USER_SELECTOR_WIDGET, nicks, row=1, column=0)
-        self.gui.addStatusbar(fields=4)
+        self.gui.addStatusbar(fields=6)
         self.gui.setStatusbar("Call Quality: N/A", 0)
         self.gui.setStatusbar("Packages lost: N/A", 1)
         self.gui.setStatusbar("Delay avg: N/A", 2)
         self.gui.setStatusbar("Jitter: N/A", 3)
+        self.gui.setStatusbar("Buffer: N/A", 4)
+        self.gui.setStatusbar("Sending: N/A", 5)
+        # The video widget and the status bar are updated from the visualization thread through the GUI thread
+        self.gui_updater = GuiUpdater(self.gui, self.video_image, VideoClient.VIDEO_WIDTH, VideoClient.VIDEO_HEIGHT)
+        self.user_directory.add_listener(
+            lambda nicks: self.gui_updater.update_auto_entry(VideoClient.USER_SELECTOR_WIDGET, nicks))
+        self.user_directory.start()
 
-        # Initialize threads
-        start_control_thread = self.configuration.status == ConfigurationStatus.LOADED
-        self.call_control = CallControl(self, start_control_thread)
-        self.video_semaphore = Semaphore()
-        self.camera_buffer = Queue()
-        self.udp_buffer = UDPBuffer(self.video_semaphore)
-        self.receiving_thread = Thread(target=self.receive_video, daemon=True)
-        self.capture_thread = Thread(target=self.capture_and_send_video, daemon=True)
-        self.visualization_thread = Thread(target=self.display_video, daemon=True)
-        self.receiving_thread.start()
-        self.capture_thread.start()
-        self.visualization_thread.start()
+        self.start_pipeline()
 
         # Set end function to hung up call if X button is pressed
         self.gui.setStopFunction(self.stop)
 
-    def receive_video(self):
-        """
-        This function will receive data from the UDP socket. After checking that the video should indeed flow
-        (a not-that-good-programmed client might send us video even if the video is on pause), it inserts the datagram
-        into the UDPBuffer. This function is meant to be run on a separate thread.
-        """
-        while True:
-            data, addr = self.receive_socket.recvfrom(MAX_DATAGRAM_SIZE)
-            if self.call_control.should_video_flow() and addr[0] == self.call_control.get_send_address()[0]:
-                udp_datagram = udp_datagram_from_msg(data)
-                self.udp_buffer.insert(udp_datagram)
-
-    def capture_and_send_video(self):
-        """
-        This function will capture video from the preferred source (webcam, file or static image), insert it into a
-        queue (so the visualization thread can play it) and send it to the other end in the case that we are in a call
-        and the video should flow. This function is meant to be run on a separate thread.
-        """
-        while True:
-            # Fetch webcam frame
-            local_frame = self.get_frame()
-            # Notify visualization thread
-            self.camera_buffer.put(local_frame)
-            self.video_semaphore.release()
-            # Compress local frame to send it via the socket
-            if self.call_control.should_video_flow():
-                if self.extreme_compression:
-                    # If the connection quality is not that good, we shrink the image that we'll send
-                    video_width = VideoClient.VIDEO_WIDTH // 2
-                    video_height = VideoClient.VIDEO_HEIGHT // 2
-                    local_frame = cv2.resize(local_frame, (video_width, video_height))
-                else:
-                    video_width = VideoClient.VIDEO_WIDTH
-                    video_height = VideoClient.VIDEO_HEIGHT
-
-                success, compressed_local_frame = cv2.imencode(".jpg", local_frame, [cv2.IMWRITE_JPEG_QUALITY, 50])
-                if not success:
-                    get_logger().error("Error compressing a frame")
-                    sleep(1 / self.fps)
-                    continue
-                compressed_local_frame = compressed_local_frame.tobytes()
-                sequence_number = self.call_control.get_sequence_number()
-                if sequence_number < 0:
-                    continue
-
-                udp_datagram = UDPDatagram(sequence_number,
-                                           f"{video_width}x{video_height}",
-                                           self.fps,
-                                           compressed_local_frame).encode()
-
-                assert (len(udp_datagram) <= MAX_DATAGRAM_SIZE)
-
-                address = self.call_control.get_send_address()
-                if address:
-                    self.send_socket.sendto(udp_datagram, address)
-
-            sleep(1 / self.fps)
-
     def start(self):
         """
         Runs the GUI. This function won't return until the X is pressed
@@ -217,43 +117,12 @@ class VideoClient:
         """
         get_logger().info(f"Closing {VideoClient.APP_NAME}")
 
-        if self.call_control.in_call():
-            self.call_control.call_end()
-        # Close sockets
-        if self.call_control.control_socket is not None:
-            self.call_control.control_socket.close()
-        self.send_socket.close()
-        self.receive_socket.close()
+        self.user_directory.stop()
+        self.stop_pipeline()
+        get_logger().debug(f"GUI updates: {self.gui_updater.get_statistics()}")
 
         return True
 
-    def get_frame(self):
-        """
-        Captures a frame using the selected capture mode.
-        :return:
-        """
-        with self.capture_lock:
-            if self.capture_mode == CaptureMode.NO_CAMERA:
-                frame = self.no_camera
-            else:
-                success, frame = self.capture.read()
-                if not success:
-                    frame = self.no_camera
-                else:
-                    if self.capture_mode == CaptureMode.CAMERA:
-                        # Flip the image so it has the natural orientation
-                        frame = cv2.flip(frame, 1)
-                    elif self.capture_mode == CaptureMode.FILE:
-                        # Update the current video frame number
-                        self.video_current_frame += 1
-
-                        # If the reached the end of the video file, we'll start back again
-                        if self.video_current_frame == self.capture.get(cv2.CAP_PROP_FRAME_COUNT):
-                            self.video_current_frame = 0
-                            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
-
-            return cv2.resize(frame, (VideoClient.VIDEO_WIDTH, VideoClient.VIDEO_HEIGHT), interpolation=cv2.INTER_AREA)
-
     @staticmethod
     def get_image(frame):
         """
@@ -262,17 +131,17 @@ class VideoClient:
         """
         return ImageTk.PhotoImage(Image.fromarray(frame))
 
-    def display_frame(self, frame):
+    def display_frame(self, frame: np.ndarray):
         """
-        Displays the frame on the GUI
-        :param frame: a frame returned by the get_frame function
+        Displays the frame on the GUI on its next refresh (the image of the video widget is updated in place)
+        :param frame: a frame returned by the renderer (with the size of the video)
         """
-        self.gui.setImageData(VideoClient.VIDEO_WIDGET_NAME, self.get_image(frame), fmt="PhotoImage")
+        self.gui_updater.update_frame(frame)
 
     def display_video(self):
         """
         This function is meant to run on a separate thread. It will block until someone wakes it (the capture_video
-        thread or the waker thread). Two "frozen" frames are stored, one for the local one and one for the remote one.
+        thread or the playout clock). Two "frozen" frames are stored, one for the local one and one for the remote one.
         If data cannot be consumed from the local video feed or from the UDPBuffer, a frozen frame will be shown. If
         we are in a call, our image will be shown in a small rectangle at the bottom right (with 1/16th of the original
         area). It will also check if the buffer quality is bad in order to take measures (which will vary of with the
@@ -280,58 +149,61 @@ class VideoClient:
         """
         # Do first acquire so next one is blocking
         self.video_semaphore.acquire()
-        last_congested = 0
         while True:
             self.video_semaphore.acquire()
-            # Fetch webcam frame
-            try:
-                local_frame = cv2.cvtColor(self.camera_buffer.get(block=False), cv2.COLOR_BGR2RGB)
-                self.last_local_frame = local_frame
-            except queue.Empty:
-                local_frame = self.last_local_frame
-            # Fetch remote frame
-            remote_frame = self.udp_buffer.consume()
-            quality, packages_lost, delay_avg, jitter = self.udp_buffer.get_statistics()
-            # If we are using V0, decrease our video quality (assuming that the connection is symmetric)
-            # If V1 (or higher) is used, we will send a CALL_CONGESTED to the other end
-            if self.call_control.in_call() and quality < BufferQuality.MEDIUM:
-                if self.call_control.protocol == "V0":
-                    self.extreme_compression = True
+            with MediaPipeline.DISPLAY_TIMER:
+                # Fetch webcam frame
+                local_frame = self.camera_buffer.take()
+                new_local_frame = local_frame is not None
+                if new_local_frame:
+                    local_frame = self.renderer.render_local(local_frame)
+                    self.last_local_frame = local_frame
                 else:
-                    now = default_timer()
-                    if now - last_congested > VideoClient.CONGESTED_INTERVAL:
-                        last_congested = now
-                        self.call_control.call_congested()
-            else:
-                self.extreme_compression = False
-
-            if not remote_frame and self.call_control.in_call():
-                remote_frame = self.last_remote_frame
-            # Show local (and remote) frame
-            if remote_frame:
-                self.last_remote_frame = remote_frame
-                remote_frame = np.frombuffer(remote_frame, np.uint8)
-                remote_frame = cv2.imdecode(remote_frame, 1)
-                remote_frame = cv2.resize(remote_frame, (VideoClient.VIDEO_WIDTH, VideoClient.VIDEO_HEIGHT))
-                remote_frame = cv2.cvtColor(remote_frame, cv2.COLOR_BGR2RGB)
-                margin = 10
-                mini_frame_width = VideoClient.VIDEO_WIDTH // 4
-                mini_frame_height = VideoClient.VIDEO_HEIGHT // 4
-                mini_frame = cv2.resize(local_frame, (mini_frame_width, mini_frame_height))
-                remote_frame[-mini_frame_height - margin:-margin, -mini_frame_width - margin:-margin] = mini_frame
-
-                self.gui.setStatusbar(f"Call Quality: {quality.name}", 0)
-                self.gui.setStatusbar(f"Packages lost: {packages_lost}", 1)
-                self.gui.setStatusbar(f"Delay avg: {round(delay_avg, ndigits=2)} ms", 2)
-                self.gui.setStatusbar(f"Jitter: {round(jitter, ndigits=2)} ms", 3)
-
-                self.display_frame(remote_frame)
-            elif not remote_frame:
-                self.gui.setStatusbar("Call Quality: N/A", 0)
-                self.gui.setStatusbar("Packages lost: N/A", 1)
-                self.gui.setStatusbar("Delay avg: N/A", 2)
-                self.gui.setStatusbar("Jitter: N/A", 3)
-                self.display_frame(local_frame)
+                    local_frame = self.last_local_frame
+                # Fetch remote frame
+                remote_frame = self.udp_buffer.consume()
+                # Nothing is rendered again if neither frame has changed since the last wake
+                new_remote_frame = bool(remote_frame)
+                new_frame = new_local_frame or new_remote_frame
+                statistics = self.udp_buffer.get_statistics()
+                self.check_congestion(statistics)
+
+                if not remote_frame and self.call_control.in_call():
+                    remote_frame = self.last_remote_frame
+                # Show local (and remote) frame
+                if remote_frame:
+                    self.last_remote_frame = remote_frame
+
+                    self.gui_updater.update_status(f"Call Quality: {statistics.quality.name}", 0)
+                    self.gui_updater.update_status(f"Packages lost: {statistics.packages_lost} "
+                                                   f"({statistics.partial_frames} partial, "
+                                                   f"{statistics.packets_recovered} recovered)", 1)
+                    latency = self.latency_estimate()
+                    if latency is None:
+                        self.gui_updater.update_status(f"Delay avg: {round(statistics.avg_delay, ndigits=2)} ms", 2)
+                    else:
+                        self.gui_updater.update_status(f"Delay: {round(latency.glass_to_glass)} ms glass to glass, "
+                                                       f"RTT {round(latency.rtt)} ms", 2)
+                    self.gui_updater.update_status(f"Jitter: {round(statistics.jitter, ndigits=2)} ms", 3)
+                    self.gui_updater.update_status(f"Buffer: {statistics.depth}/"
+                                                   f"{round(statistics.target_depth, ndigits=1)} frames", 4)
+                    rung = self.quality_ladder.current()
+                    self.gui_updater.update_status(f"Sending: {rung.name} ({rung.width}x{rung.height})", 5)
+
+                    if new_frame:
+                        call_frame = self.renderer.render_call(remote_frame, local_frame)
+                        if call_frame is not None:
+                            self.frames_decoded += new_remote_frame
+                            self.display_frame(call_frame)
+                elif not remote_frame:
+                    self.gui_updater.update_status("Call Quality: N/A", 0)
+                    self.gui_updater.update_status("Packages lost: N/A", 1)
+                    self.gui_updater.update_status("Delay avg: N/A", 2)
+                    self.gui_updater.update_status("Jitter: N/A", 3)
+                    self.gui_updater.update_status("Buffer: N/A", 4)
+                    self.gui_updater.update_status("Sending: N/A", 5)
+                    if new_frame:
+                        self.display_frame(local_frame)
 
     def buttons_callback(self, name: str):
         """
@@ -412,21 +284,24 @@ class VideoClient:
                 self.display_message("Registration needed",
                                      "You have to register again since an error occurred reading the configuration.ini "
                                      "file")
+            elif self.configuration.status == ConfigurationStatus.SERVER_UNAVAILABLE:
+                get_logger().info("Cannot call before registering (the discovery server could not be reached)")
+                self.display_message("Registration needed",
+                                     "You have to register again since the discovery server could not be reached to "
+                                     "check the configuration.ini file")
 
         elif name == VideoClient.SUBMIT_BUTTON:
             persistent = self.gui.getCheckBox(VideoClient.REMEMBER_USER_CHECKBOX)
             private_ip = self.gui.getCheckBox(VideoClient.PRIVATE_IP_CHECKBOX)
-            title, message = self.configuration.load(self.gui.getEntry(VideoClient.NICKNAME_ENTRY),
-                                                     self.gui.getEntry(VideoClient.PASSWORD_ENTRY),
-                                                     int(self.gui.getEntry(VideoClient.TCP_PORT_ENTRY)),
-                                                     int(self.gui.getEntry(VideoClient.UDP_PORT_ENTRY)),
-                                                     persistent=persistent,
-                                                     private_ip=private_ip)
+            title, message = self.register(self.gui.getEntry(VideoClient.NICKNAME_ENTRY),
+                                           self.gui.getEntry(VideoClient.PASSWORD_ENTRY),
+                                           int(self.gui.getEntry(VideoClient.TCP_PORT_ENTRY)),
+                                           int(self.gui.getEntry(VideoClient.UDP_PORT_ENTRY)),
+                                           persistent=persistent,
+                                           private_ip=private_ip)
             self.gui.hideSubWindow(VideoClient.REGISTER_SUBWINDOW)
             self.display_message(title, message)
             if self.configuration.status == ConfigurationStatus.LOADED:
-                self.receive_socket.bind(("0.0.0.0", CurrentUser().udp_port))
-                self.call_control.control_thread.start()
                 self.gui.setButton(VideoClient.REGISTER_BUTTON, CurrentUser().nick)
         elif name == VideoClient.SELECT_VIDEO_BUTTON:
             if self.gui.getButton(VideoClient.SELECT_VIDEO_BUTTON) == VideoClient.SELECT_VIDEO_BUTTON:
@@ -437,38 +312,19 @@ class VideoClient:
                     get_logger().info("No video file selected")
                     return
                 try:
-                    capture = cv2.VideoCapture(ret)
-                    success, _ = capture.read()
-                    if not success:
-                        get_logger().warning(f"Couldn't open {ret} as a video file")
+                    if not self.select_video_file(ret):
                         self.display_message("File not valid",
                                              f"Could't open {ret} as a video file")
                         return
-                    with self.capture_lock:
-                        get_logger().info(f"File {ret} loaded")
-                        self.capture_mode = CaptureMode.FILE
-                        self.capture = capture
-                        self.video_current_frame = 1
-                        self.fps = int(self.capture.get(cv2.CAP_PROP_FPS))
-                        self.gui.setButton(VideoClient.SELECT_VIDEO_BUTTON, VideoClient.CLEAR_VIDEO_BUTTON)
+                    self.gui.setButton(VideoClient.SELECT_VIDEO_BUTTON, VideoClient.CLEAR_VIDEO_BUTTON)
                 except FileNotFoundError as e:
                     print(e)
             else:
                 answer = self.gui.yesNoBox("Clear video",
                                            "Are you sure you want to clear the video?")
                 if answer:
-                    with self.capture_lock:
-                        self.capture = cv2.VideoCapture(0)
-                        if not self.capture.isOpened():
-                            get_logger().info("No camera mode enabled")
-                            self.capture_mode = CaptureMode.NO_CAMERA
-                            self.fps = VideoClient.NO_CAMERA_FPS
-                        else:
-                            get_logger().info("Camera mode enabled")
-                            self.fps = int(self.capture.get(cv2.CAP_PROP_FPS))
-                            self.capture_mode = CaptureMode.CAMERA
-
-                        self.gui.setButton(VideoClient.SELECT_VIDEO_BUTTON, VideoClient.SELECT_VIDEO_BUTTON)
+                    self.select_camera()
+                    self.gui.setButton(VideoClient.SELECT_VIDEO_BUTTON, VideoClient.SELECT_VIDEO_BUTTON)
                 else:
                     get_logger().info("Video was not cleared")
 
@@ -492,15 +348,6 @@ class VideoClient:
         """
         self.gui.infoBox(title, message)
 
-    def flush_buffer(self):
-        """
-        This function will be called when a call ends. It will flush the UDPBuffer and delete the "frozen" remote frame
-        """
-        get_logger().debug("Flushing buffer")
-        del self.udp_buffer
-        self.last_remote_frame = None
-        self.udp_buffer = UDPBuffer(self.video_semaphore)
-
     def display_calling(self, nickname: str):
         """
         This function will be called when calling someone.
@@ -535,9 +382,29 @@ if __name__ == '__main__':
     parser.add_argument('-log_level', action='store', nargs='?', default='info',
                         choices=['debug', 'info', 'warning', 'error'], required=False,
                         help='Indicate logging level')
+    parser.add_argument('-receive_mode', action='store', nargs='?', default='zero_copy',
+                        choices=['copy', 'zero_copy'], required=False,
+                        help='Indicate how video datagrams are received')
+    parser.add_argument('-network_mode', action='store', nargs='?', default='threads',
+                        choices=['threads', 'asyncio'], required=False,
+                        help='Indicate whether sockets are handled by threads or by an asyncio event loop')
+    parser.add_argument('-rcvbuf', action='store', type=int, default=None, required=False,
+                        help='Indicate the size (in bytes) of the receive buffer of the video socket')
+    parser.add_argument('-metrics_port', action='store', type=int, default=None, required=False,
+                        help='Indicate the local port of an HTTP endpoint that serves the latency metrics')
+    parser.add_argument('-metrics_file', action='store', default=None, required=False,
+                        help='Indicate a JSON file where the latency metrics are written periodically')
+    parser.add_argument('-instrumentation', action='store', nargs='?', default='on', choices=['on', 'off'],
+                        required=False, help='Indicate whether the hot paths are timed (dumped to the log on SIGUSR1)')
 
     args = parser.parse_args()
 
     set_logger(args)
-    VideoClient().start()
+    get_instrumentation().enabled = args.instrumentation == 'on'
+    install_dump_signal()
+    metrics_exporter = MetricsExporter(port=args.metrics_port, path=args.metrics_file)
+    metrics_exporter.start()
+    VideoClient(receive_mode=ReceiveMode[args.receive_mode.upper()], receive_buffer_size=args.rcvbuf,
+                network_mode=NetworkMode[args.network_mode.upper()]).start()
+    metrics_exporter.stop()
     _exit(0)
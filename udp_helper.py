@@ -1,61 +1,296 @@
-from time import sleep, time
+import struct
+from time import time
 from timeit import default_timer
-from typing import Tuple
+from typing import Dict, List, NamedTuple, Optional, Union
 from functools import total_ordering
 from enum import Enum, auto
-from threading import Lock, Semaphore, Thread
+from threading import Condition, Lock, Semaphore, Thread
 
+from instrumentation import timed
 from logger import get_logger
+from metrics import get_metrics
+
+# Wall-clock time when the module was loaded, minus the monotonic time back then
+_STEADY_TIME_BASE = time() - default_timer()
+
+
+def steady_time() -> float:
+    """
+    :return: seconds since the epoch, like time.time(), but advancing with the monotonic clock. It does not jump when
+             the wall clock is stepped (e.g. by NTP), so differences between two timestamps of the same machine are
+             always right. Timestamps of the video and of the round trip probe are taken with it
+    """
+    return _STEADY_TIME_BASE + default_timer()
 
 
 class UDPDatagram:
-    def __init__(self, seq_number: int, resolution: str, fps: float, data: bytes, ts: float = None):
+    # V2+ header: magic, flags, sequence number, timestamp, width, height, fps. Since it has a fixed size, it is packed
+    # and parsed in constant time, no matter how big the payload is
+    BINARY_HEADER = struct.Struct("!BBIdHHf")
+    # First byte of every V2+ datagram. V0/V1 datagrams start with an ASCII digit, so both formats can be told apart
+    BINARY_MAGIC = 0xB2
+    # The ASCII header (V0/V1) is searched only in the first MAX_ASCII_HEADER bytes of the message
+    MAX_ASCII_HEADER = 128
+    # Flags of the binary header
+    FLAG_FRAGMENT = 0x01  # The datagram carries a fragment of a frame, and it is followed by the FRAGMENT_HEADER
+    FLAG_PARITY = 0x02  # (V3+) The datagram carries the parity of a group of fragments, followed by the PARITY_HEADER
+    # Fragment header: fragment index, fragment count. Parity datagrams set the index to the first one of the group
+    FRAGMENT_HEADER = struct.Struct("!HH")
+    # Parity header (after the fragment header): number of fragments in the group, XOR of their lengths
+    PARITY_HEADER = struct.Struct("!HH")
+    # Maximum size of each packet when a frame is split into fragments, so they are not fragmented at IP level
+    PACKET_SIZE = 1200
+
+    __slots__ = ("seq_number", "sent_ts", "resolution", "fps", "data", "flags", "fragment_index", "fragment_count",
+                 "parity_group_size", "parity_length", "received_ts", "delay_ts", "__buffer", "__pool")
+
+    def __init__(self, seq_number: int, resolution: str, fps: float, data: Union[bytes, memoryview], ts: float = None,
+                 flags: int = 0, fragment_index: int = 0, fragment_count: int = 1, parity_group_size: int = 0,
+                 parity_length: int = 0):
         """
         Constructor
         :param seq_number
         :param resolution
         :param fps
-        :param data
-        :param ts: timestamp. If not specified, it will be set to time.time()
+        :param data: payload. It may be a memoryview of a buffer taken from a DatagramPool (see set_buffer)
+        :param ts: timestamp (moment the frame was captured). If not specified, it will be set to steady_time()
+        :param flags: bit field of the binary header (V2+). Ignored by the ASCII header
+        :param fragment_index: if the datagram is a fragment of a frame (FLAG_FRAGMENT), its position in the frame
+        :param fragment_count: number of fragments the frame has been split into
+        :param parity_group_size: if the datagram is a parity one (FLAG_PARITY), number of fragments it protects
+        :param parity_length: if the datagram is a parity one, XOR of the lengths of the fragments it protects
         """
         self.seq_number = seq_number
-        self.sent_ts = ts if ts is not None else time()
+        self.sent_ts = ts if ts is not None else steady_time()
         self.resolution = resolution
         self.fps = fps
         self.data = data
+        self.flags = flags
+        self.fragment_index = fragment_index
+        self.fragment_count = fragment_count
+        self.parity_group_size = parity_group_size
+        self.parity_length = parity_length
         self.received_ts = -1
-        self.delay_ts = -1  # Measured in ms
+        self.delay_ts = -1  # Measured in ms, from the capture of the frame until it is received
+        # Receive buffer backing data, if it was taken from a pool
+        self.__buffer = None
+        self.__pool = None
+
+    def set_buffer(self, buffer: bytearray, pool: "DatagramPool"):
+        """
+        Sets the pooled buffer that backs the data of the datagram, so it can be given back with release
+        :param buffer
+        :param pool: pool the buffer was acquired from
+        """
+        self.__buffer = buffer
+        self.__pool = pool
 
-    def set_received_time(self):
+    def release(self):
+        """
+        Returns the buffer backing the data to its pool (if any). The data must not be used after calling this method
+        """
+        if self.__pool is not None:
+            self.__pool.release(self.__buffer)
+            self.__buffer = None
+            self.__pool = None
+
+    def detach(self):
+        """
+        Copies the data out of the pooled buffer backing it (if any) and gives the buffer back to its pool, so the
+        datagram can be held for long without keeping a whole receive buffer
+        """
+        if self.__pool is not None:
+            self.data = bytes(self.data)
+            self.release()
+
+    def set_received_time(self, clock_offset: float = 0):
         """
         Sets received time and computes datagram delay
+        :param clock_offset: seconds the clock of the sender is ahead of the local one. If it's not known (0), the delay
+                             is only right if both clocks are in sync
         """
-        self.received_ts = time()
-        self.delay_ts = (self.received_ts - self.sent_ts) * 1000
+        self.received_ts = steady_time()
+        self.delay_ts = (self.received_ts - self.sent_ts + clock_offset) * 1000
 
     def __str__(self):
-        return f"{self.seq_number}#{self.sent_ts}#{self.resolution}#{self.fps}#" + self.data.decode()
+        return f"{self.seq_number}#{self.sent_ts}#{self.resolution}#{self.fps}#" + bytes(self.data).decode()
+
+    def encode(self, binary: bool = False) -> bytes:
+        """
+        :param binary: if True, the packed binary header (V2+) is used. If not, the ASCII one (V0/V1)
+        :return: the datagram ready to be sent
+        """
+        if binary:
+            width, height = self.resolution.split('x')
+            header = UDPDatagram.BINARY_HEADER.pack(UDPDatagram.BINARY_MAGIC, self.flags, self.seq_number, self.sent_ts,
+                                                    int(width), int(height), self.fps)
+            if self.flags & UDPDatagram.FLAG_FRAGMENT:
+                header += UDPDatagram.FRAGMENT_HEADER.pack(self.fragment_index, self.fragment_count)
+            if self.flags & UDPDatagram.FLAG_PARITY:
+                header += UDPDatagram.PARITY_HEADER.pack(self.parity_group_size, self.parity_length)
+            return header + self.data
 
-    def encode(self) -> bytes:
         return f"{self.seq_number}#{self.sent_ts}#{self.resolution}#{self.fps}#".encode() + self.data
 
+    def fragment(self, always: bool = False) -> List["UDPDatagram"]:
+        """
+        Splits the datagram into fragments that fit in UDPDatagram.PACKET_SIZE bytes once encoded with the binary header
+        (V2+)
+        :param always: if False and the datagram already fits, it is returned as is. If True, it is returned as a single
+                       fragment (so parity datagrams can be built for it)
+        :return: list of datagrams, one per fragment
+        """
+        max_payload = UDPDatagram.PACKET_SIZE - UDPDatagram.BINARY_HEADER.size - UDPDatagram.FRAGMENT_HEADER.size
+        if not always and len(self.data) <= UDPDatagram.PACKET_SIZE - UDPDatagram.BINARY_HEADER.size:
+            return [self]
+
+        data = memoryview(self.data)
+        fragment_count = max((len(data) + max_payload - 1) // max_payload, 1)
+        return [UDPDatagram(self.seq_number, self.resolution, self.fps, data[i * max_payload:(i + 1) * max_payload],
+                            ts=self.sent_ts, flags=self.flags | UDPDatagram.FLAG_FRAGMENT, fragment_index=i,
+                            fragment_count=fragment_count)
+                for i in range(fragment_count)]
+
 
-def udp_datagram_from_msg(message: bytes) -> UDPDatagram:
+def udp_datagram_from_msg(message: Union[bytes, memoryview]) -> Optional[UDPDatagram]:
     """
-    Builds a UDPDatagram object from a message
+    Builds a UDPDatagram object from a message, which may use either the binary (V2+) or the ASCII (V0/V1) header.
+    If message is a memoryview, the data of the datagram will be a slice of it (so no copy is made)
     :param message
-    :return: UDPDatagram object built
+    :return: UDPDatagram object built, or None if the message is malformed
     """
+    if not message:
+        return None
+
+    if message[0] == UDPDatagram.BINARY_MAGIC:
+        if len(message) < UDPDatagram.BINARY_HEADER.size:
+            return None
+        _, flags, seq_number, ts, width, height, fps = UDPDatagram.BINARY_HEADER.unpack_from(message)
+        data_start = UDPDatagram.BINARY_HEADER.size
+        fragment_index, fragment_count = 0, 1
+        if flags & UDPDatagram.FLAG_FRAGMENT:
+            if len(message) < data_start + UDPDatagram.FRAGMENT_HEADER.size:
+                return None
+            fragment_index, fragment_count = UDPDatagram.FRAGMENT_HEADER.unpack_from(message, data_start)
+            data_start += UDPDatagram.FRAGMENT_HEADER.size
+            if fragment_index >= fragment_count:
+                return None
+        parity_group_size, parity_length = 0, 0
+        if flags & UDPDatagram.FLAG_PARITY:
+            if not flags & UDPDatagram.FLAG_FRAGMENT or len(message) < data_start + UDPDatagram.PARITY_HEADER.size:
+                return None
+            parity_group_size, parity_length = UDPDatagram.PARITY_HEADER.unpack_from(message, data_start)
+            data_start += UDPDatagram.PARITY_HEADER.size
+            if parity_group_size == 0:
+                return None
+        return UDPDatagram(seq_number=seq_number, ts=ts, resolution=f"{width}x{height}", fps=fps,
+                           data=message[data_start:], flags=flags, fragment_index=fragment_index,
+                           fragment_count=fragment_count, parity_group_size=parity_group_size,
+                           parity_length=parity_length)
+
     # Find the fourth '#' to split the message (we cannot use split because the binary data could contain '#')
-    count = 0
-    for index, c in enumerate(map(chr, message)):
-        if c == '#':
-            count += 1
-            if count == 4:
-                fields = message[:index].decode().split('#')
-                data = message[index + 1:]
-                return UDPDatagram(seq_number=int(fields[0]), ts=float(fields[1]), resolution=fields[2],
-                                   fps=float(fields[3]), data=data)
+    header = bytes(message[:UDPDatagram.MAX_ASCII_HEADER])
+    index = -1
+    for _ in range(4):
+        index = header.find(b'#', index + 1)
+        if index < 0:
+            return None
+
+    try:
+        fields = header[:index].decode().split('#')
+        return UDPDatagram(seq_number=int(fields[0]), ts=float(fields[1]), resolution=fields[2],
+                           fps=float(fields[3]), data=message[index + 1:])
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+def _xor(datas: List[Union[bytes, memoryview]]) -> bytes:
+    """
+    :param datas: byte strings, which may have different lengths
+    :return: XOR of all of them, as if the shorter ones were padded with zeros at the end
+    """
+    length = max(len(data) for data in datas)
+    result = 0
+    for data in datas:
+        # Little endian, so padding at the end does not change the value
+        result ^= int.from_bytes(data, "little")
+    return result.to_bytes(length, "little")
+
+
+# Forward error correction (V3+): each parity datagram is the XOR of a group of fragments of a frame, so any single
+# fragment lost in the group can be recovered. Groups are sized so that FEC_LOSS_TARGET packets are expected to be lost
+# per group, according to the measured loss rate
+FEC_MIN_GROUP_SIZE = 2
+FEC_MAX_GROUP_SIZE = 16
+FEC_LOSS_TARGET = 0.1
+
+
+def fec_group_size(loss_rate: float) -> int:
+    """
+    :param loss_rate: fraction of packets lost
+    :return: number of fragments protected by each parity datagram
+    """
+    if loss_rate <= FEC_LOSS_TARGET / FEC_MAX_GROUP_SIZE:
+        return FEC_MAX_GROUP_SIZE
+    return min(max(int(FEC_LOSS_TARGET / loss_rate), FEC_MIN_GROUP_SIZE), FEC_MAX_GROUP_SIZE)
+
+
+def add_parity(fragments: List[UDPDatagram], group_size: int) -> List[UDPDatagram]:
+    """
+    Builds the parity datagrams of the fragments of a frame
+    :param fragments: fragments of a frame (as returned by UDPDatagram.fragment(always=True))
+    :param group_size: number of fragments protected by each parity datagram
+    :return: the fragments, with the parity datagram of each group right after the group
+    """
+    datagrams = []
+    for start in range(0, len(fragments), group_size):
+        group = fragments[start:start + group_size]
+        datagrams.extend(group)
+        first = group[0]
+        parity_length = 0
+        for fragment in group:
+            parity_length ^= len(fragment.data)
+        datagrams.append(UDPDatagram(first.seq_number, first.resolution, first.fps,
+                                     _xor([fragment.data for fragment in group]), ts=first.sent_ts,
+                                     flags=first.flags | UDPDatagram.FLAG_FRAGMENT | UDPDatagram.FLAG_PARITY,
+                                     fragment_index=start, fragment_count=first.fragment_count,
+                                     parity_group_size=len(group), parity_length=parity_length))
+    return datagrams
+
+
+class DatagramPool:
+    """
+    Pool of preallocated receive buffers. Datagrams are received into them with recvfrom_into, so no new bytes object
+    has to be allocated per datagram. Buffers should be given back (see UDPDatagram.release) when no longer needed.
+    """
+    def __init__(self, buffer_size: int, max_buffers: int):
+        """
+        Constructor
+        :param buffer_size: size of each buffer (it should fit the biggest datagram expected)
+        :param max_buffers: maximum number of free buffers kept. If the pool runs out of buffers, new ones are allocated
+        """
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.__free = [bytearray(buffer_size) for _ in range(max_buffers)]
+        self.__mutex = Lock()
+
+    def acquire(self) -> bytearray:
+        """
+        :return: a free buffer
+        """
+        with self.__mutex:
+            if self.__free:
+                return self.__free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray):
+        """
+        Gives back a buffer to the pool
+        :param buffer
+        """
+        with self.__mutex:
+            if len(self.__free) < self.max_buffers:
+                self.__free.append(buffer)
 
 
 @total_ordering
@@ -74,101 +309,473 @@ class BufferQuality(Enum):
         return NotImplemented
 
 
+class BufferStatistics(NamedTuple):
+    quality: BufferQuality
+    packages_lost: int
+    avg_delay: float  # Measured in ms, from capture to reception (corrected with the clock offset, if it is known)
+    jitter: float  # Interarrival jitter (RFC 3550), measured in ms
+    partial_frames: int  # Frames dropped with some (but not all) of their fragments received
+    depth: int  # Frames currently in the buffer
+    target_depth: float  # Frames the buffer tries to hold before playing them
+    packets_recovered: int  # Fragments recovered with parity datagrams (V3+)
+    packet_loss_rate: float  # Estimated fraction of packets lost before recovering them
+    highest_seq_number: int  # Highest sequence number received (0 if nothing has been received)
+    buffer_delay: float  # Average time (in ms) frames wait in the buffer until they are played
+
+
+class _PartialFrame:
+    """
+    Fragments received so far of a frame that has been split into several datagrams
+    """
+    __slots__ = ("fragments", "parities", "received", "recovered", "started")
+
+    def __init__(self, fragment_count: int):
+        self.fragments: List[Optional[UDPDatagram]] = [None] * fragment_count
+        # Parity datagrams received, by index of the first fragment of their group
+        self.parities: Dict[int, UDPDatagram] = {}
+        self.received = 0
+        self.recovered = 0
+        self.started = default_timer()
+
+    def recover(self, group_start: int) -> bool:
+        """
+        Recovers the missing fragment of a group, if its parity has been received and only one fragment is missing
+        :param group_start: index of the first fragment of the group
+        :return: True if a fragment has been recovered
+        """
+        parity = self.parities.get(group_start)
+        if parity is None:
+            return False
+
+        group = range(group_start, min(group_start + parity.parity_group_size, len(self.fragments)))
+        missing = [index for index in group if self.fragments[index] is None]
+        if len(missing) != 1:
+            return False
+
+        received = [self.fragments[index] for index in group if index != missing[0]]
+        length = parity.parity_length
+        for fragment in received:
+            length ^= len(fragment.data)
+        data = _xor([parity.data] + [fragment.data for fragment in received])[:length]
+        self.fragments[missing[0]] = UDPDatagram(parity.seq_number, parity.resolution, parity.fps, data,
+                                                 ts=parity.sent_ts,
+                                                 flags=parity.flags & ~UDPDatagram.FLAG_PARITY,
+                                                 fragment_index=missing[0], fragment_count=len(self.fragments))
+        self.received += 1
+        self.recovered += 1
+        return True
+
+    def group_of(self, fragment_index: int) -> Optional[int]:
+        """
+        :param fragment_index
+        :return: index of the first fragment of the group protected by a received parity datagram that contains
+                 fragment_index, or None if there is not such a group
+        """
+        for group_start, parity in self.parities.items():
+            if group_start <= fragment_index < group_start + parity.parity_group_size:
+                return group_start
+        return None
+
+    def release(self):
+        """
+        Gives back the buffers of the fragments and parity datagrams received
+        """
+        for fragment in self.fragments:
+            if fragment is not None:
+                fragment.release()
+        for parity in self.parities.values():
+            parity.release()
+
+
+class ClockStatistics(NamedTuple):
+    ticks: int
+    late_ticks: int  # Ticks that fired more than LATE_TOLERANCE periods after their deadline
+    underruns: int  # Ticks for which the buffer had nothing to play
+
+
+class PlayoutClock:
+    """
+    Long-lived thread that wakes the displayer every time a frame of the remote video should be played. Ticks are
+    scheduled on deadlines computed with a monotonic clock, so the time spent by the displayer does not accumulate.
+    """
+    # A tick that fires more than LATE_TOLERANCE periods after its deadline is late, and the next deadlines are
+    # computed from it (instead of trying to catch up)
+    LATE_TOLERANCE = 0.5
+
+    def __init__(self, display_video_semaphore: Semaphore):
+        """
+        Constructor. The clock does not tick until a period is set with retarget
+        :param display_video_semaphore: semaphore to be released when displayer should consume
+        """
+        self.display_video_semaphore = display_video_semaphore
+        self.__period: Optional[float] = None
+        self.__deadline = 0
+        self.__running = True
+        self.__condition = Condition()
+        self.__ticks = 0
+        self.__late_ticks = 0
+        self.__underruns = 0
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def retarget(self, period: Optional[float]):
+        """
+        Sets the seconds between two ticks, which applies from the next tick on
+        :param period: if None, the clock stops ticking until a new period is set
+        """
+        with self.__condition:
+            if self.__period is None and period is not None:
+                self.__deadline = default_timer() + period
+                self.__condition.notify()
+            self.__period = period
+
+    def report_underrun(self):
+        """
+        Tells the clock that a tick found nothing to be played
+        """
+        with self.__condition:
+            self.__underruns += 1
+
+    def get_statistics(self) -> ClockStatistics:
+        """
+        :return: ticks, late ticks, underruns
+        """
+        with self.__condition:
+            return ClockStatistics(self.__ticks, self.__late_ticks, self.__underruns)
+
+    def stop(self):
+        """
+        Stops the thread of the clock
+        """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+
+    def __run(self):
+        with self.__condition:
+            while self.__running:
+                if self.__period is None:
+                    self.__condition.wait()
+                    continue
+
+                now = default_timer()
+                if now < self.__deadline:
+                    self.__condition.wait(self.__deadline - now)
+                    continue
+
+                self.display_video_semaphore.release()
+                self.__ticks += 1
+                if now - self.__deadline > PlayoutClock.LATE_TOLERANCE * self.__period:
+                    self.__late_ticks += 1
+                    self.__deadline = now + self.__period
+                else:
+                    self.__deadline += self.__period
+
+
 class UDPBuffer:
     MINIMUM_INITIAL_FRAMES = 5
     U = 0.01
     BUFFER_MAX = 5
     CONSUME_SPEEDUP = 1.5
-
-    def __init__(self, display_video_semaphore: Semaphore):
+    # Seconds a frame may wait for its missing fragments before being dropped
+    REASSEMBLY_TIMEOUT = 0.5
+    # Number of slots of the ring. Datagrams more than RING_CAPACITY sequence numbers ahead of the oldest one buffered
+    # make the buffer skip forward
+    RING_CAPACITY = 256
+    # Adaptive playout delay: the target depth covers JITTER_MARGIN times the jitter, plus LOSS_MARGIN frames per unit
+    # of loss rate (late fragments and reordering come along with loss). It grows fast and shrinks slowly
+    INITIAL_TARGET_FRAMES = 2
+    MIN_TARGET_FRAMES = 1
+    MAX_TARGET_FRAMES = 30
+    JITTER_MARGIN = 3
+    LOSS_MARGIN = 20
+    TARGET_GROW = 0.2
+    TARGET_SHRINK = 0.01
+    LOSS_U = 0.05
+    # Consumption is slowed down by this factor when the buffer is below the target depth
+    CONSUME_SLOWDOWN = 1.25
+    # Gain of the interarrival jitter estimator (RFC 3550, section 6.4.1)
+    JITTER_GAIN = 1 / 16
+
+    def __init__(self, playout_clock: PlayoutClock, adaptive: bool = False):
         """
         Constructor
-        :param display_video_semaphore: semaphore to be released when displayer should consume
+        :param playout_clock: clock that wakes the displayer. It is retargeted to the pace the buffer should be consumed
+        :param adaptive: if True, the number of frames buffered before playing them (target depth) is adapted to the
+                         measured jitter and loss. If False, playing starts after MINIMUM_INITIAL_FRAMES and the buffer
+                         is only consumed faster when it reaches BUFFER_MAX frames
         """
-        self._buffer = []
+        # Ring of datagrams indexed by sequence number (slot = seq_number % RING_CAPACITY). Every datagram buffered has
+        # a sequence number between __head_seq_number and __tail_seq_number, so no two of them share a slot
+        self._buffer: List[Optional[UDPDatagram]] = [None] * UDPBuffer.RING_CAPACITY
+        self.__length = 0
+        self.__head_seq_number = 0  # Lowest sequence number in the buffer (if not empty)
+        self.__tail_seq_number = 0  # Highest sequence number in the buffer (if not empty)
         self.__last_seq_number = 0
+        self.__highest_seq_number = 0
         self.__mutex = Lock()
         self._buffer_quality = BufferQuality.MEDIUM
-        self.__num_holes = 0  # Number of missing packages in the buffer
         self.__packages_lost = 0
-        self.__avg_delay = 0  # Measured in ms
+        # Average of the transit times (reception minus capture timestamp, in ms) of the frames. It includes the offset
+        # between the clocks of both ends, which does not matter to the jitter: only differences of transit times are
+        # used to compute it
+        self.__avg_transit = 0
+        self.__last_transit: Optional[float] = None
         self.__jitter = 0
+        self.__buffer_delay = 0  # Measured in ms
         self.__initial_frames = 0
+        self.__playing = False
+        self.__adaptive = adaptive
+        self.__target_depth = UDPBuffer.INITIAL_TARGET_FRAMES if adaptive else UDPBuffer.MINIMUM_INITIAL_FRAMES
+        self.__loss_rate = 0
         self.__time_between_frames = 0
         self.__last_consumed = None
-        self.__waker_continue = True
-        self.display_video_semaphore = display_video_semaphore
+        # The last consumed datagram is kept (the displayer may still be using its data) until the next one is consumed
+        self.__last_consumed_datagram = None
+        # Frames whose fragments are still being received, by sequence number
+        self.__partial_frames: Dict[int, _PartialFrame] = {}
+        self.__partial_frames_dropped = 0
+        self.__partial_frames_since_consumed = 0
+        self.__packets_recovered = 0
+        self.__packet_loss_rate = 0
+        self.playout_clock = playout_clock
+        # Seconds the clock of the other end is ahead of ours, as estimated by the round trip probe of the call (V5+).
+        # While it's None, delays are computed as if both clocks were in sync
+        self.clock_offset: Optional[float] = None
+
+    def __len__(self):
+        return self.__length
+
+    def __num_holes(self) -> int:
+        """
+        :return: number of missing packages between the first and the last datagrams of the buffer
+        """
+        if not self.__length:
+            return 0
+        return self.__tail_seq_number - self.__head_seq_number + 1 - self.__length
 
-    def __del__(self):
-        self.__waker_continue = False
+    def __pop_head(self) -> UDPDatagram:
+        """
+        Removes the first datagram of the buffer, that must not be empty, and looks for the next one. Since every slot
+        is only skipped once, this is O(1) amortized. Must be called with the mutex held
+        :return: the removed datagram
+        """
+        slot = self.__head_seq_number % UDPBuffer.RING_CAPACITY
+        datagram = self._buffer[slot]
+        self._buffer[slot] = None
+        self.__length -= 1
+        if self.__length:
+            self.__head_seq_number += 1
+            while self._buffer[self.__head_seq_number % UDPBuffer.RING_CAPACITY] is None:
+                self.__head_seq_number += 1
+        return datagram
+
+    def __skip_until(self, seq_number: int):
+        """
+        Drops every datagram older than seq_number, which are considered lost. Used when a datagram does not fit in the
+        ring because it is too far ahead. Must be called with the mutex held
+        :param seq_number
+        """
+        while self.__length and self.__head_seq_number < seq_number:
+            self.__pop_head().release()
+        self.__packages_lost += seq_number - 1 - self.__last_seq_number
+        self.__last_seq_number = seq_number - 1
 
-    def wake_displayer(self):
+    def get_statistics(self) -> BufferStatistics:
         """
-        Tells the displayer it should display video according to computed fps
+        :return: buffer quality, packages lost, average delay, jitter, partial frames dropped, depth, target depth,
+                 packets recovered, packet loss rate, highest sequence number received, buffer delay
         """
-        while self.__waker_continue:
-            self.display_video_semaphore.release()
-            sleep(self.__time_between_frames)
+        clock_offset = self.clock_offset
+        avg_delay = self.__avg_transit + clock_offset * 1000 if clock_offset is not None else self.__avg_transit
+        return BufferStatistics(self._buffer_quality, self.__packages_lost, avg_delay, self.__jitter,
+                                self.__partial_frames_dropped, self.__length, self.__target_depth,
+                                self.__packets_recovered, self.__packet_loss_rate, self.__highest_seq_number,
+                                self.__buffer_delay)
+
+    def __playout_interval(self) -> float:
+        """
+        :return: seconds between two consumed frames. In adaptive mode, the buffer is consumed faster when it holds
+                 more frames than the target depth, and slower when it holds less
+        """
+        if self.__adaptive:
+            if self.__length > self.__target_depth + 1:
+                return self.__time_between_frames / UDPBuffer.CONSUME_SPEEDUP
+            if self.__length < self.__target_depth - 1:
+                return self.__time_between_frames * UDPBuffer.CONSUME_SLOWDOWN
+        return self.__time_between_frames
+
+    def __update_target_depth(self):
+        """
+        Moves the target depth towards the one needed for the current jitter and loss rate. Must be called with the
+        mutex held
+        """
+        frame_interval = self.__time_between_frames * 1000  # Measured in ms
+        needed = 1 + UDPBuffer.JITTER_MARGIN * self.__jitter / frame_interval + UDPBuffer.LOSS_MARGIN * self.__loss_rate
+        needed = min(max(needed, UDPBuffer.MIN_TARGET_FRAMES), UDPBuffer.MAX_TARGET_FRAMES)
+        factor = UDPBuffer.TARGET_GROW if needed > self.__target_depth else UDPBuffer.TARGET_SHRINK
+        self.__target_depth += factor * (needed - self.__target_depth)
 
-    def get_statistics(self) -> Tuple[BufferQuality, int, float, float]:
+    def __update_packet_loss_rate(self, lost: int, total: int):
         """
-        :return: buffer quality, packages lost, average delay, jitter
+        Updates the estimated packet loss rate (before recovering packets) with the packets of a frame
+        :param lost: packets of the frame that were lost (even if they were recovered afterwards)
+        :param total: packets of the frame
         """
-        return self._buffer_quality, self.__packages_lost, self.__avg_delay, self.__jitter
+        self.__packet_loss_rate = (1 - UDPBuffer.LOSS_U)*self.__packet_loss_rate + UDPBuffer.LOSS_U*lost/total
 
+    def __drop_partial_frame(self, seq_number: int):
+        """
+        Drops a frame whose fragments have not been completely received. Must be called with the mutex held
+        :param seq_number
+        """
+        partial_frame = self.__partial_frames.pop(seq_number)
+        partial_frame.release()
+        self.__partial_frames_dropped += 1
+        self.__partial_frames_since_consumed += 1
+        fragment_count = len(partial_frame.fragments)
+        self.__update_packet_loss_rate(fragment_count - partial_frame.received + partial_frame.recovered,
+                                       fragment_count)
+
+    def __reassemble(self, fragment: UDPDatagram) -> Optional[UDPDatagram]:
+        """
+        Stores a fragment (or a parity datagram) of a frame, recovering the missing fragments that can be recovered.
+        Frames that have waited for their fragments more than REASSEMBLY_TIMEOUT seconds are dropped. Must be called
+        with the mutex held
+        :param fragment
+        :return: the whole frame if this was its last missing fragment, None otherwise
+        """
+        now = default_timer()
+        for seq_number in [seq_number for seq_number, partial_frame in self.__partial_frames.items()
+                           if now - partial_frame.started > UDPBuffer.REASSEMBLY_TIMEOUT]:
+            self.__drop_partial_frame(seq_number)
+
+        partial_frame = self.__partial_frames.get(fragment.seq_number)
+        if partial_frame is None:
+            partial_frame = self.__partial_frames[fragment.seq_number] = _PartialFrame(fragment.fragment_count)
+        elif len(partial_frame.fragments) != fragment.fragment_count:
+            fragment.release()
+            return None
+
+        # Fragments may wait long for the rest of their frame, and each one would hold a receive buffer as big as the
+        # biggest datagram, running the pool out. Their data is small, so it is copied out and the buffer given back
+        if fragment.flags & UDPDatagram.FLAG_PARITY:
+            if fragment.fragment_index in partial_frame.parities:
+                # Duplicated parity datagram
+                fragment.release()
+                return None
+            fragment.detach()
+            partial_frame.parities[fragment.fragment_index] = fragment
+            group_start = fragment.fragment_index
+        else:
+            if partial_frame.fragments[fragment.fragment_index] is not None:
+                # Duplicated fragment
+                fragment.release()
+                return None
+            fragment.detach()
+            partial_frame.fragments[fragment.fragment_index] = fragment
+            partial_frame.received += 1
+            group_start = partial_frame.group_of(fragment.fragment_index)
+
+        if group_start is not None and partial_frame.recover(group_start):
+            self.__packets_recovered += 1
+
+        if partial_frame.received < len(partial_frame.fragments):
+            return None
+
+        del self.__partial_frames[fragment.seq_number]
+        self.__update_packet_loss_rate(partial_frame.recovered, len(partial_frame.fragments))
+        frame = UDPDatagram(fragment.seq_number, fragment.resolution, fragment.fps,
+                            b"".join(f.data for f in partial_frame.fragments), ts=fragment.sent_ts,
+                            flags=fragment.flags & ~(UDPDatagram.FLAG_FRAGMENT | UDPDatagram.FLAG_PARITY))
+        partial_frame.release()
+        return frame
+
+    @timed("UDPBuffer.insert")
     def insert(self, datagram: UDPDatagram) -> bool:
         """
-        Inserts the specified datagram in the buffer, preserving the order. It discards the datagram if it's too old
+        Inserts the specified datagram in the buffer, preserving the order. It discards the datagram if it's too old.
+        If the datagram is a fragment of a frame, it is held until the rest of fragments are received
         :param datagram
-        :return True if datagram is inserted, False if not
+        :return True if datagram is inserted (or held as a fragment), False if not
         """
-        datagram.set_received_time()
-
         with self.__mutex:
             # If datagram should have already been consumed, discard it
-            if datagram.seq_number < self.__last_seq_number:
+            if datagram.seq_number <= self.__last_seq_number:
+                datagram.release()
                 return False
+            self.__highest_seq_number = max(self.__highest_seq_number, datagram.seq_number)
+
+            if datagram.flags & UDPDatagram.FLAG_FRAGMENT:
+                slot = datagram.seq_number % UDPBuffer.RING_CAPACITY
+                if self._buffer[slot] is not None and self._buffer[slot].seq_number == datagram.seq_number:
+                    # The frame has already been completed (this is a duplicate or an unneeded parity datagram)
+                    datagram.release()
+                    return False
+                datagram = self.__reassemble(datagram)
+                if datagram is None:
+                    return True
+
+            seq_number = datagram.seq_number
+            slot = seq_number % UDPBuffer.RING_CAPACITY
+            if self.__length:
+                if self._buffer[slot] is not None and self._buffer[slot].seq_number == seq_number:
+                    # Duplicated datagram
+                    datagram.release()
+                    return False
+                if self.__tail_seq_number - seq_number >= UDPBuffer.RING_CAPACITY:
+                    # Too old compared to the rest of the buffer
+                    datagram.release()
+                    return False
+                if seq_number - self.__head_seq_number >= UDPBuffer.RING_CAPACITY:
+                    self.__skip_until(seq_number - UDPBuffer.RING_CAPACITY + 1)
+
+            datagram.set_received_time(self.clock_offset or 0)
+            get_metrics().observe("receive", datagram.delay_ts)
+            transit = (datagram.received_ts - datagram.sent_ts) * 1000
 
             # Update time_between_frames
-            self.__time_between_frames = UDPBuffer.U*1/datagram.fps + (1 - UDPBuffer.U)*self.__time_between_frames
+            if self.__initial_frames == 0:
+                self.__time_between_frames = 1 / datagram.fps
+            else:
+                self.__time_between_frames = UDPBuffer.U*1/datagram.fps + (1 - UDPBuffer.U)*self.__time_between_frames
 
-            buffer_len = len(self._buffer)
-            if buffer_len >= UDPBuffer.BUFFER_MAX:
+            if not self.__adaptive and self.__length >= UDPBuffer.BUFFER_MAX:
                 self.__time_between_frames /= UDPBuffer.CONSUME_SPEEDUP
 
             if self.__initial_frames < UDPBuffer.MINIMUM_INITIAL_FRAMES:
                 self.__initial_frames += 1
                 if self.__initial_frames == 1:
-                    self.__avg_delay = datagram.delay_ts
-                if self.__initial_frames == UDPBuffer.MINIMUM_INITIAL_FRAMES:
-                    # If we are ready to start playing, start the waker thread
-                    Thread(target=self.wake_displayer, daemon=True).start()
-
-            # If buffer is currently empty
-            if buffer_len == 0:
-                self._buffer.append(datagram)
-
-            # If datagram should be the first element
-            elif self._buffer[0].seq_number > datagram.seq_number:
-                self.__num_holes += self._buffer[0].seq_number - datagram.seq_number - 1
-                self._buffer.insert(0, datagram)
-
-            else:
-                for i in range(buffer_len - 1, -1, -1):
-                    if self._buffer[i].seq_number < datagram.seq_number:
-                        if i + 1 < buffer_len:
-                            self.__num_holes -= 1  # Since package is inserted in the middle, there is one less lost
-                        else:
-                            self.__num_holes += datagram.seq_number - self._buffer[i].seq_number - 1
-
-                        self._buffer.insert(i + 1, datagram)
-                        break
-
-            self.__avg_delay = (1 - UDPBuffer.U)*self.__avg_delay + UDPBuffer.U*datagram.delay_ts
-            self.__jitter = (1 - UDPBuffer.U)*self.__jitter + UDPBuffer.U*abs(datagram.delay_ts - self.__avg_delay)
+                    self.__avg_transit = transit
+                if not self.__adaptive and self.__initial_frames == UDPBuffer.MINIMUM_INITIAL_FRAMES:
+                    self.__playing = True
+
+            self._buffer[slot] = datagram
+            if not self.__length:
+                self.__head_seq_number = self.__tail_seq_number = seq_number
+            elif seq_number < self.__head_seq_number:
+                self.__head_seq_number = seq_number
+            elif seq_number > self.__tail_seq_number:
+                self.__tail_seq_number = seq_number
+            self.__length += 1
+
+            self.__avg_transit = (1 - UDPBuffer.U)*self.__avg_transit + UDPBuffer.U*transit
+            # Interarrival jitter: variation of the transit time between consecutive frames received. The offset
+            # between clocks cancels out, so it does not need to be known
+            if self.__last_transit is not None:
+                self.__jitter += (abs(transit - self.__last_transit) - self.__jitter) * UDPBuffer.JITTER_GAIN
+            self.__last_transit = transit
+
+            if self.__adaptive:
+                self.__update_target_depth()
+                if not self.__playing and self.__length >= self.__target_depth:
+                    self.__playing = True
+
+            if self.__playing:
+                self.playout_clock.retarget(self.__playout_interval())
 
             # Recompute buffer_quality
-            score = 5 * self.__num_holes + 2 * self.__packages_lost/(datagram.seq_number+1)
+            score = 5 * self.__num_holes() + 2 * self.__packages_lost/(datagram.seq_number+1)
             if 20 < self.__jitter < 50:
                 score += 10
             elif self.__jitter > 50:
@@ -182,28 +789,55 @@ class UDPBuffer:
                 self._buffer_quality = BufferQuality.LOW
             return True
 
-    def consume(self) -> bytes:
+    @timed("UDPBuffer.consume")
+    def consume(self) -> Union[bytes, memoryview]:
         """
-        Consumes first datagram of the buffer, returning its data and updating buffer statistics
+        Consumes first datagram of the buffer, returning its data and updating buffer statistics. The data returned is
+        valid until the next datagram is consumed
         :return: consumed_datagram.data
         """
         with self.__mutex:
             now = default_timer()
-            if self.__last_consumed is not None and now - self.__last_consumed < self.__time_between_frames:
+            if self.__last_consumed is not None and now - self.__last_consumed < self.__playout_interval():
                 return bytes()
 
-            if not self._buffer or self.__initial_frames < UDPBuffer.MINIMUM_INITIAL_FRAMES:
+            if not self.__playing:
+                return bytes()
+
+            if not self.__length:
+                self.playout_clock.report_underrun()
+                if self.__adaptive:
+                    # Underrun: hold playing until a (bigger) target depth is buffered again
+                    self.__target_depth = min(self.__target_depth + 1, UDPBuffer.MAX_TARGET_FRAMES)
+                    self.__playing = False
                 return bytes()
 
             # Update last time consumed
             self.__last_consumed = now
 
-            consumed_datagram = self._buffer.pop(0)
+            consumed_datagram = self.__pop_head()
+            buffer_delay = (steady_time() - consumed_datagram.received_ts) * 1000
+            get_metrics().observe("buffer", buffer_delay)
+            self.__buffer_delay = buffer_delay if self.__last_consumed_datagram is None \
+                else (1 - UDPBuffer.U)*self.__buffer_delay + UDPBuffer.U*buffer_delay
+            # Frames older than the consumed one will never be completed
+            for seq_number in [seq_number for seq_number in self.__partial_frames
+                               if seq_number < consumed_datagram.seq_number]:
+                self.__drop_partial_frame(seq_number)
+
             # Update packages that have been definitely lost
-            self.__packages_lost += consumed_datagram.seq_number - self.__last_seq_number - 1
+            lost = consumed_datagram.seq_number - self.__last_seq_number - 1
+            self.__packages_lost += lost
             self.__last_seq_number = consumed_datagram.seq_number
-
-            if self._buffer:
-                self.__num_holes -= self._buffer[0].seq_number - consumed_datagram.seq_number - 1
+            self.__loss_rate = (1 - UDPBuffer.LOSS_U)*self.__loss_rate + UDPBuffer.LOSS_U*lost/(lost + 1)
+            # Frames never seen at all count as all of their packets lost (partial frames were already accounted for)
+            unseen = max(lost - self.__partial_frames_since_consumed, 0)
+            self.__packet_loss_rate = 1 - (1 - self.__packet_loss_rate)*(1 - UDPBuffer.LOSS_U)**unseen
+            self.__partial_frames_since_consumed = 0
+            self.playout_clock.retarget(self.__playout_interval())
+
+            if self.__last_consumed_datagram is not None:
+                self.__last_consumed_datagram.release()
+            self.__last_consumed_datagram = consumed_datagram
 
             return consumed_datagram.data
@@ -5,6 +5,22 @@ from decorators import singleton
 
 currentUser = None
 
+# Protocols supported by this client, in the format expected by the discovery server.
+# V2 adds a packed binary header to the video datagrams (see udp_helper.UDPDatagram)
+# V3 adds parity datagrams for forward error correction (see udp_helper.add_parity)
+# V4 ends every message of the call connection with a newline, and adds periodic receiver reports (CALL_REPORT, see
+# call_control.ReceiverReport)
+# V5 adds a round trip probe (CALL_PING/CALL_PONG, see call_control.RoundTripEstimator)
+SUPPORTED_PROTOCOLS = "V0#V1#V2#V3#V4#V5"
+
+
+def protocol_version(protocol: str) -> int:
+    """
+    :param protocol: protocol name, such as V0 or V1
+    :return: numeric version of the protocol (V2 -> 2)
+    """
+    return int(protocol[1:])
+
 
 def _get_public_ip():
     """
@@ -49,7 +65,7 @@ class User:
         Returns best common protocol with the current user
         """
         common_protocols = list(set(self.protocols).intersection(CurrentUser().protocols))
-        best_protocol = sorted(common_protocols)[-1]
+        best_protocol = sorted(common_protocols, key=protocol_version)[-1]
         return best_protocol
 
 
@@ -0,0 +1,125 @@
+from typing import Optional, Tuple, Union
+
+from timeit import default_timer
+
+import cv2
+import numpy as np
+
+from logger import get_logger
+from metrics import get_metrics
+
+
+def jpeg_size(data: Union[bytes, memoryview]) -> Optional[Tuple[int, int]]:
+    """
+    Reads the size of a JPEG image from its frame header, without decoding it
+    :param data: the compressed image
+    :return: (width, height), or None if the frame header could not be found
+    """
+    data = memoryview(data)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        # Padding bytes between segments
+        if marker == 0xFF:
+            position += 1
+            continue
+        # Start of frame markers (all of them but DHT, JPG and DAC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[position + 5:position + 7], "big")
+            width = int.from_bytes(data[position + 7:position + 9], "big")
+            return width, height
+        position += 2 + int.from_bytes(data[position + 2:position + 4], "big")
+    return None
+
+
+class VideoRenderer:
+    """
+    Builds the frames shown on the video widget. Every frame is rendered into the same preallocated arrays, resizes are
+    skipped when the frames already have the right size, and remote frames larger than needed are decoded at a reduced
+    scale. The frames returned are overwritten by the next render, so they must be displayed (copied) before that
+    """
+    # The local frame is shown over the remote one with 1/PIP_SCALE of its width and height
+    PIP_SCALE = 4
+    PIP_MARGIN = 10
+    # Decoding flags that reduce the size of the image, by factor
+    REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+    def __init__(self, width: int, height: int):
+        """
+        Constructor
+        :param width: width of the rendered frames
+        :param height: height of the rendered frames
+        """
+        self.__width = width
+        self.__height = height
+        self.__frame = np.empty((height, width, 3), np.uint8)
+        self.__local_frame = np.empty((height, width, 3), np.uint8)
+        self.__pip_frame = np.empty((height // VideoRenderer.PIP_SCALE, width // VideoRenderer.PIP_SCALE, 3), np.uint8)
+
+    def __decode_flags(self, data: Union[bytes, memoryview]) -> int:
+        """
+        :return: the flags to decode a remote frame with the smallest size that is not smaller than the rendered frames
+        """
+        size = jpeg_size(data)
+        if size is not None:
+            for factor, flags in VideoRenderer.REDUCED_FLAGS:
+                if size[0] // factor >= self.__width and size[1] // factor >= self.__height:
+                    return flags
+        return cv2.IMREAD_COLOR
+
+    def __fit(self, frame: np.ndarray, dst: np.ndarray, code: Optional[int]) -> np.ndarray:
+        """
+        Converts the colors of a frame and resizes it, writing it into dst. The resize is skipped if the frame already
+        has the size of dst, and otherwise the colors are converted on the smaller of both sizes
+        :param frame: the frame
+        :param dst: array the frame is written to
+        :param code: color conversion code, or None if no conversion is needed
+        :return: dst
+        """
+        if frame.shape == dst.shape:
+            if code is None:
+                np.copyto(dst, frame)
+            else:
+                cv2.cvtColor(frame, code, dst=dst)
+            return dst
+        if code is not None and frame.size < dst.size and frame.flags.writeable:
+            cv2.cvtColor(frame, code, dst=frame)
+            code = None
+        interpolation = cv2.INTER_AREA if frame.size > dst.size else cv2.INTER_LINEAR
+        cv2.resize(frame, (dst.shape[1], dst.shape[0]), dst=dst, interpolation=interpolation)
+        if code is not None:
+            cv2.cvtColor(dst, code, dst=dst)
+        return dst
+
+    def render_local(self, frame: np.ndarray) -> np.ndarray:
+        """
+        :param frame: a local frame (BGR)
+        :return: the local frame to be displayed (RGB)
+        """
+        return self.__fit(frame, self.__local_frame, cv2.COLOR_BGR2RGB)
+
+    def render_call(self, data: Union[bytes, memoryview], local_frame: np.ndarray) -> Optional[np.ndarray]:
+        """
+        :param data: a remote frame, compressed as JPEG
+        :param local_frame: the last local frame returned by render_local
+        :return: the remote frame with the local one at the bottom right (RGB), or None if the remote frame could not
+                 be decoded
+        """
+        start = default_timer()
+        remote_frame = cv2.imdecode(np.frombuffer(data, np.uint8), self.__decode_flags(data))
+        if remote_frame is None:
+            get_logger().warning("Error decoding a remote frame")
+            return None
+        decoded = default_timer()
+        get_metrics().observe("decode", (decoded - start) * 1000)
+        self.__fit(remote_frame, self.__frame, cv2.COLOR_BGR2RGB)
+        self.__fit(local_frame, self.__pip_frame, None)
+        pip_height, pip_width = self.__pip_frame.shape[:2]
+        margin = VideoRenderer.PIP_MARGIN
+        self.__frame[-pip_height - margin:-margin, -pip_width - margin:-margin] = self.__pip_frame
+        get_metrics().observe("render", (default_timer() - decoded) * 1000)
+        return self.__frame